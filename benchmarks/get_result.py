@@ -0,0 +1,76 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+#  license you chose for the specific language governing permissions and
+#  limitations under that license.
+#
+
+"""Compare the ways _get_result can find the result tests are run with.
+
+Times a lookup from under a run frame holding the result, at a range of
+stack depths, using the inspect.stack() search _get_result used to do, its
+frame walking fallback, and the result published by activeResult.
+
+Run with: python benchmarks/get_result.py [depths...]
+"""
+
+import inspect
+import sys
+import timeit
+import unittest
+
+import testresources
+
+
+def stack_search():
+    for frame in inspect.stack()[2:]:
+        if frame[3] in ('run', '__call__'):
+            result = frame[0].f_locals.get('result')
+            if (result is not None and
+                getattr(result, 'startTest', None) is not None):
+                return result
+
+
+def lookup(find):
+    return find()
+
+
+def nest(depth, function):
+    if depth:
+        return nest(depth - 1, function)
+    return function()
+
+
+def run(result, depth, find, number):
+    return timeit.timeit(lambda: nest(depth, lambda: lookup(find)),
+        number=number)
+
+
+def main(argv):
+    depths = [int(arg) for arg in argv] or [10, 50, 200]
+    number = 1000
+    result = unittest.TestResult()
+    print("%6s %14s %14s %14s" % (
+        "depth", "stack (ms)", "frames (ms)", "active (ms)"))
+    for depth in depths:
+        stack = run(result, depth, stack_search, number)
+        with testresources.activeResult(None):
+            frames = run(result, depth, testresources._get_result, number)
+        with testresources.activeResult(result):
+            active = run(result, depth, testresources._get_result, number)
+        print("%6d %14.4f %14.4f %14.4f" % (depth, stack * 1000 / number,
+            frames * 1000 / number, active * 1000 / number))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
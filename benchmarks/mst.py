@@ -0,0 +1,80 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+#  license you chose for the specific language governing permissions and
+#  limitations under that license.
+#
+
+"""Compare the MST backends used when ordering resource sets.
+
+Times ordering by walking an MST found with _kruskals_graph_MST against
+OptimisingTestSuite._walkOrder, which uses _prim_MST, on the doubled graphs
+that the walk needs, for a range of numbers of resource sets. Reports where
+Prim's algorithm starts to win.
+
+Run with: python benchmarks/mst.py [sizes...]
+"""
+
+import random
+import sys
+import timeit
+
+import testresources
+
+
+def make_costs(size):
+    """Make a random switching cost matrix with size resource sets."""
+    return [[random.randint(1, 100) if from_node != to_node else 0
+        for to_node in range(size)] for from_node in range(size)]
+
+
+def kruskal(costs):
+    size = len(costs)
+    primes = dict((node, node + size) for node in range(size))
+    digraph = {}
+    for from_node in range(size):
+        digraph[from_node] = dict((to_node, costs[from_node][to_node])
+            for to_node in range(1, size) if to_node != from_node)
+    graph = testresources._digraph_to_graph(digraph, primes)
+    mst = testresources._kruskals_graph_MST(graph)
+    return testresources._walk_MST(mst, 0, primes)
+
+
+def prim(costs):
+    suite = testresources.OptimisingTestSuite()
+    suite.use_numpy = False
+    return suite._walkOrder(costs)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [5, 10, 20, 50, 100, 200, 400]
+    print("%8s %12s %12s" % ("sets", "kruskal (s)", "prim (s)"))
+    crossover = None
+    for size in sizes:
+        costs = make_costs(size)
+        repeat = max(1, 2000 // (size * size))
+        kruskal_time = min(timeit.repeat(
+            lambda: kruskal(costs), number=repeat, repeat=3)) / repeat
+        prim_time = min(timeit.repeat(
+            lambda: prim(costs), number=repeat, repeat=3)) / repeat
+        print("%8d %12.6f %12.6f" % (size, kruskal_time, prim_time))
+        if crossover is None and prim_time < kruskal_time:
+            crossover = size
+    if crossover is None:
+        print("Prim's algorithm did not win at any size tried.")
+    else:
+        print("Prim's algorithm wins from %d resource sets." % crossover)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+#  license you chose for the specific language governing permissions and
+#  limitations under that license.
+#
+
+"""Compare _OrderedSet with the linked list recipe it replaced.
+
+Times what OptimisingTestSuite.switch does with its ordered sets: building
+the old and new sets, then iterating the resources to tear down in reverse
+and the resources to set up, for a range of resource set sizes where half of
+the resources are shared between the two sets.
+
+Run with: python benchmarks/ordered_set.py [sizes...]
+"""
+
+import sys
+import timeit
+
+try:
+    from collections.abc import MutableSet
+except ImportError:
+    from collections import MutableSet
+
+import testresources
+
+
+class RecipeOrderedSet(MutableSet):
+    """The linked list OrderedSet recipe testresources used to use.
+
+    See https://code.activestate.com/recipes/576694/
+    """
+
+    def __init__(self, iterable=None):
+        self.end = end = []
+        end += [None, end, end]         # sentinel node for doubly linked list
+        self.map = {}                   # key --> [key, prev, next]
+        if iterable is not None:
+            self |= iterable
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def add(self, key):
+        if key not in self.map:
+            end = self.end
+            curr = end[1]
+            curr[2] = end[1] = self.map[key] = [key, curr, end]
+
+    def discard(self, key):
+        if key in self.map:
+            key, prev, next = self.map.pop(key)
+            prev[2] = next
+            next[1] = prev
+
+    def __iter__(self):
+        end = self.end
+        curr = end[2]
+        while curr is not end:
+            yield curr[0]
+            curr = curr[2]
+
+    def __reversed__(self):
+        end = self.end
+        curr = end[1]
+        while curr is not end:
+            yield curr[0]
+            curr = curr[1]
+
+
+def recipe_switch(old, new):
+    """Switch between resource lists the way switch() used to."""
+    old_set = RecipeOrderedSet(old)
+    new_set = RecipeOrderedSet(new)
+    for resource in reversed(old_set - new_set):
+        pass
+    for resource in new_set - old_set:
+        pass
+
+
+def compact_switch(old, new):
+    """Switch between resource lists the way switch() does now."""
+    old_set = testresources._OrderedSet(old)
+    new_set = testresources._OrderedSet(new)
+    for resource in old_set.reversed_difference(new_set):
+        pass
+    for resource in new_set.difference(old_set):
+        pass
+
+
+def time_switch(switch, old, new, number):
+    """Return the seconds per call of switch(old, new)."""
+    return timeit.timeit(lambda: switch(old, new), number=number) / number
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [1, 4, 16, 64, 256]
+    print("%8s %12s %12s %8s" % ("size", "recipe", "compact", "speedup"))
+    for size in sizes:
+        resources = [testresources.TestResourceManager()
+            for i in range(size + size // 2)]
+        old = resources[:size]
+        new = resources[size // 2:]
+        number = max(10, 20000 // size)
+        recipe = time_switch(recipe_switch, old, new, number)
+        compact = time_switch(compact_switch, old, new, number)
+        print("%8d %10.1fus %10.1fus %7.1fx" % (
+            size, recipe * 1e6, compact * 1e6, recipe / compact))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -17,14 +17,42 @@
 
 """TestResources: declarative management of external resources for tests."""
 
+import collections
+import contextlib
+import atexit
+import copy
 import heapq
-import inspect
+import multiprocessing
+import os
+import sys
+import threading
+import time
 import unittest
-import collections
+import warnings
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from collections.abc import Iterable, MutableSet
+except ImportError:
+    from collections import Iterable, MutableSet
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 try:
     import unittest2
 except ImportError:
     unittest2 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 # same format as sys.version_info: "A tuple containing the five components of
 # the version number: major, minor, micro, releaselevel, and serial. All
@@ -43,6 +71,9 @@ _version = VersionInfo('testresources')
 __version__ = _version.semantic_version().version_tuple()
 version = _version.release_string()
 
+# The clock used to measure the costs of resources.
+_timer = getattr(time, 'perf_counter', time.time)
+
 
 def test_suite():
     import testresources.tests
@@ -125,29 +156,677 @@ def _kruskals_graph_MST(graph):
     return result
 
 
-def _resource_graph(resource_sets):
+def _walk_MST(mst, root, primes):
+    """Order the nodes of a digraph from the MST of its prime graph.
+
+    :param mst: The minimum spanning tree of the graph made by
+        _digraph_to_graph(digraph, primes). It is consumed.
+    :param root: The node to start from.
+    :param primes: The prime node mapping used to make the graph.
+    :return: A list of the nodes of the digraph, starting with root.
+    """
+    # Because the representation is a digraph, we can build an Eulerian
+    # cycle directly from the representation by just following the links:
+    # a node with only 1 'edge' has two directed edges; and we can only
+    # enter and leave it once, so the edge lookups will match precisely.
+    # As the mst is a spanning tree, the graph will become disconnected
+    # (we choose non-disconnecting edges first)
+    #  - for a stub node (1 outgoing link): when exiting it unless it is
+    #    the first node started at
+    # - for a non-stub node if choosing an outgoing link where some other
+    #   endpoints incoming link has not been traversed. [exit by a
+    #   different node than entering, until all exits taken].
+    # We don't need the mst after, so it gets modified in place.
+    node = root
+    cycle = [node]
+    steps = 2 * (len(mst) - 1)
+    for step in range(steps):
+        found = False
+        outgoing = None  # For clearer debugging.
+        for outgoing in mst[node]:
+            if node in mst[outgoing]:
+                # we have a return path: take it
+                # print node, '->', outgoing, ' can return'
+                del mst[node][outgoing]
+                node = outgoing
+                cycle.append(node)
+                found = True
+                break
+        if not found:
+            # none of the outgoing links have an incoming, so follow an
+            # arbitrary one (the last examined outgoing)
+            # print node, '->', outgoing
+            del mst[node][outgoing]
+            node = outgoing
+            cycle.append(node)
+    # Convert to a path:
+    visited = set()
+    order = []
+    for node in cycle:
+        if node in visited:
+            continue
+        if node in primes:
+            order.append(node)
+        visited.add(node)
+    assert order[0] == root
+    return order
+
+
+def _prim_MST(size, row):
+    """Find the minimal spanning tree of a dense graph using Prims algorithm.
+
+    See http://en.wikipedia.org/wiki/Prim%27s_algorithm. This takes O(n^2)
+    time and O(n) extra memory, which beats _kruskals_graph_MST on the
+    complete graphs that _makeOrder works with.
+    :param size: The number of nodes in the graph, which are numbered from 0.
+    :param row: A function returning a list of the weights of the edges from a
+        node, with float('inf') where there is no edge.
+    :return: A graph in {from:{to:value}} form with all nodes and those
+        vertices that are part of the MST for graph. If graph is not
+        connected, then the result will also be a forest.
+    """
+    inf = float('inf')
+    result = dict((node, {}) for node in range(size))
+    # best[node] is the cheapest edge from the tree to node, via parent[node].
+    best = [inf] * size
+    parent = [None] * size
+    remaining = list(range(size))
+    while remaining:
+        pos = min(range(len(remaining)), key=lambda pos: best[remaining[pos]])
+        node = remaining[pos]
+        remaining[pos] = remaining[-1]
+        remaining.pop()
+        if parent[node] is not None:
+            result[node][parent[node]] = best[node]
+            result[parent[node]][node] = best[node]
+        weights = row(node)
+        for other in remaining:
+            weight = weights[other]
+            if weight < best[other]:
+                best[other] = weight
+                parent[other] = node
+    return result
+
+
+def _numpy_prim_MST(size, row):
+    """Find the minimal spanning tree of a dense graph using Prims algorithm.
+
+    See http://en.wikipedia.org/wiki/Prim%27s_algorithm.
+    :param size: The number of nodes in the graph, which are numbered from 0.
+    :param row: A function returning the numpy.ndarray of the weights of the
+        edges from a node, with numpy.inf where there is no edge. Taking rows
+        one at a time avoids needing the whole matrix in memory at once.
+    :return: A graph in {from:{to:value}} form with all nodes and those
+        vertices that are part of the MST for graph. If graph is not
+        connected, then the result will also be a forest.
+    """
+    result = dict((node, {}) for node in range(size))
+    in_tree = numpy.zeros(size, dtype=bool)
+    # best[node] is the cheapest edge from the tree to node, via parent[node].
+    best = numpy.full(size, numpy.inf)
+    parent = numpy.full(size, -1)
+    for _ in range(size):
+        candidates = numpy.where(in_tree, numpy.inf, best)
+        node = int(candidates.argmin())
+        if in_tree[node]:
+            # Only unreachable nodes remain: start a new tree.
+            node = int(numpy.flatnonzero(~in_tree)[0])
+        in_tree[node] = True
+        if best[node] != numpy.inf:
+            value = best[node].item()
+            result[node][int(parent[node])] = value
+            result[int(parent[node])][node] = value
+        weights = row(node)
+        closer = (weights < best) & ~in_tree
+        best[closer] = weights[closer]
+        parent[closer] = node
+    return result
+
+
+def _min_weight_perfect_matching(graph, nodes):
+    """Find a minimum weight perfect matching between nodes.
+
+    This is an exact dynamic programme over subsets of nodes, so it is only
+    suitable for small numbers of nodes.
+
+    :param graph: A complete graph in {from:{to:value}} form.
+    :param nodes: A list of an even number of nodes in graph to match.
+    :return: A list of (node, node) pairs.
+    """
+    memo = {0: (0, None)}
+
+    def best(mask):
+        # Match the lowest unmatched node against every other unmatched node
+        # and keep the cheapest way to finish.
+        if mask in memo:
+            return memo[mask][0]
+        first = next(_bit_positions(mask))
+        rest = mask & ~(1 << first)
+        best_cost = None
+        best_pair = None
+        other = 0
+        while rest >> other:
+            if rest & (1 << other):
+                cost = (graph[nodes[first]][nodes[other]] +
+                    best(rest & ~(1 << other)))
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    best_pair = other
+            other += 1
+        memo[mask] = (best_cost, (first, best_pair))
+        return best_cost
+
+    mask = (1 << len(nodes)) - 1
+    best(mask)
+    pairs = []
+    while mask:
+        first, other = memo[mask][1]
+        pairs.append((nodes[first], nodes[other]))
+        mask &= ~((1 << first) | (1 << other))
+    return pairs
+
+
+def _greedy_matching(graph, nodes):
+    """Find a cheap perfect matching between nodes greedily.
+
+    Pairs are taken cheapest first whenever neither of their nodes has been
+    matched yet. This takes O(n**2 log n) time for n nodes, but the matching
+    is not always the minimum weight one.
+
+    :param graph: A complete graph in {from:{to:value}} form, or a dense
+        numpy.ndarray indexed by node number.
+    :param nodes: A list of an even number of nodes in graph to match.
+    :return: A list of (node, node) pairs.
+    """
+    count = len(nodes)
+    if numpy is not None and isinstance(graph, numpy.ndarray):
+        firsts, others = numpy.triu_indices(count, 1)
+        positions = numpy.array(nodes, dtype=int)
+        weights = graph[positions[firsts], positions[others]]
+        order = numpy.argsort(weights, kind='mergesort')
+        candidates = zip(firsts[order].tolist(), others[order].tolist())
+    else:
+        candidates = [(first, other) for _, first, other in sorted(
+            (graph[nodes[first]][nodes[other]], first, other)
+            for first in range(count) for other in range(first + 1, count))]
+    matched = [False] * count
+    pairs = []
+    for first, other in candidates:
+        if not (matched[first] or matched[other]):
+            matched[first] = matched[other] = True
+            pairs.append((nodes[first], nodes[other]))
+            if len(pairs) * 2 == count:
+                break
+    return pairs
+
+
+def _eulerian_circuit(multigraph, start):
+    """Find an Eulerian circuit using Hierholzer's algorithm.
+
+    :param multigraph: A connected multigraph in {from:[to, ...]} form where
+        every node has even degree. It is consumed.
+    :param start: The node to start and end the circuit at.
+    :return: A list of nodes, beginning and ending with start.
+    """
+    stack = [start]
+    circuit = []
+    while stack:
+        node = stack[-1]
+        if multigraph[node]:
+            next_node = multigraph[node].pop()
+            multigraph[next_node].remove(node)
+            stack.append(next_node)
+        else:
+            circuit.append(stack.pop())
+    circuit.reverse()
+    return circuit
+
+
+def _christofides_tour(graph, start, matching_limit, mst=None):
+    """Find a short tour of graph using Christofides algorithm.
+
+    See http://en.wikipedia.org/wiki/Christofides_algorithm.
+    :param graph: A complete graph in {from:{to:value}} form whose values meet
+        the triangle inequality. A dense matrix indexed by node number may be
+        used instead, in which case mst must be supplied.
+    :param start: The node to start the tour at.
+    :param matching_limit: The largest number of odd degree nodes in the
+        minimum spanning tree that will be matched exactly. Exact matching is
+        exponential in this number, so beyond the limit the odd nodes are
+        matched with _greedy_matching instead, and the tour is no longer
+        guaranteed to be within 1.5 times the optimal.
+    :param mst: The minimum spanning tree of graph, in {from:{to:value}} form.
+        If not supplied it is found with _kruskals_graph_MST.
+    :return: A list of every node in graph, beginning with start.
+    """
+    if mst is None:
+        mst = _kruskals_graph_MST(graph)
+    odd_nodes = [node for node, edges in mst.items() if len(edges) % 2]
+    if len(odd_nodes) > matching_limit:
+        matching = _greedy_matching(graph, odd_nodes)
+    else:
+        matching = _min_weight_perfect_matching(graph, odd_nodes)
+    multigraph = {}
+    for node, edges in mst.items():
+        multigraph[node] = list(edges)
+    for node, other in matching:
+        multigraph[node].append(other)
+        multigraph[other].append(node)
+    # Shortcut the circuit past nodes that have already been visited: the
+    # triangle inequality means this never makes the tour longer.
+    visited = set()
+    tour = []
+    for node in _eulerian_circuit(multigraph, start):
+        if node not in visited:
+            visited.add(node)
+            tour.append(node)
+    return tour
+
+
+def _tour_cost(tour, cost):
+    """Return the cost of travelling tour and back to its start.
+
+    :param tour: A list of nodes.
+    :param cost: A function giving the cost of going from one node to another.
+    """
+    return sum(cost(from_node, to_node) for from_node, to_node in
+        zip(tour, tour[1:] + tour[:1]))
+
+
+def _cost_matrix(tour, cost):
+    """Return a dense matrix of the costs between the nodes in tour.
+
+    :param tour: A list of nodes.
+    :param cost: A function giving the cost of going from one node to another.
+    :return: A list of rows, so that result[i][j] is the cost of going from
+        tour[i] to tour[j].
+    """
+    return [[cost(from_node, to_node) if from_node is not to_node else 0
+        for to_node in tour] for from_node in tour]
+
+
+def _held_karp_tour(tour, cost):
+    """Find the cheapest tour of some nodes using the Held-Karp algorithm.
+
+    :param tour: A list of nodes. The first node is where the tour starts.
+    :param cost: A function giving the cost of going from one node to another.
+    :return: A list of the same nodes, beginning with the same node, in the
+        order that costs least to travel and return to the start.
+    """
+    return [tour[pos] for pos in _held_karp_order(_cost_matrix(tour, cost))]
+
+
+def _held_karp_order(costs):
+    """Find the cheapest tour of a cost matrix using the Held-Karp algorithm.
+
+    See http://en.wikipedia.org/wiki/Held%E2%80%93Karp_algorithm. This is an
+    exact dynamic programme over subsets of nodes, taking O(2^n n^2) time, so
+    it is only suitable for small numbers of nodes.
+
+    :param costs: A dense cost matrix as returned by _cost_matrix.
+    :return: A list of the positions in costs, beginning with 0, in the order
+        that costs least to travel and return to the start.
+    """
+    size = len(costs) - 1
+    if size < 2:
+        return list(range(size + 1))
+    # best[mask][last] is the cost of the cheapest path from the start
+    # through the nodes in mask, ending at last (both positions in costs less
+    # one); came_from[mask][last] is the node before last on that path.
+    full = (1 << size) - 1
+    best = [[None] * size for _ in range(full + 1)]
+    came_from = [[None] * size for _ in range(full + 1)]
+    for last in range(size):
+        best[1 << last][last] = costs[0][last + 1]
+    for mask in range(1, full + 1):
+        row = best[mask]
+        for last in range(size):
+            path_cost = row[last]
+            if path_cost is None:
+                continue
+            step_costs = costs[last + 1]
+            for next_node in range(size):
+                bit = 1 << next_node
+                if mask & bit:
+                    continue
+                next_cost = path_cost + step_costs[next_node + 1]
+                current = best[mask | bit][next_node]
+                if current is None or next_cost < current:
+                    best[mask | bit][next_node] = next_cost
+                    came_from[mask | bit][next_node] = last
+    last = min(range(size),
+        key=lambda last: best[full][last] + costs[last + 1][0])
+    order = []
+    mask = full
+    while last is not None:
+        order.append(last + 1)
+        mask, last = mask & ~(1 << last), came_from[mask][last]
+    order.append(0)
+    order.reverse()
+    return order
+
+
+def _refine_tour(tour, cost, max_moves, deadline=None):
+    """Improve tour with 2-opt and Or-opt local search.
+
+    :param tour: A list of nodes. The first node is never moved.
+    :param cost: A function giving the cost of going from one node to another.
+    :param max_moves: The most moves to make.
+    :param deadline: If not None, a time.time() value after which no more
+        moves will be tried.
+    :return: A list of the same nodes in an order costing no more than tour.
+    """
+    order = _refine_order(_cost_matrix(tour, cost), list(range(len(tour))),
+        max_moves, deadline)
+    return [tour[pos] for pos in order]
+
+
+def _refine_order(costs, order, max_moves, deadline=None):
+    """Improve a tour of a cost matrix with 2-opt and Or-opt local search.
+
+    Moves are found by trying to reverse every segment of the tour (2-opt) and
+    then to move every segment of up to three nodes elsewhere in the tour
+    (Or-opt). The first move that lowers the cost of the tour is taken, and
+    the search repeats until no move helps. Costs need not be symmetric:
+    reversals are costed in the direction they will be travelled.
+
+    :param costs: A dense cost matrix as returned by _cost_matrix.
+    :param order: A list of the positions in costs. The first is never moved.
+    :param max_moves: The most moves to make.
+    :param deadline: If not None, a time.time() value after which no more
+        moves will be tried.
+    :return: A list of the same positions in an order costing no more than
+        order.
+    """
+    size = len(order)
+    order = list(order)
+    if size < 3:
+        return order
+
+    def out_of_time():
+        return deadline is not None and time.time() > deadline
+
+    def two_opt():
+        # forward[k] and backward[k] are the costs of travelling order[:k+1]
+        # forwards and backwards respectively.
+        forward = [0]
+        backward = [0]
+        for pos in range(1, size):
+            forward.append(forward[-1] + costs[order[pos - 1]][order[pos]])
+            backward.append(backward[-1] + costs[order[pos]][order[pos - 1]])
+        for start in range(1, size - 1):
+            if out_of_time():
+                return False
+            before = order[start - 1]
+            first = order[start]
+            for end in range(start + 1, size):
+                last = order[end]
+                after = order[(end + 1) % size]
+                delta = (costs[before][last] + costs[first][after] -
+                    costs[before][first] - costs[last][after] +
+                    backward[end] - backward[start] -
+                    forward[end] + forward[start])
+                if delta < 0:
+                    order[start:end + 1] = reversed(order[start:end + 1])
+                    return True
+        return False
+
+    def or_opt():
+        for length in (1, 2, 3):
+            for start in range(1, size - length + 1):
+                if out_of_time():
+                    return False
+                end = start + length - 1
+                before = order[start - 1]
+                first = order[start]
+                last = order[end]
+                after = order[(end + 1) % size]
+                removed = (costs[before][after] - costs[before][first] -
+                    costs[last][after])
+                for pos in range(size):
+                    if start - 1 <= pos <= end:
+                        continue
+                    left = order[pos]
+                    right = order[(pos + 1) % size]
+                    delta = (removed + costs[left][first] +
+                        costs[last][right] - costs[left][right])
+                    if delta < 0:
+                        segment = order[start:end + 1]
+                        del order[start:end + 1]
+                        if pos > end:
+                            pos -= length
+                        order[pos + 1:pos + 1] = segment
+                        return True
+        return False
+
+    for _ in range(max_moves):
+        if out_of_time() or not (two_opt() or or_opt()):
+            break
+    return order
+
+
+def _iter_bits(mask):
+    """Yield each set bit of mask as an integer of its own, lowest first."""
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+# The position of each bit of a byte, as int.bit_length is not available
+# before Python 2.7.
+_BYTE_BIT_POSITIONS = dict((1 << position, position) for position in range(8))
+
+
+def _bit_positions(mask):
+    """Yield the position of each set bit of mask, lowest first."""
+    offset = 0
+    while mask:
+        byte = mask & 255
+        while byte:
+            bit = byte & -byte
+            yield offset + _BYTE_BIT_POSITIONS[bit]
+            byte ^= bit
+        mask >>= 8
+        offset += 8
+
+
+def _weighted_popcount_tables(weights):
+    """Build lookup tables for _weighted_popcount.
+
+    :param weights: A list of the weight of each bit position.
+    :return: A list with a table for each byte of a mask, giving the total
+        weight of the set bits of every possible value of that byte.
+    """
+    tables = []
+    for start in range(0, len(weights), 8):
+        chunk = weights[start:start + 8]
+        table = [0] * (1 << len(chunk))
+        for value in range(1, len(table)):
+            bit = value & -value
+            table[value] = table[value ^ bit] + chunk[
+                _BYTE_BIT_POSITIONS[bit]]
+        tables.append(table)
+    return tables
+
+
+def _weighted_popcount(mask, tables):
+    """Return the total weight of the set bits in mask.
+
+    :param tables: Tables from _weighted_popcount_tables.
+    """
+    total = 0
+    for table in tables:
+        if not mask:
+            break
+        byte = mask & 255
+        if byte:
+            total += table[byte]
+        mask >>= 8
+    return total
+
+
+class _ResourceIndex(object):
+    """Interns resource managers as bits of integer resource sets.
+
+    A resource set is represented as an int with the bit for each manager in
+    the set turned on, so that set differences are bitwise operations and
+    hashing is cheap.
+
+    Tests normally share one resources list with the rest of their class,
+    so declarations are looked up by the identity of that list and each
+    distinct declaration is resolved only once.
+
+    :ivar managers: The interned managers, in bit order.
+    """
+
+    def __init__(self):
+        self.managers = []
+        self._bits = {}
+        self._declarations = {}
+
+    def bit(self, manager):
+        """Return the bit for manager, interning it if needed."""
+        bit = self._bits.get(manager)
+        if bit is None:
+            bit = 1 << len(self.managers)
+            self._bits[manager] = bit
+            self.managers.append(manager)
+        return bit
+
+    def mask(self, resource_set):
+        """Return the mask for an iterable of managers."""
+        mask = 0
+        for manager in resource_set:
+            mask |= self.bit(manager)
+        return mask
+
+    def declaration(self, resources):
+        """Return the resources needed by a tests resources declaration.
+
+        :param resources: A list of (name, manager) tuples, as found on
+            ResourcedTestCase.resources.
+        :return: A (mask, needed) tuple, where needed is the list of managers
+            returned by neededResources() for the declared managers.
+        """
+        entry = self._declarations.get(id(resources))
+        # The declaration itself is kept in the entry, so its id cannot be
+        # reused while it is cached. Lists can still be changed in place, so
+        # they are compared against a snapshot, and the needed managers are
+        # checked against the resources lists they were found from.
+        if (entry is not None and entry[0] is resources
+            and (entry[1] is None or entry[1] == resources)
+            and _closure_still_valid(entry[3][1], entry[2])):
+            return entry[3]
+        needed = neededResources([resource for _, resource in resources])
+        result = (self.mask(needed), needed)
+        stamp = _closure_stamp(needed)
+        if stamp is not None:
+            if isinstance(resources, tuple):
+                snapshot = None
+            else:
+                snapshot = list(resources)
+            self._declarations[id(resources)] = (
+                resources, snapshot, stamp, result)
+        return result
+
+    def resources(self, mask):
+        """Return the frozenset of managers in mask."""
+        return frozenset(self.managers[position]
+            for position in _bit_positions(mask))
+
+    def tables(self, weight):
+        """Return _weighted_popcount tables for a weight of each manager.
+
+        :param weight: A function returning the weight of a manager.
+        """
+        return _weighted_popcount_tables(
+            [weight(manager) for manager in self.managers])
+
+
+def _numpy_cost_matrix(masks, index, set_up_cost, tear_down_cost,
+    sharing_cost):
+    """Build the matrix of switching costs between masks using NumPy.
+
+    The masks are expanded into a resource incidence matrix, from which the
+    set up and tear down cost of every pair is found by matrix products.
+
+    :param masks: A list of masks from index.
+    :param index: A _ResourceIndex.
+    :param set_up_cost: A function returning the set up cost of a manager.
+    :param tear_down_cost: A function returning the tear down cost of a
+        manager.
+    :param sharing_cost: A function returning the cost of a manager being
+        kept from one mask to the next.
+    :return: A numpy.ndarray where result[i][j] is the cost of switching from
+        masks[i] to masks[j].
+    """
+    incidence = numpy.zeros((len(masks), len(index.managers)))
+    for row, mask in enumerate(masks):
+        for position in _bit_positions(mask):
+            incidence[row, position] = 1
+    set_up = incidence * numpy.array(
+        [set_up_cost(manager) for manager in index.managers], dtype=float)
+    tear_down = incidence * numpy.array(
+        [tear_down_cost(manager) for manager in index.managers], dtype=float)
+    sharing = incidence * numpy.array(
+        [sharing_cost(manager) for manager in index.managers], dtype=float)
+    # Switching from i to j sets up what j has that i lacks, tears down what
+    # i has that j lacks, and may have to reset what they share.
+    costs = (set_up.sum(axis=1)[numpy.newaxis, :] -
+        incidence.dot(set_up.T) +
+        tear_down.sum(axis=1)[:, numpy.newaxis] -
+        tear_down.dot(incidence.T) +
+        sharing.dot(incidence.T))
+    numpy.fill_diagonal(costs, 0)
+    return costs
+
+
+def _resource_graph(resource_sets, members=None):
     """Convert an iterable of resource_sets into a graph.
 
     Each resource_set in the iterable is treated as a node, and each resource
     in that resource_set is used as an edge to other nodes.
+
+    :param members: If supplied, a function returning the resources in a
+        resource set. The resource sets are then used as nodes as-is, which
+        allows masks from a _ResourceIndex to be used with _iter_bits.
     """
     nodes = {}
     edges = {}
-    for resource_set in resource_sets:
+    if members is None:
+        resource_sets = [frozenset(resource_set)
+            for resource_set in resource_sets]
+        members = iter
+    for node in resource_sets:
         # put node in nodes
-        node = frozenset(resource_set)
         nodes[node] = set()
         # put its contents in as edges
-        for resource in resource_set:
+        for resource in members(node):
             edges.setdefault(resource, []).append(node)
     # populate the adjacent members of nodes
     for node, connected in nodes.items():
-        for resource in node:
+        for resource in members(node):
             connected.update(edges[resource])
         connected.discard(node)
     return nodes
 
 
+def _split_by_resource_masks(tests, index):
+    """Split a list of tests by the resources that the tests use.
+
+    :param index: A _ResourceIndex to intern the resources with.
+    :return: a dictionary mapping resource masks to lists of tests
+    using that combination of resources.  The dictionary always
+    contains an entry for 0 - "no resources".
+    """
+    resource_set_tests = {0: []}
+    for test in tests:
+        mask = index.declaration(getattr(test, "resources", ()))[0]
+        resource_set_tests.setdefault(mask, []).append(test)
+    return resource_set_tests
+
+
 def split_by_resources(tests):
     """Split a list of tests by the resources that the tests use.
 
@@ -155,17 +834,9 @@ def split_by_resources(tests):
     using that combination of resources.  The dictionary always
     contains an entry for "no resources".
     """
-    no_resources = frozenset()
-    resource_set_tests = {no_resources: []}
-    for test in tests:
-        resources = getattr(test, "resources", ())
-        all_resources = list(resource.neededResources()
-                             for _, resource in resources)
-        resource_set = set()
-        for resource_list in all_resources:
-            resource_set.update(resource_list)
-        resource_set_tests.setdefault(frozenset(resource_set), []).append(test)
-    return resource_set_tests
+    index = _ResourceIndex()
+    return dict((index.resources(mask), mask_tests) for mask, mask_tests in
+        _split_by_resource_masks(tests, index).items())
 
 
 def _strongly_connected_components(graph, no_resources):
@@ -192,63 +863,560 @@ def _strongly_connected_components(graph, no_resources):
     return partitions
 
 
-class _OrderedSet(collections.MutableSet):
-    """This is taken from the OrderedSet recipe link in the Python 2 docs.
+def _partition_resource_sets(resource_sets, members=None):
+    """Partition resource sets into groups that share no resources.
+
+    This gives the same partitions as _strongly_connected_components of
+    _resource_graph, but uses a union-find over the resources themselves, so
+    it takes time linear in the total size of the resource sets rather than
+    building an edge between every pair of sets sharing a resource.
+
+    :param members: If supplied, a function returning the resources in a
+        resource set. The resource sets are then used as-is, which allows
+        masks from a _ResourceIndex to be used with _iter_bits.
+    :return: A list of sets of resource sets.
+    """
+    if members is None:
+        resource_sets = [frozenset(resource_set)
+            for resource_set in resource_sets]
+        members = iter
+    else:
+        resource_sets = list(resource_sets)
+    parent = {}
+    size = {}
+
+    def find(resource):
+        while parent[resource] != resource:
+            # Path halving keeps later finds short.
+            parent[resource] = parent[parent[resource]]
+            resource = parent[resource]
+        return resource
+
+    firsts = []
+    for resource_set in resource_sets:
+        first = None
+        for resource in members(resource_set):
+            if resource not in parent:
+                parent[resource] = resource
+                size[resource] = 1
+            if first is None:
+                first = find(resource)
+                continue
+            root = find(resource)
+            if root != first:
+                # Union by size.
+                if size[root] > size[first]:
+                    root, first = first, root
+                parent[root] = first
+                size[first] += size[root]
+        firsts.append(first)
+    partitions = {}
+    result = []
+    for resource_set, first in zip(resource_sets, firsts):
+        if first is None:
+            # No resources: a partition of its own.
+            result.append(set([resource_set]))
+            continue
+        root = find(first)
+        partition = partitions.get(root)
+        if partition is None:
+            partition = partitions[root] = set()
+            result.append(partition)
+        partition.add(resource_set)
+    return result
+
+
+def _make_thread_safe(resources):
+    """Lock resources, and those they need, before threads use them."""
+    for resource in resources:
+        for needed in resource.neededResources():
+            needed._makeThreadSafe()
+
+
+class _SerialisedResult(object):
+    """Serialise calls to a TestResult made from several threads."""
+
+    def __init__(self, result):
+        self._result = result
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._result, name)
+        if not callable(attribute):
+            return attribute
+        def serialised(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return serialised
+
+
+class _DeferredResult(object):
+    """Record calls to a TestResult, to be replayed on another thread."""
+
+    def __init__(self, result):
+        self._result = result
+        self._calls = collections.deque()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._result, name)
+        if not callable(attribute):
+            return attribute
+        def deferred(*args, **kwargs):
+            self._calls.append((attribute, args, kwargs))
+        return deferred
+
+    def replay(self):
+        """Make the recorded calls on the result, in order."""
+        while self._calls:
+            attribute, args, kwargs = self._calls.popleft()
+            attribute(*args, **kwargs)
+
+
+class _PlaceholderTest(object):
+    """Stands in for a test when reporting an outcome that has no test.
+
+    For instance a failed background teardown, or a test run by a worker
+    process that the parent process does not hold.
+    """
+
+    failureException = None
+
+    def __init__(self, description):
+        self.description = description
+
+    def id(self):
+        return self.description
+
+    def shortDescription(self):
+        return None
+
+    def countTestCases(self):
+        return 0
+
+    def __str__(self):
+        return self.description
+
+
+class _BackgroundTeardown(object):
+    """Finish with resources on a background thread.
+
+    A single thread is used, so resources are still torn down in the order
+    they are submitted, dependents before their dependencies. Calls to the
+    result are deferred until report is called on the thread running tests.
+    """
+
+    def __init__(self, result):
+        self._executor = futures.ThreadPoolExecutor(1)
+        self._result = _DeferredResult(result)
+        self._last = None
+
+    def submit(self, resources, kept=()):
+        """Finish with resources, in order, in the background.
+
+        Resources that need any of kept are finished with before returning
+        instead, as cleaning them may use resources the next tests are
+        using.
+
+        :param kept: The resources the next tests need.
+        """
+        if not resources:
+            return
+        _make_thread_safe(resources)
+        inline = []
+        background = []
+        for resource in resources:
+            if any(needed in kept for needed in resource.neededResources()):
+                inline.append(resource)
+            else:
+                background.append(resource)
+        if inline:
+            # Earlier teardowns may still be releasing the same dependencies.
+            if self._last is not None:
+                futures.wait([self._last])
+            self._finishWith(inline)
+        if background:
+            self._last = self._executor.submit(self._finishWith, background)
+
+    def _finishWith(self, resources):
+        for resource in resources:
+            try:
+                resource._release(self._result)
+            except Exception:
+                self._result.addError(
+                    _PlaceholderTest("tearDown (%r)" % (resource,)),
+                    sys.exc_info())
+
+    def report(self):
+        """Report what has happened in the background to the result."""
+        self._result.replay()
+
+    def wait(self):
+        """Wait for all teardowns to finish, and report them."""
+        self._executor.shutdown(wait=True)
+        self.report()
+
+
+class _Prefetcher(object):
+    """Get resources on background threads ahead of the tests needing them.
+
+    Each prefetched resource holds a use until release is called, once the
+    suite has switched to the resource itself. A resource is only made
+    while no more resources are being made than the prefetchConcurrency of
+    it, its dependencies and the others being made allows. Calls to the
+    result are deferred until report is called on the thread running tests.
+    """
+
+    def __init__(self, result, memory_limit=None, workers=1):
+        self._executor = futures.ThreadPoolExecutor(workers)
+        self._result = _DeferredResult(result)
+        self._memory_limit = memory_limit
+        self._pending = {}
+        # The prefetchConcurrency limits of the resources being made.
+        self._making = []
+        self._making_changed = threading.Condition()
+
+    def prefetch(self, resources, held):
+        """Start getting those of resources that can be got early.
+
+        :param resources: Resources in the order to set them up.
+        :param held: The resources in use by the running tests.
+        """
+        for resource in resources:
+            if resource in held or resource in self._pending:
+                continue
+            closure = resource.neededResources()
+            if not all(needed.prefetch and needed not in held
+                for needed in closure):
+                continue
+            if self._memory_limit is not None:
+                in_use = set(held)
+                in_use.update(self._pending)
+                in_use.update(closure)
+                if (sum(needed.memoryCost for needed in in_use) >
+                    self._memory_limit):
+                    continue
+            _make_thread_safe([resource])
+            limit = min(needed.prefetchConcurrency for needed in closure)
+            self._pending[resource] = self._executor.submit(
+                self._get, resource, limit)
+
+    def _get(self, resource, limit):
+        with self._making_changed:
+            while self._making and len(self._making) >= min(
+                limit, min(self._making)):
+                self._making_changed.wait()
+            self._making.append(limit)
+        try:
+            return resource._hold(self._result)
+        finally:
+            with self._making_changed:
+                self._making.remove(limit)
+                self._making_changed.notify_all()
+
+    def claim(self, resources):
+        """Wait for any prefetches of resources to finish."""
+        for resource in resources:
+            future = self._pending.get(resource)
+            if future is not None:
+                future.result()
+
+    def release(self, resources):
+        """Drop the uses held by prefetches of resources."""
+        for resource in resources:
+            future = self._pending.pop(resource, None)
+            if future is not None and future.exception() is None:
+                resource._release(self._result)
+
+    def report(self):
+        """Report what has happened in the background to the result."""
+        self._result.replay()
 
-    See:
+    def close(self):
+        """Wait for outstanding prefetches and release them."""
+        self._executor.shutdown(wait=True)
+        self.release(list(self._pending))
+        self.report()
 
-    - https://docs.python.org/2/library/collections.html
-    - https://code.activestate.com/recipes/576694/
 
+class _RemoteError(Exception):
+    """An error from a worker process, holding its formatted traceback."""
+
+
+class _RemoteFailure(AssertionError):
+    """A failure from a worker process, holding its formatted traceback."""
+
+
+def _remote_exc_info(exception_class, text):
+    """Make an exc_info tuple to report text from a worker process with."""
+    return (exception_class, exception_class(text), None)
+
+
+class _ForwardingResult(unittest.TestResult):
+    """Send what happens in a worker process to the parent process.
+
+    Events are put on a queue as tuples of the result method name and its
+    arguments. Tests and resources are sent as their positions in the lists
+    the parent process holds, and tests it does not hold as their ids.
+    Errors are sent as formatted tracebacks, as tracebacks cannot be pickled.
+    shouldStop is shared with the parent and the other workers through an
+    Event, so that a stop anywhere stops every worker.
     """
 
+    def __init__(self, events, test_positions, manager_positions, stop):
+        self._stop = stop
+        unittest.TestResult.__init__(self)
+        self._events = events
+        self._test_positions = test_positions
+        self._manager_positions = manager_positions
+
+    def _getShouldStop(self):
+        return self._stop.is_set()
+
+    def _setShouldStop(self, value):
+        if value:
+            self._stop.set()
+
+    shouldStop = property(_getShouldStop, _setShouldStop)
+
+    def _send(self, name, test, *args):
+        position = self._test_positions.get(id(test))
+        if position is None:
+            position = test.id()
+        self._events.put((name, position) + args)
+
+    def _sendResource(self, name, resource):
+        position = self._manager_positions.get(id(resource))
+        if position is not None:
+            self._events.put((name, position))
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self._send('startTest', test)
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self._send('stopTest', test)
+
+    def addError(self, test, err):
+        self._send('addError', test, self._exc_info_to_string(err, test))
+
+    def addFailure(self, test, err):
+        self._send('addFailure', test, self._exc_info_to_string(err, test))
+
+    def addSuccess(self, test):
+        self._send('addSuccess', test)
+
+    def addSkip(self, test, reason):
+        self._send('addSkip', test, reason)
+
+    def addExpectedFailure(self, test, err):
+        self._send('addExpectedFailure', test,
+            self._exc_info_to_string(err, test))
+
+    def addUnexpectedSuccess(self, test):
+        self._send('addUnexpectedSuccess', test)
+
+    def addSubTest(self, test, subtest, err):
+        if err is None:
+            self._send('addSubTest', test, subtest.id(), False, None)
+        else:
+            self._send('addSubTest', test, subtest.id(),
+                issubclass(err[0], test.failureException),
+                self._exc_info_to_string(err, test))
+
+    def addDuration(self, test, elapsed):
+        self._send('addDuration', test, elapsed)
+
+    def startCleanResource(self, resource):
+        self._sendResource('startCleanResource', resource)
+
+    def stopCleanResource(self, resource):
+        self._sendResource('stopCleanResource', resource)
+
+    def startMakeResource(self, resource):
+        self._sendResource('startMakeResource', resource)
+
+    def stopMakeResource(self, resource):
+        self._sendResource('stopMakeResource', resource)
+
+    def startResetResource(self, resource):
+        self._sendResource('startResetResource', resource)
+
+    def stopResetResource(self, resource):
+        self._sendResource('stopResetResource', resource)
+
+
+_RESOURCE_EVENTS = frozenset([
+    'startCleanResource', 'stopCleanResource', 'startMakeResource',
+    'stopMakeResource', 'startResetResource', 'stopResetResource'])
+
+
+def _fork_context():
+    """Return a multiprocessing context that forks, or None without fork."""
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        # Python 2 always forks, except on Windows where it cannot.
+        if sys.platform == 'win32':
+            return None
+        return multiprocessing
+    try:
+        return get_context('fork')
+    except ValueError:
+        return None
+
+
+class _OrderedSet(MutableSet):
+    """A set that remembers the order members were added in.
+
+    Members are kept in a list, with a set alongside it for membership tests,
+    so iterating in either direction and taking differences are single passes
+    over a list.
+    """
+
+    __slots__ = ('_items', '_members')
+
     def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]         # sentinel node for doubly linked list
-        self.map = {}                   # key --> [key, prev, next]
+        self._items = []
+        self._members = set()
         if iterable is not None:
-            self |= iterable
+            self.update(iterable)
+
+    @classmethod
+    def _from_unique(cls, items):
+        """Make an _OrderedSet from a list that has no duplicates."""
+        result = cls()
+        result._items = items
+        result._members = set(items)
+        return result
 
     def __len__(self):
-        return len(self.map)
+        return len(self._items)
 
     def __contains__(self, key):
-        return key in self.map
+        return key in self._members
 
     def add(self, key):
-        if key not in self.map:
-            end = self.end
-            curr = end[1]
-            curr[2] = end[1] = self.map[key] = [key, curr, end]
+        if key not in self._members:
+            self._members.add(key)
+            self._items.append(key)
 
     def discard(self, key):
-        if key in self.map:
-            key, prev, next = self.map.pop(key)
-            prev[2] = next
-            next[1] = prev
+        if key in self._members:
+            self._members.remove(key)
+            self._items.remove(key)
 
     def update(self, iterable):
-        self |= iterable
+        members = self._members
+        items = self._items
+        for key in iterable:
+            if key not in members:
+                members.add(key)
+                items.append(key)
 
     def __iter__(self):
-        end = self.end
-        curr = end[2]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[2]
+        return iter(self._items)
 
     def __reversed__(self):
-        end = self.end
-        curr = end[1]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[1]
+        return reversed(self._items)
+
+    def difference(self, other):
+        """Return the members not in other, in order, as an _OrderedSet."""
+        if not isinstance(other, (_OrderedSet, set, frozenset, dict)):
+            other = set(other)
+        return self._from_unique(
+            [key for key in self._items if key not in other])
+
+    def reversed_difference(self, other):
+        """Return a list of the members not in other, in reverse order."""
+        if not isinstance(other, (_OrderedSet, set, frozenset, dict)):
+            other = set(other)
+        return [key for key in reversed(self._items) if key not in other]
+
+    def __sub__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.difference(other)
 
 
 class OptimisingTestSuite(unittest.TestSuite):
-    """A resource creation optimising TestSuite."""
+    """A resource creation optimising TestSuite.
+
+    :cvar ordering: How sortTests orders the resource sets within a
+        partition. 'mst' (the default) walks a minimum spanning tree, which
+        is at worst twice the optimal switching cost. 'christofides' uses
+        Christofides algorithm, which is at worst 1.5 times the optimal cost
+        when its matching step is exact and resources are not costed for
+        being shared between resource sets.
+    :cvar christofides_matching_limit: The largest number of odd degree
+        nodes that the 'christofides' ordering will match exactly. Exact
+        matching is exponential in this number, so larger partitions are
+        matched greedily, which is fast but loses the 1.5 times bound.
+    :cvar refine_moves: The most 2-opt and Or-opt local search moves to make
+        when improving each partition's order after it has been made. 0 (the
+        default) disables refinement. Searching stops early when no move
+        improves the order.
+    :cvar refine_time_budget: If not None, the number of seconds that
+        refining each partition's order may take.
+    :cvar exact_ordering_limit: Partitions with this many resource sets or
+        fewer are ordered exactly using the Held-Karp algorithm instead of
+        with the approximate ordering. Its cost doubles with every extra
+        resource set, so keep this small.
+    :cvar use_numpy: If NumPy is installed, use it to build the matrix of
+        switching costs and the minimum spanning trees used for ordering.
+        This is much faster for large suites. It is not used when
+        cost_of_switching has been overridden.
+    :cvar use_measured_costs: Cost switching with the measuredSetUpCost and
+        measuredTearDownCost of resources instead of their setUpCost and
+        tearDownCost, where they have been measured. Costs recorded in the
+        costStore of resources by earlier runs are loaded by sortTests.
+    :cvar setup_workers: If set, switch gets new resources on this many
+        threads, making resources that do not depend on each other at the
+        same time. This needs concurrent.futures, and is worthwhile when
+        making resources mostly waits on I/O.
+    :cvar background_teardown: If True, run tears down the resources that
+        the next tests do not need on a background thread, while those tests
+        run. Resources depending on ones the next tests use are still torn
+        down before those tests start. run waits for the teardowns to finish
+        before returning, and reports any that fail as errors rather than
+        stopping. This needs concurrent.futures.
+    :cvar prefetch_lookahead: How many groups of tests ahead run makes
+        resources in the background while the current tests run. Only
+        resources whose manager allows prefetch, and that share no resources
+        with those in use, are made early, as many at once as their
+        prefetchConcurrency allows. 0 (the default) disables this. This
+        needs concurrent.futures.
+    :cvar prefetch_memory_limit: If not None, resources are not prefetched
+        when the memoryCost of the resources held and prefetched would
+        exceed this.
+    :cvar test_workers: If set, run runs tests on this many threads at once
+        while every resource they use is concurrencySafe. Tests are run one
+        at a time again once a resource is dirtied, and tests expected to
+        dirty resources always are. Each test reports to the result when it
+        finishes. This needs concurrent.futures.
+    :ivar partition_solvers: A list of (solver, order) pairs describing how
+        each partition was ordered by the last sortTests. solver is one of
+        'exact', 'christofides' or 'mst'.
+    """
 
     known_suite_classes = None
+    ordering = 'mst'
+    christofides_matching_limit = 14
+    refine_moves = 0
+    refine_time_budget = None
+    exact_ordering_limit = 12
+    use_numpy = True
+    use_measured_costs = False
+    setup_workers = None
+    background_teardown = False
+    prefetch_lookahead = 0
+    prefetch_memory_limit = None
+    test_workers = None
+
+    def __init__(self, tests=()):
+        self.partition_solvers = []
+        self._resourceIndex = None
+        self._teardown = None
+        unittest.TestSuite.__init__(self, tests)
 
     def adsorbSuite(self, test_case_or_suite):
         """Deprecated. Use addTest instead."""
@@ -279,17 +1447,48 @@ class OptimisingTestSuite(unittest.TestSuite):
         """Cost of switching from 'old_resource_set' to 'new_resource_set'.
 
         This is calculated by adding the cost of tearing down unnecessary
-        resources to the cost of setting up the newly-needed resources.
+        resources to the cost of setting up the newly-needed resources. Each
+        resource kept adds its reset cost, weighted by the chance that it
+        will be dirty, so that resources which are always dirtied are not
+        considered free to share.
 
-        Note that resources which are always dirtied may skew the predicted
-        skew the cost of switching because they are considered common, even
-        when reusing them may actually be equivalent to a teardown+setup
-        operation.
+        If use_measured_costs is set, the costs measured by each resource are
+        used in place of setUpCost and tearDownCost once they are known.
         """
         new_resources = new_resource_set - old_resource_set
         gone_resources = old_resource_set - new_resource_set
-        return (sum(resource.setUpCost for resource in new_resources) +
-            sum(resource.tearDownCost for resource in gone_resources))
+        kept_resources = old_resource_set & new_resource_set
+        return (sum(self._setUpCost(resource) for resource in new_resources) +
+            sum(self._tearDownCost(resource) for resource in gone_resources) +
+            sum(self._sharingCost(resource) for resource in kept_resources))
+
+    def _setUpCost(self, resource):
+        """Return the cost of setting up resource."""
+        if self.use_measured_costs and resource.measuredSetUpCost is not None:
+            return resource.measuredSetUpCost
+        return resource.setUpCost
+
+    def _tearDownCost(self, resource):
+        """Return the cost of tearing down resource."""
+        if (self.use_measured_costs and
+            resource.measuredTearDownCost is not None):
+            return resource.measuredTearDownCost
+        return resource.tearDownCost
+
+    def _resetCost(self, resource):
+        """Return the cost of resetting resource when it is dirty."""
+        if self.use_measured_costs and resource.measuredResetCost is not None:
+            return resource.measuredResetCost
+        if resource.resetCost is not None:
+            return resource.resetCost
+        return self._setUpCost(resource) + self._tearDownCost(resource)
+
+    def _sharingCost(self, resource):
+        """Return the expected cost of resource being kept between tests."""
+        probability = resource.dirtyProbability()
+        if not probability:
+            return 0
+        return probability * self._resetCost(resource)
 
     def switch(self, old_resource_set, new_resource_set, result):
         """Switch from 'old_resource_set' to 'new_resource_set'.
@@ -303,31 +1502,231 @@ class OptimisingTestSuite(unittest.TestSuite):
         # Ensure that we're being passed ordered sets, since the contract
         # for this method didn't always require so and we don't want to
         # break exsisting consumers (like our own unit tests).
-        old_resource_set = _OrderedSet(old_resource_set)
-        new_resource_set = _OrderedSet(new_resource_set)
+        if not isinstance(old_resource_set, _OrderedSet):
+            old_resource_set = _OrderedSet(old_resource_set)
+        if not isinstance(new_resource_set, _OrderedSet):
+            new_resource_set = _OrderedSet(new_resource_set)
+
+        old_resources = old_resource_set.reversed_difference(new_resource_set)
+        if self._teardown is not None:
+            self._teardown.submit(old_resources, new_resource_set)
+        elif _async is not None and _async.has_async(old_resources):
+            _async.finish_resources(old_resources, result)
+        else:
+            for resource in old_resources:
+                resource._release(result)
+        new_resources = new_resource_set.difference(old_resource_set)
+        if _async is not None and _async.has_async(new_resources):
+            _async.get_resources(new_resources, result)
+        elif (self.setup_workers and futures is not None and
+            len(new_resources) > 1):
+            self._getResourcesConcurrently(new_resources, result)
+        else:
+            for resource in new_resources:
+                resource._hold(result)
 
-        new_resources = new_resource_set - old_resource_set
-        old_resources = old_resource_set - new_resource_set
-        for resource in reversed(old_resources):
-            resource.finishedWith(resource._currentResource, result)
-        for resource in new_resources:
-            resource.getResource(result)
+    def _getResourcesConcurrently(self, resources, result):
+        """Get resources on a pool of setup_workers threads.
+
+        Each resource is only got once the resources it depends on have
+        been, so independent resources are made at the same time. Calls to
+        result are serialised.
+
+        :param resources: An _OrderedSet of the resources to get, which must
+            include all the dependencies of them that are not already held.
+        """
+        _make_thread_safe(resources)
+        if result is not None:
+            result = _SerialisedResult(result)
+        waiting = {}
+        dependents = {}
+        ready = []
+        for resource in resources:
+            for _, dependency in resource.resources:
+                if dependency in resources:
+                    waiting[resource] = waiting.get(resource, 0) + 1
+                    dependents.setdefault(dependency, []).append(resource)
+            if resource not in waiting:
+                ready.append(resource)
+        failed = None
+        with futures.ThreadPoolExecutor(self.setup_workers) as executor:
+            running = dict(
+                (executor.submit(resource._hold, result), resource)
+                for resource in ready)
+            while running:
+                done, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    resource = running.pop(future)
+                    if future.exception() is not None:
+                        # Let what is already running finish, but start
+                        # nothing more.
+                        failed = failed or future
+                        continue
+                    if failed is not None:
+                        continue
+                    for dependent in dependents.get(resource, ()):
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            running[executor.submit(
+                                dependent._hold, result)] = dependent
+        if failed is not None:
+            failed.result()
 
     def run(self, result):
         self.sortTests()
+        return self._runSorted(result)
+
+    def _runSorted(self, result):
+        """Run the tests in their current order."""
+        with activeResult(result):
+            try:
+                if not self.background_teardown or futures is None:
+                    return self._runTests(result)
+                self._teardown = _BackgroundTeardown(result)
+                try:
+                    return self._runTests(result)
+                finally:
+                    teardown, self._teardown = self._teardown, None
+                    teardown.wait()
+            finally:
+                # Write the costs measured by the run in one go.
+                _flush_cost_stores()
+
+    def _runTests(self, result):
+        """Run the sorted tests, switching resources between groups."""
+        groups = self._groupTests()
+        prefetcher = None
+        if self.prefetch_lookahead and futures is not None:
+            # Only start as many threads as the managers could use at once.
+            workers = max([1] + [resource.prefetchConcurrency
+                for needed, _ in groups for resource in needed
+                if resource.prefetch])
+            prefetcher = _Prefetcher(
+                result, self.prefetch_memory_limit, workers)
         current_resources = _OrderedSet()
-        for test in self._tests:
+        try:
+            for position, (needed, tests) in enumerate(groups):
+                if result.shouldStop:
+                    break
+                new_resources = _OrderedSet._from_unique(list(needed))
+                if prefetcher is not None:
+                    prefetcher.claim(new_resources)
+                self.switch(current_resources, new_resources, result)
+                current_resources = new_resources
+                if prefetcher is not None:
+                    prefetcher.release(current_resources)
+                    prefetcher.report()
+                    for upcoming, _ in groups[position + 1:
+                        position + 1 + self.prefetch_lookahead]:
+                        prefetcher.prefetch(upcoming, current_resources)
+                if self._teardown is not None:
+                    self._teardown.report()
+                self._runGroup(tests, current_resources, result)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        self.switch(current_resources, set(), result)
+        return result
+
+    def _runGroup(self, tests, resources, result):
+        """Run tests that need resources, which are already held."""
+        started = 0
+        # Tests using no resources have not declared that they are safe.
+        if (self.test_workers and futures is not None and len(tests) > 1
+            and resources and
+            all(resource.concurrencySafe for resource in resources)):
+            started = self._runConcurrently(tests, resources, result)
+        for test in tests[started:]:
             if result.shouldStop:
                 break
-            resources = getattr(test, 'resources', [])
-            new_resources = _OrderedSet()
-            for name, resource in resources:
-                new_resources.update(resource.neededResources())
-            self.switch(current_resources, new_resources, result)
-            current_resources = new_resources
+            dirtied_counts = self._dirtiedCounts(resources)
             test(result)
-        self.switch(current_resources, set(), result)
-        return result
+            self._noteDirtied(test, dirtied_counts)
+
+    def _runConcurrently(self, tests, resources, result):
+        """Run tests on test_workers threads until one may dirty resources.
+
+        Tests report to the result once they finish, so that the calls for
+        different tests are not interleaved. No more tests are started once
+        a resource is dirtied, or at a test expected to dirty one.
+
+        :return: The number of tests started.
+        """
+        index = self._resourceIndex or _ResourceIndex()
+        _make_thread_safe(resources)
+        # A test getting a dirtied resource resets it, so count those resets
+        # as well as looking for dirty resources.
+        resets = [resource._dirtyReuses for resource in resources]
+        started = 0
+        running = {}
+        with futures.ThreadPoolExecutor(self.test_workers) as executor:
+            while True:
+                dirty = any(resource._dirty or resource._dirtyReuses != reset
+                    for resource, reset in zip(resources, resets))
+                while (not dirty and not result.shouldStop and
+                    started < len(tests) and
+                    len(running) < self.test_workers and
+                    not self._dirtiedMask(tests[started], index)):
+                    test = tests[started]
+                    deferred = _DeferredResult(result)
+                    running[executor.submit(
+                        self._runWithResult, test, deferred)] = (
+                        test, deferred, self._dirtiedCounts(resources))
+                    started += 1
+                if not running:
+                    break
+                done, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    test, deferred, dirtied_counts = running.pop(future)
+                    deferred.replay()
+                    future.result()
+                    # This may blame a test that ran alongside the dirtier.
+                    self._noteDirtied(test, dirtied_counts)
+        return started
+
+    def _runWithResult(self, test, result):
+        """Run test on a worker thread, publishing result there."""
+        with activeResult(result):
+            test(result)
+
+    def _dirtiedCounts(self, resources):
+        """Return how many times each of resources has been dirtied."""
+        return dict((resource, resource._dirtiedCount)
+            for resource in resources)
+
+    def _noteDirtied(self, test, dirtied_counts):
+        """Remember which resources test dirtied, for sortTests.
+
+        Only calls to dirtied count, as some managers, such as
+        FixtureResource, are always dirty whatever their tests do.
+
+        :param dirtied_counts: The _dirtiedCounts of the resources test used,
+            from before it ran.
+        """
+        for resource, count in dirtied_counts.items():
+            if resource._dirtiedCount != count:
+                resource._dirtiedBy.add(test.id())
+
+    def _groupTests(self):
+        """Group consecutive tests that need the same resources.
+
+        :return: A list of (needed, tests) tuples, where needed is the list
+            of resources the tests need in the order to set them up.
+        """
+        # sortTests has usually resolved every declaration already.
+        index = self._resourceIndex or _ResourceIndex()
+        groups = []
+        current_mask = None
+        for test in self._tests:
+            mask, needed = index.declaration(getattr(test, 'resources', ()))
+            if mask != current_mask:
+                current_mask = mask
+                group = []
+                groups.append((needed, group))
+            group.append(test)
+        return groups
 
     def sortTests(self):
         """Attempt to topographically sort the contained tests.
@@ -343,7 +1742,13 @@ class OptimisingTestSuite(unittest.TestSuite):
         # actual tests and there can never be more: This gives us 'nodes' or
         # 'resource_sets' that represent many tests using the same set of
         # resources.
-        resource_set_tests = split_by_resources(self._tests)
+        self.partition_solvers = []
+        # Resource sets are handled as integer masks from here on.
+        index = self._resourceIndex = _ResourceIndex()
+        resource_set_tests = _split_by_resource_masks(self._tests, index)
+        if self.use_measured_costs:
+            for manager in index.managers:
+                manager._loadMeasuredCosts()
         # Partition into separate sets of resources, there is no ordering
         # preference between sets that do not share members. Rationale:
         # If resource_set A and B have no common resources, AB and BA are
@@ -352,34 +1757,116 @@ class OptimisingTestSuite(unittest.TestSuite):
         # better than having B between A and C, because the shared resources
         # can be reset or reused. Having partitioned we can use connected graph
         # logic on each partition.
-        resource_set_graph = _resource_graph(resource_set_tests)
-        no_resources = frozenset()
+        no_resources = 0
         # A list of resource_set_tests, all fully internally connected.
-        partitions = _strongly_connected_components(resource_set_graph,
-            no_resources)
+        partitions = _partition_resource_sets(resource_set_tests, _iter_bits)
         result = []
         for partition in partitions:
             # we process these at the end for no particularly good reason (it
             # makes testing slightly easier).
-            if partition == [no_resources]:
+            if partition == set([no_resources]):
                 continue
-            order = self._makeOrder(partition)
+            order = self._makeOrder(partition, index)
             # Spit this partition out into result
             for resource_set in order:
-                result.extend(resource_set_tests[resource_set])
+                result.extend(
+                    self._dirtiersLast(resource_set_tests[resource_set], index))
         result.extend(resource_set_tests[no_resources])
         self._tests = result
 
-    def _getGraph(self, resource_sets):
+    def _dirtiersLast(self, tests, index):
+        """Order tests that use the same resources so dirtiers run last.
+
+        A test dirtying a resource makes the next test reset it, so running
+        the tests that dirty nothing first saves a reset for each of them.
+        Tests that dirty the same resources are kept together.
+
+        :param tests: Tests that all need the same resources.
+        :param index: The _ResourceIndex used by sortTests.
+        """
+        clean = []
+        dirtier_masks = []
+        dirtiers = {}
+        for test in tests:
+            mask = self._dirtiedMask(test, index)
+            if not mask:
+                clean.append(test)
+                continue
+            if mask not in dirtiers:
+                dirtier_masks.append(mask)
+                dirtiers[mask] = []
+            dirtiers[mask].append(test)
+        for mask in dirtier_masks:
+            clean.extend(dirtiers[mask])
+        return clean
+
+    def _dirtiedMask(self, test, index):
+        """Return the mask of resources that test is expected to dirty.
+
+        These are the resources named by the dirties attribute of the test,
+        and those that were left dirty by the test when it was last run.
+        """
+        resources = getattr(test, 'resources', ())
+        dirties = getattr(test, 'dirties', ())
+        needed = index.declaration(resources)[1]
+        dirtied_by = [manager for manager in needed if manager._dirtiedBy]
+        if not dirties and not dirtied_by:
+            return 0
+        mask = 0
+        for name, manager in resources:
+            if name in dirties:
+                mask |= index.bit(manager)
+        if dirtied_by:
+            test_id = test.id()
+            for manager in dirtied_by:
+                if test_id in manager._dirtiedBy:
+                    mask |= index.bit(manager)
+        return mask
+
+    def _switchingCostFunction(self, index):
+        """Return a function giving the cost of switching between masks.
+
+        When cost_of_switching has not been overridden this is computed
+        directly from the masks, otherwise cost_of_switching is called.
+
+        :param index: The _ResourceIndex the masks are from.
+        """
+        method = getattr(self.cost_of_switching, '__func__', None)
+        if method is not OptimisingTestSuite.__dict__['cost_of_switching']:
+            def cost(old_mask, new_mask):
+                return self.cost_of_switching(
+                    index.resources(old_mask), index.resources(new_mask))
+            return cost
+        set_up_tables = index.tables(self._setUpCost)
+        tear_down_tables = index.tables(self._tearDownCost)
+        sharing_tables = index.tables(self._sharingCost)
+        def cost(old_mask, new_mask):
+            return (_weighted_popcount(new_mask & ~old_mask, set_up_tables) +
+                _weighted_popcount(old_mask & ~new_mask, tear_down_tables) +
+                _weighted_popcount(old_mask & new_mask, sharing_tables))
+        return cost
+
+    def _getGraph(self, resource_sets, index=None):
         """Build a graph of the resource-using nodes.
 
         This special cases set(['root']) to be a node with no resources and
         edges to everything.
 
+        :param index: If supplied, resource_sets are masks from this
+            _ResourceIndex, and 0 - no resources - is the root.
         :return: A complete directed graph of the switching costs
             between each resource combination. Note that links from N to N are
             not included.
         """
+        if index is not None:
+            cost = self._switchingCostFunction(index)
+            graph = {}
+            for from_mask in resource_sets:
+                graph[from_mask] = dict((to_mask, cost(from_mask, to_mask))
+                    for to_mask in resource_sets
+                    # no self-edges, no links to root
+                    if to_mask != from_mask and to_mask)
+            return graph
         no_resources = frozenset()
         graph = {}
         root = set(['root'])
@@ -408,74 +1895,157 @@ class OptimisingTestSuite(unittest.TestSuite):
                         from_resources, to_resources)
         return graph
 
-    def _makeOrder(self, partition):
-        """Return a order for the resource sets in partition."""
+    def _makeOrder(self, partition, index=None):
+        """Return a order for the resource sets in partition.
+
+        :param index: If supplied, partition is a set of masks from this
+            _ResourceIndex, and a list of masks is returned.
+        """
+        if index is None:
+            index = _ResourceIndex()
+            resource_sets = dict((index.mask(resource_set), resource_set)
+                for resource_set in partition)
+            return [resource_sets[mask] for mask in
+                self._makeOrder(set(resource_sets), index)]
         # This problem is NP-C - find the lowest cost hamiltonian path. It
-        # also meets the triangle inequality, so we can use an approximation.
-        # TODO: implement Christofides.
+        # also meets the triangle inequality, so we can use an approximation,
+        # unless the reset costs of dirtied resources are counted.
         # See:
         #   http://en.wikipedia.org/wiki/Travelling_salesman_problem#Metric_TSP
 
-        # We need a root
-        root = frozenset(['root'])
-        partition.add(root)
-        # and an end
-        # partition.add(frozenset(['bottom']))
-        # get rid of 'noresources'
-        partition.discard(frozenset())
-        digraph = self._getGraph(partition)
-        # build a prime map
-        primes = {}
-        prime = frozenset(['prime'])
-        for node in digraph:
-            primes[node] = node.union(prime)
-        graph = _digraph_to_graph(digraph, primes)
-        mst = _kruskals_graph_MST(graph)
-        # Because the representation is a digraph, we can build an Eulerian
-        # cycle directly from the representation by just following the links:
-        # a node with only 1 'edge' has two directed edges; and we can only
-        # enter and leave it once, so the edge lookups will match precisely.
-        # As the mst is a spanning tree, the graph will become disconnected
-        # (we choose non-disconnecting edges first)
-        #  - for a stub node (1 outgoing link): when exiting it unless it is
-        #    the first node started at
-        # - for a non-stub node if choosing an outgoing link where some other
-        #   endpoints incoming link has not been traversed. [exit by a
-        #   different node than entering, until all exits taken].
-        # We don't need the mst after, so it gets modified in place.
-        node = root
-        cycle = [node]
-        steps = 2 * (len(mst) - 1)
-        for step in range(steps):
-            found = False
-            outgoing = None  # For clearer debugging.
-            for outgoing in mst[node]:
-                if node in mst[outgoing]:
-                    # we have a return path: take it
-                    # print node, '->', outgoing, ' can return'
-                    del mst[node][outgoing]
-                    node = outgoing
-                    cycle.append(node)
-                    found = True
-                    break
-            if not found:
-                # none of the outgoing links have an incoming, so follow an
-                # arbitrary one (the last examined outgoing)
-                # print node, '->', outgoing
-                del mst[node][outgoing]
-                node = outgoing
-                cycle.append(node)
-        # Convert to a path:
-        visited = set()
-        order = []
-        for node in cycle:
-            if node in visited:
-                continue
-            if node in primes:
-                order.append(node)
-            visited.add(node)
-        assert order[0] == root
-        return order[1:]
+        # We need a root: no resources at all, which is where the run both
+        # starts and finishes.
+        root = 0
+        nodes = [root] + sorted(partition - set([root]))
+        # The solvers all work with positions in nodes, so that they can use
+        # a dense cost matrix.
+        costs = self._costMatrix(nodes, index)
+        if numpy is not None and isinstance(costs, numpy.ndarray):
+            # Held-Karp and refinement index single elements, which is much
+            # faster on lists, but the rows are only built when used.
+            cost_rows = lambda: costs.tolist()
+        else:
+            cost_rows = lambda: costs
+        if len(nodes) - 1 <= self.exact_ordering_limit:
+            solver = 'exact'
+            positions = _held_karp_order(cost_rows())
+        else:
+            if self.ordering == 'christofides':
+                solver = 'christofides'
+                positions = self._christofidesOrder(costs)
+            else:
+                solver = 'mst'
+                positions = self._walkOrder(costs)
+            if self.refine_moves:
+                deadline = None
+                if self.refine_time_budget is not None:
+                    deadline = time.time() + self.refine_time_budget
+                positions = _refine_order(cost_rows(), positions,
+                    self.refine_moves, deadline)
+        order = [nodes[pos] for pos in positions[1:]]
+        self.partition_solvers.append(
+            (solver, [index.resources(mask) for mask in order]))
+        return order
+
+    def _costMatrix(self, masks, index):
+        """Build the matrix of switching costs between masks.
+
+        When NumPy is available and use_numpy is set the whole matrix is
+        computed with a few matrix products, otherwise with
+        _switchingCostFunction.
+
+        :param masks: A list of masks from index.
+        :return: A matrix where result[i][j] is the cost of switching from
+            masks[i] to masks[j]: a numpy.ndarray or a list of lists.
+        """
+        method = getattr(self.cost_of_switching, '__func__', None)
+        if (numpy is not None and self.use_numpy and
+            method is OptimisingTestSuite.__dict__['cost_of_switching']):
+            return _numpy_cost_matrix(masks, index, self._setUpCost,
+                self._tearDownCost, self._sharingCost)
+        return _cost_matrix(masks, self._switchingCostFunction(index))
+
+    def _christofidesOrder(self, costs):
+        """Order a cost matrix using Christofides algorithm.
+
+        The run starts and finishes with no resources, so the ordering is
+        really a cycle through root. The cost of such a cycle is the same in
+        either direction - every resource is set up and torn down once per
+        run of consecutive resource sets that use it - so the symmetric graph
+        with each edge weighted by the costs of travelling it both ways has
+        the same optimal tours. It meets the triangle inequality unless
+        resources that may be dirtied are costed for being reset when kept,
+        in which case the tour may be worse than 1.5 times the optimal.
+
+        :param costs: A matrix from _costMatrix, with the root first.
+        :return: A list of positions in costs starting with the root.
+        """
+        size = len(costs)
+        if numpy is not None and isinstance(costs, numpy.ndarray):
+            graph = costs + costs.T
+            numpy.fill_diagonal(graph, numpy.inf)
+            mst = _numpy_prim_MST(size, graph.__getitem__)
+        else:
+            graph = [[costs[from_node][to_node] + costs[to_node][from_node]
+                for to_node in range(size)] for from_node in range(size)]
+            mst = _prim_MST(size, graph.__getitem__)
+        tour = _christofides_tour(
+            graph, 0, self.christofides_matching_limit, mst)
+        if len(tour) < 3:
+            return tour
+        # Pick the cheaper direction, in case cost_of_switching has been
+        # overridden with something asymmetric.
+        reverse_tour = tour[:1] + tour[:0:-1]
+        cost = lambda from_node, to_node: costs[from_node][to_node]
+        if _tour_cost(reverse_tour, cost) < _tour_cost(tour, cost):
+            tour = reverse_tour
+        return tour
+
+    def _walkOrder(self, costs):
+        """Order a cost matrix by walking a minimum spanning tree.
+
+        :param costs: A matrix from _costMatrix, with the root first.
+        :return: A list of positions in costs starting with the root.
+        """
+        # The digraph is converted to a graph by pairing every node N with a
+        # prime node N' (numbered N + size), see _digraph_to_graph. There are
+        # no links back to the root.
+        size = len(costs)
+        primes = dict((node, node + size) for node in range(size))
+        # Node N links to every M' at the cost of M to N, and N' to every M at
+        # the cost of N to M; the rows are built as needed as the whole graph
+        # is four times the size of costs.
+        if numpy is not None and isinstance(costs, numpy.ndarray):
+            nowhere = numpy.full(size, numpy.inf)
+            def row(node):
+                if node < size:
+                    links = costs[:, node].copy()
+                    if node == 0:
+                        links[:] = numpy.inf
+                    links[node] = 0
+                    return numpy.concatenate((nowhere, links))
+                links = costs[node - size].copy()
+                links[0] = numpy.inf
+                links[node - size] = 0
+                return numpy.concatenate((links, nowhere))
+            mst = _numpy_prim_MST(2 * size, row)
+        else:
+            inf = float('inf')
+            nowhere = [inf] * size
+            def row(node):
+                if node < size:
+                    if node == 0:
+                        links = list(nowhere)
+                    else:
+                        links = [from_costs[node] for from_costs in costs]
+                    links[node] = 0
+                    return nowhere + links
+                links = list(costs[node - size])
+                links[0] = inf
+                links[node - size] = 0
+                return links + nowhere
+            mst = _prim_MST(2 * size, row)
+        return _walk_MST(mst, 0, primes)
 
 
 OptimisingTestSuite.known_suite_classes = (
@@ -484,6 +2054,482 @@ if unittest2 is not None:
     OptimisingTestSuite.known_suite_classes += (unittest2.TestSuite,)
 
 
+class ParallelOptimisingTestSuite(OptimisingTestSuite):
+    """An OptimisingTestSuite that runs independent tests in parallel.
+
+    The tests are partitioned so that no two partitions share a resource,
+    and the partitions are run by a pool of worker processes, largest first.
+    Each worker orders and runs its partitions as OptimisingTestSuite does,
+    using its own copy of the resource managers, so splitting the suite up
+    loses no reuse of resources. What happens in the workers is streamed
+    back to the result given to run, from the thread calling run.
+
+    Workers are forked, so tests and resources do not need to be picklable,
+    but the suite is run in this process where fork is not available.
+    Measured costs reach this process only through a costStore.
+
+    When the result is told to stop, the workers stop starting tests and
+    tear down the resources they hold before exiting.
+
+    :cvar processes: The number of worker processes. None (the default)
+        uses one per CPU.
+    :cvar durations: If not None, a mapping from test ids to how long each
+        test takes, used with the switching costs to estimate which
+        partitions cost most. See PartitionScheduler.
+    :cvar split_partitions: If True, let workers make their own copies of
+        resources to split up a partition that would otherwise hold the
+        other workers up, as PartitionScheduler does. The tests are then
+        divided between the workers up front.
+    :cvar stop_timeout: How many seconds workers have to finish their
+        current tests and tear down their resources once the result is told
+        to stop, after which they are terminated.
+    """
+
+    processes = None
+    durations = None
+    split_partitions = False
+    stop_timeout = 60
+
+    def run(self, result):
+        context = _fork_context()
+        workers = self.processes or multiprocessing.cpu_count()
+        if context is None or workers < 2:
+            return OptimisingTestSuite.run(self, result)
+        partitions = self._partitionTests(workers)
+        if len(partitions) < 2:
+            return OptimisingTestSuite.run(self, result)
+        workers = min(workers, len(partitions))
+        tests = [test for partition in partitions for test in partition]
+        test_positions = dict(
+            (id(test), position) for position, test in enumerate(tests))
+        index = _ResourceIndex()
+        _split_by_resource_masks(tests, index)
+        managers = index.managers
+        manager_positions = dict(
+            (id(manager), position) for position, manager in
+            enumerate(managers))
+        # Forked workers would otherwise write buffered timings again.
+        _flush_cost_stores()
+        tasks = context.Queue()
+        events = context.Queue()
+        stop = context.Event()
+        for position in range(len(partitions)):
+            tasks.put(position)
+        processes = []
+        for _ in range(workers):
+            tasks.put(None)
+        # Workers are not daemonic, so that tests can start processes of
+        # their own.
+        for _ in range(workers):
+            process = context.Process(target=self._work, args=(partitions,
+                tasks, events, test_positions, manager_positions, stop))
+            process.start()
+            processes.append(process)
+        running = workers
+        deadline = None
+        try:
+            while running:
+                if deadline is None and result.shouldStop:
+                    # Let the workers tear their resources down, and keep
+                    # reading until they have.
+                    stop.set()
+                    deadline = time.time() + self.stop_timeout
+                if deadline is not None and time.time() > deadline:
+                    break
+                try:
+                    event = events.get(timeout=0.1)
+                except queue.Empty:
+                    # Everything a worker sent is readable once it has exited.
+                    if any(process.is_alive() for process in processes):
+                        continue
+                    result.addError(_PlaceholderTest("worker process"),
+                        _remote_exc_info(_RemoteError,
+                            "A worker process exited without finishing its "
+                            "tests."))
+                    break
+                if event is None:
+                    running -= 1
+                else:
+                    self._replay(event, result, tests, managers)
+        finally:
+            for process in processes:
+                if running and process.is_alive():
+                    process.terminate()
+                process.join()
+        return result
+
+    def _partitionTests(self, workers):
+        """Split the tests into sorted lists that share no resources.
+
+        :return: A list of lists of tests, in the order to run them, with
+            the partitions estimated to cost most first. Starting the
+            costliest partitions first keeps the workers evenly loaded.
+        """
+        scheduler = PartitionScheduler(workers, self.durations,
+            suite_factory=self._partitionSuite,
+            split_partitions=self.split_partitions)
+        if self.split_partitions:
+            # Split partitions must each run in one worker, after the other
+            # partitions planned for it, to share its copies of resources.
+            return [tests for tests in scheduler._assign(self._tests)[0]
+                if tests]
+        return [tests for _, tests in scheduler._sortedPartitions(self._tests)]
+
+    def _partitionSuite(self, tests):
+        """Make a suite sharing this suite's settings to sort tests with."""
+        suite = copy.copy(self)
+        suite._tests = list(tests)
+        suite.partition_solvers = []
+        return suite
+
+    def _work(self, partitions, tasks, events, test_positions,
+        manager_positions, stop):
+        """Run partitions from tasks in a worker process."""
+        result = _ForwardingResult(
+            events, test_positions, manager_positions, stop)
+        for position in iter(tasks.get, None):
+            if stop.is_set():
+                continue
+            # The partitions were sorted by _partitionTests.
+            self._tests = partitions[position]
+            self._resourceIndex = None
+            try:
+                self._runSorted(result)
+            except Exception:
+                result.addError(
+                    _PlaceholderTest("run (partition %d)" % position),
+                    sys.exc_info())
+        events.put(None)
+
+    def _replay(self, event, result, tests, managers):
+        """Make the call on result that a worker process sent as event."""
+        name, position = event[:2]
+        method = getattr(result, name, None)
+        if method is None:
+            return
+        if name in _RESOURCE_EVENTS:
+            method(managers[position])
+            return
+        if isinstance(position, int):
+            test = tests[position]
+        else:
+            test = _PlaceholderTest(position)
+        args = event[2:]
+        if name in ('addError', 'addExpectedFailure'):
+            args = (_remote_exc_info(_RemoteError, args[0]),)
+        elif name == 'addFailure':
+            args = (_remote_exc_info(_RemoteFailure, args[0]),)
+        elif name == 'addSubTest':
+            description, failed, text = args
+            err = None
+            if text is not None:
+                err = _remote_exc_info(
+                    _RemoteFailure if failed else _RemoteError, text)
+            args = (_PlaceholderTest(description), err)
+        method(test, *args)
+
+
+def _test_id(test):
+    """Return the id of test, or the ids of the tests in a suite."""
+    test_id = getattr(test, 'id', None)
+    if test_id is not None:
+        return test_id()
+    return ' '.join(_test_id(member) for member in test)
+
+
+class PartitionPlan(object):
+    """An assignment of tests to workers, made by PartitionScheduler.
+
+    Plans hold test ids rather than tests, so they can be saved and used to
+    divide the tests of later runs the same way.
+
+    :ivar assignments: A list with, for each worker, a list of the ids of
+        the tests it runs, in the order to run them.
+    :ivar costs: A list of the estimated cost of each worker's tests.
+    :ivar duplicated_cost: The estimated cost of the extra copies of
+        resources that splitting partitions makes workers set up.
+    :ivar makespan_reduction: How much splitting partitions is estimated to
+        reduce the cost of the busiest worker.
+    """
+
+    def __init__(self, assignments, costs=None, duplicated_cost=0,
+        makespan_reduction=0):
+        self.assignments = assignments
+        if costs is None:
+            costs = [0] * len(assignments)
+        self.costs = costs
+        self.duplicated_cost = duplicated_cost
+        self.makespan_reduction = makespan_reduction
+
+    def split(self, tests):
+        """Divide tests between the workers as planned.
+
+        Tests that the plan does not name are given to the worker with the
+        lowest estimated cost.
+
+        :return: A list with a list of tests for each worker.
+        """
+        by_id = {}
+        for test in tests:
+            by_id.setdefault(_test_id(test), []).append(test)
+        split = []
+        for assignment in self.assignments:
+            worker_tests = []
+            for test_id in assignment:
+                worker_tests.extend(by_id.pop(test_id, ()))
+            split.append(worker_tests)
+        if by_id and split:
+            cheapest = self.costs.index(min(self.costs))
+            for test in tests:
+                if _test_id(test) in by_id:
+                    split[cheapest].append(test)
+        return split
+
+
+class _SplitSuite(object):
+    """Wraps a suite for a worker, as test suites cannot be hashed."""
+
+    def __init__(self, suite):
+        self.suite = suite
+
+    def __call__(self, result):
+        return self.suite.run(result)
+
+    def __iter__(self):
+        return iter(self.suite)
+
+    def countTestCases(self):
+        return self.suite.countTestCases()
+
+    def run(self, result):
+        return self.suite.run(result)
+
+
+class PartitionScheduler(object):
+    """Balance partitions of tests that share no resources across workers.
+
+    The cost of each partition is estimated as the switching cost along the
+    order OptimisingTestSuite would run it in, from and back to no
+    resources, plus the durations of its tests. Partitions are then given
+    to workers costliest first, each to the worker with the least cost so
+    far (the LPT rule). Tests that need no resources are each a partition.
+
+    A scheduler can be passed as the split function of concurrent suites,
+    such as testtools.ConcurrentTestSuite: calling it with a suite returns
+    a test for each worker, which runs that worker's tests in an
+    OptimisingTestSuite.
+
+    When one partition costs more than a fair share of the work, as when
+    nearly every test uses one database, split_partitions plans for workers
+    making their own copies of resources to break it up. The resource
+    shared by the most resource sets for the least setup and teardown cost
+    is copied first, as in a greedy minimum cut, for as long as each copy
+    lowers the cost of the busiest worker. The plan reports the cost of the
+    copies and the reduction in the busiest worker's cost. Nothing is
+    copied by the scheduler: the workers must each have their own resource
+    managers, as the forked workers of ParallelOptimisingTestSuite do, so
+    a splitting scheduler cannot be the split function of a suite running
+    workers in threads.
+
+    Switching costs come from the setUpCost and tearDownCost (or measured
+    costs) of the resources, so durations should be in the same units.
+    """
+
+    def __init__(self, workers, durations=None, default_duration=None,
+        suite_factory=None, split_partitions=False):
+        """Create a PartitionScheduler.
+
+        :param workers: The number of workers to plan for.
+        :param durations: A mapping from test ids to how long each test
+            takes, such as the timings of an earlier run.
+        :param default_duration: The duration of tests not in durations.
+            Defaults to the mean of durations, or 1 without any.
+        :param suite_factory: A callable making an OptimisingTestSuite from
+            a list of tests, used to order and cost partitions. Defaults to
+            OptimisingTestSuite.
+        :param split_partitions: If True, split partitions that cost more
+            than a fair share of the work by copying resources. Only use this
+            when each worker has its own copies of the resource managers.
+        """
+        self.workers = workers
+        self.durations = durations or {}
+        if default_duration is None:
+            if self.durations:
+                default_duration = (
+                    sum(self.durations.values()) / float(len(self.durations)))
+            else:
+                default_duration = 1
+        self.default_duration = default_duration
+        if suite_factory is None:
+            suite_factory = OptimisingTestSuite
+        self.suite_factory = suite_factory
+        self.split_partitions = split_partitions
+
+    def __call__(self, suite):
+        if self.split_partitions:
+            # Split suites would share the managers of the copied resources
+            # between threads.
+            raise ValueError("split_partitions needs workers with their own "
+                "resource managers, so cannot be used to split a suite.")
+        tests = OptimisingTestSuite(suite)._tests
+        return [_SplitSuite(self.suite_factory(worker_tests))
+            for worker_tests in self.plan(tests).split(tests) if worker_tests]
+
+    def duration(self, test):
+        """Return how long test is expected to take."""
+        test_id = getattr(test, 'id', None)
+        if test_id is None:
+            return sum(self.duration(member) for member in test)
+        return self.durations.get(test_id(), self.default_duration)
+
+    def estimate(self, tests):
+        """Estimate the cost of running tests, which may share resources."""
+        return self._estimate(tests)[0]
+
+    def _estimate(self, tests):
+        """Return the estimated cost of tests and the order to run them in."""
+        suite = self.suite_factory(tests)
+        suite.sortTests()
+        cost = 0
+        current_resources = set()
+        for needed, group in suite._groupTests():
+            needed = set(needed)
+            cost += suite.cost_of_switching(current_resources, needed)
+            current_resources = needed
+            for test in group:
+                cost += self.duration(test)
+        cost += suite.cost_of_switching(current_resources, set())
+        return cost, suite._tests
+
+    def _sortedPartitions(self, tests, replicated=()):
+        """Split tests into partitions that share no resources.
+
+        :param replicated: Resources that each partition may have its own
+            copy of, so that they do not join partitions together.
+        :return: A list of (cost, tests) tuples, costliest first, with the
+            tests of each partition in the order to run them.
+        """
+        index = _ResourceIndex()
+        resource_set_tests = _split_by_resource_masks(tests, index)
+        members = _iter_bits
+        if replicated:
+            kept = ~index.mask(replicated)
+            members = lambda mask: _iter_bits(mask & kept)
+        partitions = []
+        for partition in _partition_resource_sets(
+            resource_set_tests, members):
+            if partition == set([0]):
+                continue
+            partition_tests = []
+            for resource_set in partition:
+                partition_tests.extend(resource_set_tests[resource_set])
+            partitions.append(self._estimate(partition_tests))
+        for test in resource_set_tests[0]:
+            partitions.append((self.duration(test), [test]))
+        partitions.sort(key=lambda partition: partition[0], reverse=True)
+        return partitions
+
+    def _pack(self, partitions):
+        """Give partitions, costliest first, to the least loaded worker.
+
+        :return: A (worker_tests, costs) tuple of the tests and estimated
+            cost of each worker.
+        """
+        worker_tests = [[] for _ in range(self.workers)]
+        costs = [0] * self.workers
+        loads = [(0, worker) for worker in range(self.workers)]
+        for cost, partition_tests in partitions:
+            _, worker = heapq.heappop(loads)
+            worker_tests[worker].extend(partition_tests)
+            costs[worker] += cost
+            heapq.heappush(loads, (costs[worker], worker))
+        return worker_tests, costs
+
+    def _replicationCandidate(self, tests, replicated):
+        """Choose a resource of tests to give each worker its own copy of.
+
+        The resource shared by the most resource sets for the least setup
+        and teardown cost is chosen, as copying it cuts the most links
+        between tests for the least duplicated work.
+
+        :return: A resource manager, or None if no resource links tests.
+        """
+        index = _ResourceIndex()
+        masks = set(index.declaration(getattr(test, 'resources', ()))[0]
+            for test in tests)
+        sharing = {}
+        for mask in masks:
+            for position in _bit_positions(mask):
+                sharing[position] = sharing.get(position, 0) + 1
+        suite = self.suite_factory([])
+        best_score, best = None, None
+        for position, count in sharing.items():
+            resource = index.managers[position]
+            if count < 2 or resource in replicated:
+                continue
+            cost = suite._setUpCost(resource) + suite._tearDownCost(resource)
+            if cost:
+                score = count / float(cost)
+            else:
+                score = float('inf')
+            if best is None or score > best_score:
+                best_score, best = score, resource
+        return best
+
+    def plan(self, tests):
+        """Assign tests to workers, balancing their estimated costs.
+
+        :return: A PartitionPlan.
+        """
+        worker_tests, costs, duplicated_cost, makespan_reduction = (
+            self._assign(tests))
+        return PartitionPlan(
+            [[_test_id(test) for test in split_tests]
+                for split_tests in worker_tests],
+            costs, duplicated_cost, makespan_reduction)
+
+    def _assign(self, tests):
+        """Assign tests to workers, as plan does.
+
+        :return: A (worker_tests, costs, duplicated_cost,
+            makespan_reduction) tuple, where worker_tests holds the list of
+            tests for each worker in the order to run them.
+        """
+        partitions = self._sortedPartitions(tests)
+        worker_tests, costs = self._pack(partitions)
+        duplicated_cost = 0
+        makespan_reduction = 0
+        replicated = set()
+        while self.split_partitions and partitions:
+            # Only a partition costing more than a fair share of the work
+            # holds the other workers up.
+            if (partitions[0][0] * self.workers <=
+                sum(cost for cost, _ in partitions)):
+                break
+            resource = self._replicationCandidate(
+                partitions[0][1], replicated)
+            if resource is None:
+                break
+            replicated.add(resource)
+            unsplit = len(partitions)
+            partitions = self._sortedPartitions(tests, replicated)
+            if len(partitions) == unsplit:
+                # Other resources still link the tests: copy those too.
+                continue
+            # Partitions given to the same worker can still share their
+            # copies of resources, so each worker is costed as a whole.
+            split = [self._estimate(split_tests) for split_tests in
+                self._pack(partitions)[0]]
+            split_costs = [cost for cost, _ in split]
+            if max(split_costs) >= max(costs):
+                break
+            duplicated_cost += sum(split_costs) - sum(costs)
+            makespan_reduction += max(costs) - max(split_costs)
+            worker_tests = [split_tests for _, split_tests in split]
+            costs = split_costs
+        return worker_tests, costs, duplicated_cost, makespan_reduction
+
+
 class TestLoader(unittest.TestLoader):
     """Custom TestLoader to set the right TestSuite class."""
     suiteClass = OptimisingTestSuite
@@ -507,24 +2553,121 @@ class TestResourceManager(object):
     :ivar resources: The resources that this resource needs. Calling
         neededResources will return the closure of this resource and its needed
         resources. The resources list is in the same format as resources on a
-        test case - a list of tuples (attribute_name, resource).
+        test case - a list of tuples (attribute_name, resource). A list
+        assigned to resources is copied, so that changes to it can be noticed.
     :ivar setUpCost: The relative cost to construct a resource of this type.
          One good approach is to set this to the number of seconds it normally
          takes to set up the resource.
     :ivar tearDownCost: The relative cost to tear down a resource of this
          type. One good approach is to set this to the number of seconds it
          normally takes to tear down the resource.
+    :ivar resetCost: The relative cost to reset a dirty resource of this
+        type. None (the default) means setUpCost + tearDownCost, which is
+        what the default _reset does.
+    :cvar initialDirtyProbability: The chance that a use of the resource
+        leaves it dirty, until it has been reused enough to be learnt. See
+        dirtyProbability.
+    :ivar measuredSetUpCost: A running estimate of the seconds that make
+        takes, or None if it has not been called yet. Only make itself is
+        timed, not the setting up of dependencies.
+    :ivar measuredTearDownCost: As measuredSetUpCost, for clean.
+    :ivar measuredResetCost: As measuredSetUpCost, for _reset.
+    :cvar measurementWeight: How much each new timing moves the measured
+        costs, between 0 and 1. The estimates are exponentially weighted
+        moving averages, so higher values follow changes faster.
+    :cvar costStore: If not None, a ResourceCostStore that timings are
+        recorded into, so that later runs can use them. Set it on
+        TestResourceManager to record the costs of every manager.
+    :cvar prefetch: If True, OptimisingTestSuite may make the resource on
+        a background thread before the tests needing it start, while other
+        tests run. Only set this if making it is safe alongside those tests.
+    :cvar memoryCost: The relative memory a resource of this type uses, for
+        OptimisingTestSuite.prefetch_memory_limit.
+    :cvar prefetchConcurrency: The most resources OptimisingTestSuite may
+        prefetch at once while prefetching this resource, counting it. The
+        default of 1 makes it alone. Raise it for resources that spend
+        their time waiting, such as on a server starting.
+    :cvar concurrencySafe: If True, tests using the resource may run at the
+        same time, as OptimisingTestSuite.test_workers does. Set this for
+        resources that tests only read, such as reference data or a static
+        server.
     """
 
     setUpCost = 1
     tearDownCost = 1
+    resetCost = None
+    initialDirtyProbability = 0
+    measuredSetUpCost = None
+    measuredTearDownCost = None
+    measuredResetCost = None
+    measurementWeight = 0.3
+    costStore = None
+    prefetch = False
+    memoryCost = 0
+    prefetchConcurrency = 1
+    concurrencySafe = False
 
     def __init__(self):
         """Create a TestResourceManager object."""
         self._dirty = False
         self._uses = 0
+        self._reuses = 0
+        self._dirtyReuses = 0
+        self._dirtiedCount = 0
+        self._dirtiedBy = set()
+        # Held while the resource is got or finished with once the manager
+        # is used from several threads. See _makeThreadSafe.
+        self._lock = None
         self._currentResource = None
-        self.resources = list(getattr(self.__class__, "resources", []))
+        resources = getattr(self.__class__, "resources", [])
+        if isinstance(resources, property):
+            resources = []
+        # Subclasses declaring resources as a class attribute hide the
+        # property, so wrap the list here rather than in the setter.
+        self.resources = _ResourceList(resources)
+
+    def _getResources(self):
+        return self._resources
+
+    def _setResources(self, resources):
+        # Keep a list that notices changes, so neededResources can be
+        # cached.
+        if not isinstance(resources, _ResourceList):
+            resources = _ResourceList(resources)
+        self._resources = resources
+
+    resources = property(_getResources, _setResources)
+
+    def __getstate__(self):
+        # Locks cannot be copied or pickled, and a copy is not shared
+        # between threads yet.
+        state = self.__dict__.copy()
+        if state.get('_lock') is not None:
+            state['_lock'] = None
+        return state
+
+    def _makeThreadSafe(self):
+        """Lock getResource and finishedWith from now on.
+
+        Managers are only locked once OptimisingTestSuite is about to use
+        them from several threads, so that the usual single threaded run
+        does not pay for locking. Call this before other threads use the
+        manager.
+        """
+        if self._lock is None:
+            self._lock = threading.RLock()
+
+    def _hold(self, result=None):
+        """Get the resource for OptimisingTestSuite to keep between tests.
+
+        The suite may release the hold on another thread. By default this is
+        getResource.
+        """
+        return self.getResource(result)
+
+    def _release(self, result=None):
+        """Finish with a resource got by _hold."""
+        self.finishedWith(self._currentResource, result)
 
     def _call_result_method_if_exists(self, result, methodname, *args):
         """Call a method on a TestResult that may exist."""
@@ -535,14 +2678,25 @@ class TestResourceManager(object):
     def _clean_all(self, resource, result):
         """Clean the dependencies from resource, and then resource itself."""
         self._call_result_method_if_exists(result, "startCleanResource", self)
+        start = _timer()
         self.clean(resource)
+        seconds = _timer() - start
         for name, manager in self.resources:
             manager.finishedWith(getattr(resource, name))
+        self._measure('measuredTearDownCost', seconds)
         self._call_result_method_if_exists(result, "stopCleanResource", self)
 
     def clean(self, resource):
         """Override this to class method to hook into resource removal."""
 
+    def costKey(self):
+        """Return the key that costStore keeps this managers costs under.
+
+        This is the path of the managers class. Override it if instances of
+        one class have very different costs.
+        """
+        return "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+
     def dirtied(self, resource):
         """Mark the resource as having been 'dirtied'.
 
@@ -552,6 +2706,18 @@ class TestResourceManager(object):
         e.g. a shared database that has had rows changed.
         """
         self._dirty = True
+        self._dirtiedCount += 1
+
+    def dirtyProbability(self):
+        """Return the chance that the resource is dirty when it is reused.
+
+        This is learnt from how often getResource finds the held resource
+        dirty, for example because dirtied was called. Until then
+        initialDirtyProbability is returned.
+        """
+        if not self._reuses:
+            return self.initialDirtyProbability
+        return self._dirtyReuses / float(self._reuses)
 
     def finishedWith(self, resource, result=None):
         """Indicate that 'resource' has one less user.
@@ -564,10 +2730,17 @@ class TestResourceManager(object):
             `TestResourceManager.getResource`.
         :param result: An optional TestResult to report resource changes to.
         """
-        self._uses -= 1
-        if self._uses == 0:
-            self._clean_all(resource, result)
-            self._setResource(None)
+        lock = self._lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            self._uses -= 1
+            if self._uses == 0:
+                self._clean_all(resource, result)
+                self._setResource(None)
+        finally:
+            if lock is not None:
+                lock.release()
 
     def getResource(self, result=None):
         """Get the resource for this class and record that it's being used.
@@ -578,12 +2751,23 @@ class TestResourceManager(object):
         that it is no longer needed.
         :param result: An optional TestResult to report resource changes to.
         """
-        if self._uses == 0:
-            self._setResource(self._make_all(result))
-        elif self.isDirty():
-            self._setResource(self.reset(self._currentResource, result))
-        self._uses += 1
-        return self._currentResource
+        lock = self._lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            if self._uses == 0:
+                self._setResource(self._make_all(result))
+            else:
+                self._reuses += 1
+                if self.isDirty():
+                    self._dirtyReuses += 1
+                    self._setResource(
+                        self.reset(self._currentResource, result))
+            self._uses += 1
+            return self._currentResource
+        finally:
+            if lock is not None:
+                lock.release()
 
     def isDirty(self):
         """Return True if this managers cached resource is dirty.
@@ -609,7 +2793,9 @@ class TestResourceManager(object):
         dependency_resources = {}
         for name, resource in self.resources:
             dependency_resources[name] = resource.getResource()
+        start = _timer()
         resource = self.make(dependency_resources)
+        self._measure('measuredSetUpCost', _timer() - start)
         for name, value in dependency_resources.items():
             setattr(resource, name, value)
         self._call_result_method_if_exists(result, "stopMakeResource", self)
@@ -628,10 +2814,16 @@ class TestResourceManager(object):
     def neededResources(self):
         """Return the resources needed for this resource, including self.
 
+        The result is cached until the resources list of this manager or one
+        of its dependencies changes.
+
         :return: A list of needed resources, in topological deepest-first
             order.
         """
-        return neededResources([self])
+        cached = _cached_closure(self)
+        if cached is None:
+            cached = resourceClosures([self])[self]
+        return list(cached)
 
     def reset(self, old_resource, result=None):
         """Return a clean version of old_resource.
@@ -679,12 +2871,44 @@ class TestResourceManager(object):
         for name, mgr in self.resources:
             dependency_resources[name] = mgr.reset(
                 getattr(old_resource, name), result)
+        start = _timer()
         resource = self._reset(old_resource, dependency_resources)
+        self._measure('measuredResetCost', _timer() - start)
         for name, value in dependency_resources.items():
             setattr(resource, name, value)
         self._call_result_method_if_exists(result, "stopResetResource", self)
         return resource
 
+    def _loadMeasuredCosts(self):
+        """Fill in costs not measured in this process from costStore."""
+        if self.costStore is None:
+            return
+        try:
+            estimates = self.costStore.load(self.costKey())
+        except Exception:
+            _warnCostStoreFailed('load', sys.exc_info()[1])
+            return
+        for attribute, estimate in estimates.items():
+            if getattr(self, attribute, None) is None:
+                setattr(self, attribute, estimate)
+
+    def _measure(self, attribute, seconds):
+        """Fold a timing of seconds into the estimate held in attribute."""
+        estimate = getattr(self, attribute)
+        if estimate is None:
+            estimate = seconds
+        else:
+            estimate += self.measurementWeight * (seconds - estimate)
+        setattr(self, attribute, estimate)
+        if self.costStore is not None:
+            # Losing a timing is better than failing to make or clean the
+            # resource.
+            try:
+                self.costStore.record(
+                    self.costKey(), attribute, seconds, self.measurementWeight)
+            except Exception:
+                _warnCostStoreFailed('record', sys.exc_info()[1])
+
     def _reset(self, resource, dependency_resources):
         """Override this to reset resources other than via clean+make.
 
@@ -721,6 +2945,8 @@ class GenericResource(TestResourceManager):
     method.
     """
 
+    initialDirtyProbability = 1
+
     def __init__(self, resource_factory, setup_method_name='setUp',
         teardown_method_name='tearDown'):
         """Create a GenericResource
@@ -769,6 +2995,8 @@ class FixtureResource(TestResourceManager):
     :ivar fixture: The wrapped fixture.
     """
 
+    initialDirtyProbability = 1
+
     def __init__(self, fixture):
         """Create a FixtureResource
 
@@ -794,6 +3022,363 @@ class FixtureResource(TestResourceManager):
     _dirty = property(lambda _:True, lambda _, _1:None)
 
 
+class PooledTestResourceManager(TestResourceManager):
+    """A TestResourceManager that lends each thread a resource of its own.
+
+    Tests running on several threads at once can share a pooled manager.
+    The first getResource on a thread lends it an idle clean resource, or
+    makes one if fewer than poolSize are live. Otherwise it waits for
+    another thread to finish with one, unless growPool is set. Until the
+    thread has finished with the resource as often as it got it,
+    getResource on that thread returns the same resource, just as
+    TestResourceManager does for every caller.
+
+    Resources finished with while dirty are reset on a background thread
+    before they are lent again. Once nothing uses the manager, every
+    resource is cleaned. Background resets reset the resource itself, not
+    its dependencies, and are not reported to a result.
+
+    OptimisingTestSuite does not borrow a resource to keep between tests,
+    as its tests may run on other threads. It only keeps the pool from
+    being cleaned, making a first resource when the pool is empty.
+
+    :cvar poolSize: The most resources to keep live at once.
+    :cvar growPool: If True, make more than poolSize resources rather than
+        wait for one to be finished with.
+    """
+
+    poolSize = 4
+    growPool = False
+
+    def __init__(self):
+        """Create a PooledTestResourceManager object."""
+        self._local = threading.local()
+        # Maps the id of each lent resource to [resource, uses].
+        self._lent = {}
+        self._idle = []
+        self._live = 0
+        self._dirtyResources = set()
+        self._resetter = None
+        super(PooledTestResourceManager, self).__init__()
+        # Borrowers on many threads are expected, so always lock.
+        self._lock = threading.RLock()
+        self._available = threading.Condition(self._lock)
+
+    @property
+    def _currentResource(self):
+        """The resource lent to the calling thread."""
+        return getattr(self._local, 'resource', None)
+
+    @_currentResource.setter
+    def _currentResource(self, resource):
+        self._local.resource = resource
+
+    @property
+    def _dirty(self):
+        """Whether the resource lent to the calling thread is dirty."""
+        return id(self._currentResource) in self._dirtyResources
+
+    @_dirty.setter
+    def _dirty(self, dirty):
+        if dirty:
+            self._dirtyResources.add(id(self._currentResource))
+        else:
+            self._dirtyResources.discard(id(self._currentResource))
+
+    def dirtied(self, resource):
+        with self._lock:
+            self._dirtyResources.add(id(resource))
+            self._dirtiedCount += 1
+
+    def finishedWith(self, resource, result=None):
+        with self._lock:
+            lent = self._lent[id(resource)]
+            lent[1] -= 1
+            self._uses -= 1
+            if lent[1]:
+                return
+            del self._lent[id(resource)]
+            if self._currentResource is resource:
+                self._currentResource = None
+            dirty = id(resource) in self._dirtyResources
+            drained = self._uses == 0
+        if drained:
+            self._drain(resource, result)
+        elif not dirty:
+            self._giveBack(resource)
+        elif futures is None:
+            self._resetReturned(resource)
+        else:
+            self._getResetter().submit(self._resetReturned, resource)
+
+    def getResource(self, result=None):
+        resource = self._currentResource
+        with self._lock:
+            lent = self._lent.get(id(resource))
+            if lent is not None and lent[0] is resource:
+                lent[1] += 1
+                self._uses += 1
+                self._reuses += 1
+                if not self.isDirty():
+                    return resource
+                self._dirtyReuses += 1
+                new_resource = self.reset(resource, result)
+                del self._lent[id(resource)]
+                self._dirtyResources.discard(id(resource))
+                self._lent[id(new_resource)] = [new_resource, lent[1]]
+                self._setResource(new_resource)
+                return new_resource
+        resource = self._borrow(result)
+        with self._lock:
+            self._lent[id(resource)] = [resource, 1]
+            self._uses += 1
+            self._setResource(resource)
+        return resource
+
+    def _hold(self, result=None):
+        # Rather than borrowing a resource that tests on other threads could
+        # then not use, keep the pool from being drained, with one resource
+        # ready.
+        with self._lock:
+            self._uses += 1
+            if self._live:
+                return
+        try:
+            self._giveBack(self._borrow(result))
+        except Exception:
+            self._release(result)
+            raise
+
+    def _release(self, result=None):
+        with self._lock:
+            self._uses -= 1
+            drained = self._uses == 0
+        if drained:
+            self._drain(None, result)
+
+    def _borrow(self, result):
+        """Take an idle resource, or make one when the pool allows."""
+        with self._available:
+            while (not self._idle and self._live >= self.poolSize and
+                not self.growPool):
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._live += 1
+        try:
+            return self._make_all(result)
+        except Exception:
+            with self._available:
+                self._live -= 1
+                self._available.notify()
+            raise
+
+    def _drain(self, resource, result):
+        """Clean every resource, as nothing uses the manager any more.
+
+        :param resource: The resource last finished with, or None.
+        """
+        with self._lock:
+            resetter, self._resetter = self._resetter, None
+        if resetter is not None:
+            # Wait for resets in progress to give their resources back.
+            resetter.shutdown(wait=True)
+        with self._available:
+            if self._uses:
+                # Lent again meanwhile: keep the resources for that.
+                if resource is not None:
+                    self._idle.append(resource)
+                    self._available.notify()
+                return
+            idle, self._idle = self._idle, []
+            if resource is not None:
+                idle.append(resource)
+            self._live -= len(idle)
+            for idle_resource in idle:
+                self._dirtyResources.discard(id(idle_resource))
+            self._available.notify_all()
+        for idle_resource in idle:
+            self._clean_all(idle_resource, result)
+
+    def _getResetter(self):
+        """Return the executor that resets resources in the background."""
+        with self._lock:
+            if self._resetter is None:
+                self._resetter = futures.ThreadPoolExecutor(1)
+            return self._resetter
+
+    def _giveBack(self, resource):
+        """Make resource available to lend again."""
+        with self._available:
+            self._idle.append(resource)
+            self._available.notify()
+
+    def _resetReturned(self, resource):
+        """Reset a dirty resource that has been finished with."""
+        dependency_resources = dict((name, getattr(resource, name))
+            for name, _ in self.resources)
+        try:
+            start = _timer()
+            new_resource = self._reset(resource, dependency_resources)
+            self._measure('measuredResetCost', _timer() - start)
+        except Exception:
+            # The resource is unusable: let another be made in its place.
+            for name, manager in self.resources:
+                manager.finishedWith(dependency_resources[name])
+            with self._available:
+                self._dirtyResources.discard(id(resource))
+                self._live -= 1
+                self._available.notify()
+            return
+        for name, value in dependency_resources.items():
+            setattr(new_resource, name, value)
+        with self._lock:
+            self._dirtyResources.discard(id(resource))
+            self._dirtyResources.discard(id(new_resource))
+        self._giveBack(new_resource)
+
+
+def _warnCostStoreFailed(action, error):
+    warnings.warn("Could not %s measured resource costs: %s" % (action, error),
+        RuntimeWarning, stacklevel=3)
+
+
+class ResourceCostStore(object):
+    """A store of measured resource costs that outlives the process.
+
+    TestResourceManager.costStore records timings into a store, and
+    OptimisingTestSuite loads them back when use_measured_costs is set.
+    Subclass this to keep costs somewhere else.
+    """
+
+    def load(self, key):
+        """Return the cost estimates stored for key.
+
+        :return: A dict mapping measured cost attributes, such as
+            'measuredSetUpCost', to estimates in seconds.
+        """
+        raise NotImplementedError(self.load)
+
+    def record(self, key, attribute, seconds, weight):
+        """Fold a timing into the estimate stored for key and attribute.
+
+        Stores may buffer timings until flush is called.
+
+        :param weight: How much the timing moves the stored estimate,
+            between 0 and 1.
+        """
+        raise NotImplementedError(self.record)
+
+    def flush(self):
+        """Write any buffered timings."""
+
+
+class SQLiteResourceCostStore(ResourceCostStore):
+    """A ResourceCostStore kept in an SQLite database file.
+
+    Many processes, such as those of a parallel test runner, can record into
+    one file at once. Estimates that have not been updated for max_age
+    seconds are ignored, and are deleted when the store is first used.
+
+    Timings are buffered in memory and written in one transaction by flush,
+    which OptimisingTestSuite calls at the end of each run, load calls first,
+    and which is called when the process exits.
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 60 * 60):
+        """Create an SQLiteResourceCostStore.
+
+        :param path: The path of the database file, which is created if it
+            does not exist.
+        :param max_age: The age in seconds at which estimates are discarded.
+        """
+        self.path = path
+        self.max_age = max_age
+        self._prepared_pid = None
+        self._pending = []
+
+    def _connect(self):
+        """Return a new connection to the database.
+
+        Connections are not kept, as they cannot be shared between threads
+        or across a fork. The table is created, and old estimates pruned, by
+        the first connection in each process.
+        """
+        # Imported here so that testresources works without sqlite3 for
+        # those not using this store.
+        import sqlite3
+        connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None)
+        if self._prepared_pid != os.getpid():
+            try:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS costs (key TEXT NOT NULL, "
+                    "attribute TEXT NOT NULL, estimate REAL NOT NULL, "
+                    "updated REAL NOT NULL, PRIMARY KEY (key, attribute))")
+                connection.execute("DELETE FROM costs WHERE updated < ?",
+                    (time.time() - self.max_age,))
+            except Exception:
+                connection.close()
+                raise
+            self._prepared_pid = os.getpid()
+        return connection
+
+    def load(self, key):
+        self.flush()
+        with contextlib.closing(self._connect()) as connection:
+            return dict(connection.execute(
+                "SELECT attribute, estimate FROM costs "
+                "WHERE key = ? AND updated >= ?",
+                (key, time.time() - self.max_age)))
+
+    def record(self, key, attribute, seconds, weight):
+        self._pending.append((key, attribute, seconds, weight))
+        _unflushed_stores.add(self)
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        now = time.time()
+        with contextlib.closing(self._connect()) as connection:
+            # Take the write lock before reading, so that concurrent
+            # writers cannot lose each others timings. If anything fails the
+            # transaction is rolled back when the connection is closed.
+            connection.execute("BEGIN IMMEDIATE")
+            for key, attribute, seconds, weight in pending:
+                row = connection.execute(
+                    "SELECT estimate FROM costs WHERE key = ? AND "
+                    "attribute = ? AND updated >= ?",
+                    (key, attribute, now - self.max_age)).fetchone()
+                if row is not None:
+                    seconds = row[0] + weight * (seconds - row[0])
+                connection.execute(
+                    "INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)",
+                    (key, attribute, seconds, now))
+            connection.execute("COMMIT")
+
+
+# Stores with buffered timings, which are written at the end of each
+# OptimisingTestSuite run and when the process exits.
+_unflushed_stores = set()
+
+
+def _flush_cost_stores():
+    """Write the timings buffered by every store."""
+    while _unflushed_stores:
+        try:
+            store = _unflushed_stores.pop()
+        except KeyError:
+            break
+        try:
+            store.flush()
+        except Exception:
+            _warnCostStoreFailed('record', sys.exc_info()[1])
+
+
+atexit.register(_flush_cost_stores)
+
+
 class ResourcedTestCase(unittest.TestCase):
     """A TestCase parent or utility that enables cross-test resource usage.
 
@@ -807,9 +3392,20 @@ class ResourcedTestCase(unittest.TestCase):
     :ivar resources: A list of (name, resource) pairs, where 'resource' is a
         subclass of `TestResourceManager` and 'name' is the name of the
         attribute that the resource should be stored on.
+    :ivar dirties: The names of the resources that the test dirties.
+        OptimisingTestSuite runs these tests after the other tests using the
+        same resources. Tests found to dirty a resource when they run are
+        treated the same way from then on, whether or not they say so here.
     """
 
     resources = []
+    dirties = []
+
+    def run(self, result=None):
+        if result is None:
+            return super(ResourcedTestCase, self).run(result)
+        with activeResult(result):
+            return super(ResourcedTestCase, self).run(result)
 
     def setUp(self):
         super(ResourcedTestCase, self).setUp()
@@ -855,37 +3451,210 @@ def neededResources(resources):
 
     :return: A list of needed resources, in topological deepest-first order.
     """
+    resources = list(resources)
+    closures = resourceClosures(resources)
+    if len(resources) == 1:
+        return list(closures[resources[0]])
     seen = set()
     result = []
-
     for resource in resources:
-        dependencies = neededResources([
-            dependency for name, dependency in resource.resources])
-        for resource in dependencies + [resource]:
+        for resource in closures[resource]:
             if resource in seen:
                 continue
             seen.add(resource)
             result.append(resource)
-
     return result
 
 
+def resourceClosures(resources):
+    """Return the needed resources of many resources in one pass.
+
+    The closure of each resource is cached on it until the resources list of
+    a manager in the closure changes, so diamond shaped dependencies are only
+    walked once.
+
+    :param resources: An iterable of TestResourceManagers.
+    :return: A dict mapping each of resources, and each of their
+        dependencies, to its neededResources() list. The lists must not be
+        modified.
+    """
+    closures = {}
+    for resource in resources:
+        if resource in closures:
+            continue
+        # A depth first walk which finishes each resource after all of its
+        # dependencies, so every closure is built from finished ones.
+        stack = [(resource, False)]
+        started = set()
+        while stack:
+            current, dependencies_done = stack.pop()
+            if current in closures:
+                continue
+            cached = _cached_closure(current)
+            if cached is not None:
+                closures[current] = cached
+                continue
+            dependencies = [dependency for _, dependency in current.resources]
+            if not dependencies_done:
+                if current in started:
+                    raise ValueError(
+                        "Circular resource dependency on %r" % (current,))
+                started.add(current)
+                stack.append((current, True))
+                for dependency in reversed(dependencies):
+                    if dependency not in closures:
+                        stack.append((dependency, False))
+                continue
+            seen = set()
+            closure = []
+            for dependency in dependencies:
+                for needed in closures[dependency]:
+                    if needed not in seen:
+                        seen.add(needed)
+                        closure.append(needed)
+            if current not in seen:
+                closure.append(current)
+            closures[current] = closure
+            stamp = _closure_stamp(closure)
+            if stamp is not None:
+                current._needed_resources = (stamp, closure)
+    return closures
+
+
+def _closure_stamp(closure):
+    """Return a record of the resources lists that closure was built from.
+
+    :return: A list of (resources, generation) pairs, one for each manager in
+        closure, or None if a manager's resources list does not notice
+        changes, in which case closure must not be cached.
+    """
+    stamp = []
+    for manager in closure:
+        resources = getattr(manager, 'resources', None)
+        if not isinstance(resources, _ResourceList):
+            return None
+        stamp.append((resources, resources._generation))
+    return stamp
+
+
+def _closure_still_valid(closure, stamp):
+    """Return whether no resources list in closure changed since stamp."""
+    for manager, (resources, generation) in zip(closure, stamp):
+        if (getattr(manager, 'resources', None) is not resources or
+            resources._generation != generation):
+            return False
+    return True
+
+
+def _cached_closure(resource):
+    """Return the cached closure of resource if it is still valid."""
+    cached = getattr(resource, '_needed_resources', None)
+    if cached is not None and _closure_still_valid(cached[1], cached[0]):
+        return cached[1]
+    return None
+
+
+class _ResourceList(list):
+    """The resources list of a TestResourceManager.
+
+    Its generation is bumped whenever it is changed, invalidating the cached
+    closures of the managers that depend on its owner.
+    """
+
+    _generation = 0
+
+
+def _invalidating(method_name):
+    method = getattr(list, method_name)
+    def invalidating(self, *args, **kwargs):
+        self._generation += 1
+        return method(self, *args, **kwargs)
+    invalidating.__name__ = method_name
+    return invalidating
+
+
+for _method_name in ('__delitem__', '__delslice__', '__iadd__', '__imul__',
+    '__setitem__', '__setslice__', 'append', 'clear', 'extend', 'insert',
+    'pop', 'remove', 'reverse', 'sort'):
+    if hasattr(list, _method_name):
+        setattr(_ResourceList, _method_name, _invalidating(_method_name))
+del _method_name
+
+
+if contextvars is not None:
+    _active_result = contextvars.ContextVar(
+        'testresources_active_result', default=None)
+
+    def _getActiveResult():
+        return _active_result.get()
+
+    def _setActiveResult(result):
+        _active_result.set(result)
+else:
+    _active_result = threading.local()
+
+    def _getActiveResult():
+        return getattr(_active_result, 'result', None)
+
+    def _setActiveResult(result):
+        _active_result.result = result
+
+
+@contextlib.contextmanager
+def activeResult(result):
+    """Report the resource activity of ResourcedTestCases to result.
+
+    OptimisingTestSuite and ResourcedTestCase do this for the tests they
+    run. Other runners can wrap running tests in this, so that resources
+    set up outside of ResourcedTestCase.run report to result too, without
+    searching the stack for it::
+
+        with testresources.activeResult(result):
+            suite.run(result)
+
+    The result is held per thread (and per asyncio task, where contextvars
+    is available), and restored when the block ends.
+    """
+    previous = _getActiveResult()
+    _setActiveResult(result)
+    try:
+        yield result
+    finally:
+        _setActiveResult(previous)
+
+
 def _get_result():
-    """Find a TestResult in the stack.
-
-    unittest hides the result. This forces us to look up the stack.
-    The result is passed to a run() or a __call__ method 4 or more frames
-    up: that method is what calls setUp and tearDown, and they call their
-    parent setUp etc. Its not guaranteed that the parameter to run will
-    be calls result as its not required to be a keyword parameter in
-    TestCase. However, in practice, this works.
-    """
-    stack = inspect.stack()
-    for frame in stack[2:]:
-        if frame[3] in ('run', '__call__'):
+    """Find the TestResult that tests are being run with.
+
+    unittest hides the result, so it is published by activeResult where
+    testresources runs tests. Otherwise this looks up the stack: the result
+    is passed to a run() or a __call__ method 4 or more frames up: that
+    method is what calls setUp and tearDown, and they call their parent
+    setUp etc. Its not guaranteed that the parameter to run will be calls
+    result as its not required to be a keyword parameter in TestCase.
+    However, in practice, this works.
+    """
+    result = _getActiveResult()
+    if result is not None:
+        return result
+    # Walk the frames directly: inspect.stack() reads the source of every
+    # frame, which is slow.
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_name in ('run', '__call__'):
             # Not all frames called 'run' will be unittest. It could be a
             # reactor in trial, for instance.
-            result = frame[0].f_locals.get('result')
+            result = frame.f_locals.get('result')
             if (result is not None and
                 getattr(result, 'startTest', None) is not None):
                 return result
+        frame = frame.f_back
+
+
+try:
+    from testresources import _async
+except SyntaxError:
+    # asyncio support needs Python 3.5 or newer.
+    _async = None
+else:
+    AsyncTestResourceManager = _async.AsyncTestResourceManager
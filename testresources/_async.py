@@ -0,0 +1,269 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+#  license you chose for the specific language governing permissions and
+#  limitations under that license.
+#
+
+"""asyncio support for testresources.
+
+This is kept out of testresources itself, as Python 2 cannot parse it.
+"""
+
+import asyncio
+import threading
+
+import testresources
+
+
+_loop = None
+# Held while the shared loop runs, so that only one thread runs it at once.
+_loop_lock = threading.RLock()
+
+
+def get_event_loop():
+    """Return the event loop that AsyncTestResourceManagers run on.
+
+    Resources made by AsyncTestResourceManagers may be bound to this loop, so
+    async tests using them should run on it too.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+        return _loop
+
+
+def run(coroutine):
+    """Run coroutine to completion on the shared event loop."""
+    with _loop_lock:
+        return get_event_loop().run_until_complete(coroutine)
+
+
+async def _gather(coroutines):
+    """Run coroutines together, raising the first error once all are done."""
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def _getResource(manager, result=None):
+    if isinstance(manager, AsyncTestResourceManager):
+        return await manager.getResourceAsync(result)
+    return manager.getResource(result)
+
+
+async def _finishedWith(manager, resource, result=None):
+    if isinstance(manager, AsyncTestResourceManager):
+        await manager.finishedWithAsync(resource, result)
+    else:
+        manager.finishedWith(resource, result)
+
+
+async def _isDirty(manager):
+    if isinstance(manager, AsyncTestResourceManager):
+        return await manager.isDirtyAsync()
+    return manager.isDirty()
+
+
+async def _reset(manager, resource, result=None):
+    if isinstance(manager, AsyncTestResourceManager):
+        return await manager.resetAsync(resource, result)
+    return manager.reset(resource, result)
+
+
+def has_async(resources):
+    """Return True if any of resources is an AsyncTestResourceManager."""
+    for resource in resources:
+        if isinstance(resource, AsyncTestResourceManager):
+            return True
+    return False
+
+
+def get_resources(resources, result):
+    """Get resources, gathering the async ones together on the event loop.
+
+    :param resources: Managers in topological order. Each run of async
+        managers is got at once, and sync managers in between are got
+        normally.
+    """
+    batch = []
+    for resource in resources:
+        if isinstance(resource, AsyncTestResourceManager):
+            batch.append(resource)
+            continue
+        if batch:
+            run(_gather([manager.getResourceAsync(result)
+                for manager in batch]))
+            batch = []
+        resource._hold(result)
+    if batch:
+        run(_gather([manager.getResourceAsync(result) for manager in batch]))
+
+
+def finish_resources(resources, result):
+    """Finish with resources, gathering the async ones together.
+
+    :param resources: Managers with dependents before their dependencies.
+        Reference counting keeps dependencies until their dependents have
+        been cleaned, even when they are finished with together.
+    """
+    batch = []
+    for resource in resources:
+        if isinstance(resource, AsyncTestResourceManager):
+            batch.append(resource)
+            continue
+        if batch:
+            run(_gather([manager.finishedWithAsync(
+                manager._currentResource, result) for manager in batch]))
+            batch = []
+        resource._release(result)
+    if batch:
+        run(_gather([manager.finishedWithAsync(
+            manager._currentResource, result) for manager in batch]))
+
+
+class AsyncTestResourceManager(testresources.TestResourceManager):
+    """A TestResourceManager whose make, clean and _reset are coroutines.
+
+    Override make, and optionally clean and _reset, with async methods. The
+    dependencies of a resource are got concurrently, and
+    OptimisingTestSuite.switch gets and finishes with independent async
+    resources concurrently.
+
+    The blocking methods getResource, finishedWith, reset and isDirty run
+    their async versions on get_event_loop(), so they work unchanged from
+    synchronous tests. They cannot be called from a coroutine running on
+    that loop: use getResourceAsync and friends there. Sync managers can be
+    dependencies of async managers, but not the other way around.
+    """
+
+    def __init__(self):
+        super(AsyncTestResourceManager, self).__init__()
+        self._asyncLock = None
+
+    def _getAsyncLock(self):
+        # Made on first use, so that it belongs to the running loop.
+        if self._asyncLock is None:
+            self._asyncLock = asyncio.Lock()
+        return self._asyncLock
+
+    async def clean(self, resource):
+        """Override this to hook into resource removal."""
+
+    async def make(self, dependency_resources):
+        """Override this to construct resources.
+
+        :param dependency_resources: A dict mapping name -> resource instance
+            for the resources specified as dependencies.
+        :return: The made resource.
+        """
+        raise NotImplementedError(
+            "Override make to construct resources.")
+
+    async def _reset(self, resource, dependency_resources):
+        """Override this to reset resources other than via clean+make."""
+        await self.clean(resource)
+        return await self.make(dependency_resources)
+
+    def finishedWith(self, resource, result=None):
+        run(self.finishedWithAsync(resource, result))
+
+    def getResource(self, result=None):
+        return run(self.getResourceAsync(result))
+
+    def isDirty(self):
+        return run(self.isDirtyAsync())
+
+    def reset(self, old_resource, result=None):
+        return run(self.resetAsync(old_resource, result))
+
+    async def finishedWithAsync(self, resource, result=None):
+        """As finishedWith, but a coroutine."""
+        async with self._getAsyncLock():
+            self._uses -= 1
+            if self._uses == 0:
+                await self._clean_all_async(resource, result)
+                self._setResource(None)
+
+    async def getResourceAsync(self, result=None):
+        """As getResource, but a coroutine."""
+        async with self._getAsyncLock():
+            if self._uses == 0:
+                self._setResource(await self._make_all_async(result))
+            else:
+                self._reuses += 1
+                if await self.isDirtyAsync():
+                    self._dirtyReuses += 1
+                    self._setResource(
+                        await self.resetAsync(self._currentResource, result))
+            self._uses += 1
+            return self._currentResource
+
+    async def isDirtyAsync(self):
+        """As isDirty, but a coroutine."""
+        if self._dirty:
+            return True
+        for name, mgr in self.resources:
+            if await _isDirty(mgr):
+                return True
+            res = await _getResource(mgr)
+            try:
+                if res is not getattr(self._currentResource, name):
+                    return True
+            finally:
+                await _finishedWith(mgr, res)
+        return False
+
+    async def resetAsync(self, old_resource, result=None):
+        """As reset, but a coroutine."""
+        if not await self.isDirtyAsync():
+            return old_resource
+        self._call_result_method_if_exists(result, "startResetResource", self)
+        names = [name for name, _ in self.resources]
+        values = await _gather([
+            _reset(mgr, getattr(old_resource, name), result)
+            for name, mgr in self.resources])
+        dependency_resources = dict(zip(names, values))
+        start = testresources._timer()
+        resource = await self._reset(old_resource, dependency_resources)
+        self._measure('measuredResetCost', testresources._timer() - start)
+        for name, value in dependency_resources.items():
+            setattr(resource, name, value)
+        self._call_result_method_if_exists(result, "stopResetResource", self)
+        return resource
+
+    async def _clean_all_async(self, resource, result):
+        self._call_result_method_if_exists(result, "startCleanResource", self)
+        start = testresources._timer()
+        await self.clean(resource)
+        self._measure('measuredTearDownCost', testresources._timer() - start)
+        await _gather([_finishedWith(manager, getattr(resource, name))
+            for name, manager in self.resources])
+        self._call_result_method_if_exists(result, "stopCleanResource", self)
+
+    async def _make_all_async(self, result):
+        self._call_result_method_if_exists(result, "startMakeResource", self)
+        names = [name for name, _ in self.resources]
+        values = await _gather([_getResource(manager)
+            for _, manager in self.resources])
+        dependency_resources = dict(zip(names, values))
+        start = testresources._timer()
+        resource = await self.make(dependency_resources)
+        self._measure('measuredSetUpCost', testresources._timer() - start)
+        for name, value in dependency_resources.items():
+            setattr(resource, name, value)
+        self._call_result_method_if_exists(result, "stopMakeResource", self)
+        return resource
@@ -21,7 +21,10 @@ import testresources
 from testresources.tests import TestUtil
 
 def test_suite():
+    import testresources.tests.test_cost_store
     import testresources.tests.test_optimising_test_suite
+    import testresources.tests.test_partition_scheduler
+    import testresources.tests.test_pooled_resource
     import testresources.tests.test_resourced_test_case
     import testresources.tests.test_test_loader
     import testresources.tests.test_test_resource
@@ -31,6 +34,14 @@ def test_suite():
     result.addTest(testresources.tests.test_test_resource.test_suite())
     result.addTest(testresources.tests.test_resourced_test_case.test_suite())
     result.addTest(testresources.tests.test_resource_graph.test_suite())
+    result.addTest(testresources.tests.test_cost_store.test_suite())
+    result.addTest(testresources.tests.test_pooled_resource.test_suite())
+    result.addTest(
+        testresources.tests.test_partition_scheduler.test_suite())
+    if testresources._async is not None:
+        import testresources.tests.test_async_resource
+        result.addTest(
+            testresources.tests.test_async_resource.test_suite())
     result.addTest(
         testresources.tests.test_optimising_test_suite.test_suite())
     return result
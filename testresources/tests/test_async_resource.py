@@ -0,0 +1,215 @@
+#
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#  
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#  
+#  Unless required by applicable law or agreed to in writing, software distributed
+#  under these licenses is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+#  CONDITIONS OF ANY KIND, either express or implied.  See the license you chose
+#  for the specific language governing permissions and limitations under that
+#  license.
+#
+
+"""Tests for AsyncTestResourceManager."""
+
+import asyncio
+import unittest
+
+import testtools
+import testresources
+from testresources.tests import ResultWithResourceExtensions
+
+
+def test_suite():
+    from testresources.tests import TestUtil
+    loader = TestUtil.TestLoader()
+    result = loader.loadTestsFromName(__name__)
+    return result
+
+
+class MockResource(testresources.AsyncTestResourceManager):
+    """Async resource that logs makes and cleans."""
+
+    def __init__(self, name, log):
+        super(MockResource, self).__init__()
+        self.name = name
+        self.log = log
+
+    async def make(self, dependency_resources):
+        self.log.append(('make', self.name))
+        return MockResourceInstance(self.name)
+
+    async def clean(self, resource):
+        self.log.append(('clean', self.name))
+
+
+class MockResourceInstance(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class WaitingResource(testresources.AsyncTestResourceManager):
+    """Async resource whose make waits for another resource to be making."""
+
+    def __init__(self):
+        super(WaitingResource, self).__init__()
+        self.making = False
+        self.other = None
+        self.overlapped = False
+
+    async def make(self, dependency_resources):
+        self.making = True
+        for i in range(100):
+            if self.other.making:
+                self.overlapped = True
+                break
+            await asyncio.sleep(0)
+        return MockResourceInstance("waited")
+
+
+class TestAsyncTestResourceManager(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncTestResourceManager, self).setUp()
+        self.log = []
+
+    def testGetResourceAndFinishedWith(self):
+        manager = MockResource('one', self.log)
+        resource = manager.getResource()
+        self.assertEqual('one', resource.name)
+        self.assertIs(resource, manager.getResource())
+        self.assertEqual(2, manager._uses)
+        manager.finishedWith(resource)
+        manager.finishedWith(resource)
+        self.assertEqual([('make', 'one'), ('clean', 'one')], self.log)
+        self.assertEqual(None, manager._currentResource)
+        self.assertNotEqual(None, manager.measuredSetUpCost)
+        self.assertNotEqual(None, manager.measuredTearDownCost)
+
+    def testDependencies(self):
+        manager = MockResource('one', self.log)
+        async_dependency = MockResource('two', self.log)
+        sync_dependency = testresources.GenericResource(unittest.TestCase,
+            setup_method_name='setUp', teardown_method_name='tearDown')
+        manager.resources = [('two', async_dependency),
+                             ('sync', sync_dependency)]
+        resource = manager.getResource()
+        self.assertIs(async_dependency._currentResource, resource.two)
+        self.assertIs(sync_dependency._currentResource, resource.sync)
+        manager.finishedWith(resource)
+        self.assertEqual(
+            [('make', 'two'), ('make', 'one'), ('clean', 'one'),
+             ('clean', 'two')], self.log)
+        self.assertEqual(0, async_dependency._uses)
+        self.assertEqual(0, sync_dependency._uses)
+
+    def testDirtiedResourceReset(self):
+        manager = MockResource('one', self.log)
+        resource = manager.getResource()
+        manager.dirtied(resource)
+        self.assertTrue(manager.isDirty())
+        manager.getResource()
+        self.assertEqual(
+            [('make', 'one'), ('clean', 'one'), ('make', 'one')], self.log)
+        self.assertFalse(manager.isDirty())
+        self.assertEqual(1, manager.dirtyProbability())
+
+    def testResultCalls(self):
+        manager = MockResource('one', self.log)
+        result = ResultWithResourceExtensions()
+        manager.finishedWith(manager.getResource(result), result)
+        self.assertEqual(
+            [("make", "start", manager), ("make", "stop", manager),
+             ("clean", "start", manager), ("clean", "stop", manager)],
+            result._calls)
+
+    def testUnimplementedMake(self):
+        manager = testresources.AsyncTestResourceManager()
+        self.assertRaises(NotImplementedError, manager.getResource)
+
+    def testAsyncAPI(self):
+        manager = MockResource('one', self.log)
+        async def use():
+            resource = await manager.getResourceAsync()
+            await manager.finishedWithAsync(resource)
+            return resource
+        resource = testresources._async.run(use())
+        self.assertEqual('one', resource.name)
+        self.assertEqual([('make', 'one'), ('clean', 'one')], self.log)
+
+
+class TestSwitch(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSwitch, self).setUp()
+        self.log = []
+        self.suite = testresources.OptimisingTestSuite()
+
+    def testIndependentMakesGathered(self):
+        resource1 = WaitingResource()
+        resource2 = WaitingResource()
+        resource1.other = resource2
+        resource2.other = resource1
+        self.suite.switch(set(), [resource1, resource2], None)
+        self.assertTrue(resource1.overlapped)
+        self.assertTrue(resource2.overlapped)
+        self.suite.switch([resource1, resource2], set(), None)
+        self.assertEqual(0, resource1._uses)
+        self.assertEqual(0, resource2._uses)
+
+    def testSharedDependency(self):
+        shared = MockResource('shared', self.log)
+        manager1 = MockResource('one', self.log)
+        manager1.resources = [('shared', shared)]
+        manager2 = MockResource('two', self.log)
+        manager2.resources = [('shared', shared)]
+        needed = testresources.neededResources([manager1, manager2])
+        self.suite.switch(set(), needed, None)
+        self.assertEqual(1, self.log.count(('make', 'shared')))
+        self.assertEqual(3, shared._uses)
+        self.suite.switch(needed, set(), None)
+        self.assertEqual(('clean', 'shared'), self.log[-1])
+        self.assertEqual(0, shared._uses)
+
+    def testMixedWithSyncResources(self):
+        sync = testresources.GenericResource(unittest.TestCase,
+            setup_method_name='setUp', teardown_method_name='tearDown')
+        manager = MockResource('one', self.log)
+        manager.resources = [('sync', sync)]
+        needed = testresources.neededResources([manager])
+        self.suite.switch(set(), needed, None)
+        self.assertEqual(2, sync._uses)
+        self.assertEqual(1, manager._uses)
+        self.suite.switch(needed, set(), None)
+        self.assertEqual(0, sync._uses)
+        self.assertEqual(0, manager._uses)
+
+    def testFailureRaised(self):
+        class Broken(testresources.AsyncTestResourceManager):
+            async def make(self, dependency_resources):
+                raise ValueError("broken")
+        other = MockResource('other', self.log)
+        self.assertRaises(ValueError, self.suite.switch,
+            set(), [Broken(), other], None)
+        self.assertEqual(1, other._uses)
+
+    def testRunSuite(self):
+        manager = MockResource('one', self.log)
+        class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
+            resources = [('one', manager)]
+            def runTest(self):
+                pass
+        self.suite.addTests(
+            [ResourcedTestCaseForTesting('runTest') for i in range(2)])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual([('make', 'one'), ('clean', 'one')], self.log)
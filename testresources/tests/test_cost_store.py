@@ -0,0 +1,265 @@
+#
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#  
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#  
+#  Unless required by applicable law or agreed to in writing, software distributed
+#  under these licenses is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+#  CONDITIONS OF ANY KIND, either express or implied.  See the license you chose
+#  for the specific language governing permissions and limitations under that
+#  license.
+#
+
+"""Tests for persistent resource cost stores."""
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import testtools
+import testresources
+
+
+def test_suite():
+    from testresources.tests import TestUtil
+    loader = TestUtil.TestLoader()
+    result = loader.loadTestsFromName(__name__)
+    return result
+
+
+class MockResource(testresources.TestResourceManager):
+
+    def make(self, dependency_resources):
+        return "boo"
+
+
+class DependentResource(testresources.TestResourceManager):
+
+    def make(self, dependency_resources):
+        return testresources.ResourcedTestCase('run')
+
+
+class ResourcedTest(testresources.ResourcedTestCase):
+
+    def test_nothing(self):
+        pass
+
+
+class BrokenCostStore(testresources.ResourceCostStore):
+
+    def load(self, key):
+        raise sqlite3.OperationalError("database is locked")
+
+    def record(self, key, attribute, seconds, weight):
+        raise sqlite3.OperationalError("database is locked")
+
+
+class TestSQLiteResourceCostStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteResourceCostStore, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'costs.sqlite')
+
+    def makeStore(self, max_age=60):
+        return testresources.SQLiteResourceCostStore(self.path, max_age)
+
+    def testEmpty(self):
+        self.assertEqual({}, self.makeStore().load('key'))
+
+    def testRecordAndLoad(self):
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 2.0, 0.5)
+        store.record('key', 'measuredTearDownCost', 1.0, 0.5)
+        store.record('other', 'measuredSetUpCost', 9.0, 0.5)
+        self.assertEqual(
+            {'measuredSetUpCost': 2.0, 'measuredTearDownCost': 1.0},
+            store.load('key'))
+
+    def testRecordsAreMovingAverages(self):
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 2.0, 0.5)
+        store.flush()
+        # A new store on the same file, as a later run would make.
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 4.0, 0.5)
+        self.assertEqual({'measuredSetUpCost': 3.0}, store.load('key'))
+
+    def testStaleEstimatesAgeOut(self):
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 2.0, 0.5)
+        store.flush()
+        real_time = time.time
+        self.patch(time, 'time', lambda: real_time() + 120)
+        self.assertEqual({}, store.load('key'))
+        # A stale estimate is replaced rather than averaged.
+        store.record('key', 'measuredSetUpCost', 4.0, 0.5)
+        self.assertEqual({'measuredSetUpCost': 4.0}, store.load('key'))
+
+    def testStaleEstimatesDeleted(self):
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 2.0, 0.5)
+        store.flush()
+        real_time = time.time
+        self.patch(time, 'time', lambda: real_time() + 120)
+        self.makeStore().load('key')
+        self.patch(time, 'time', real_time)
+        self.assertEqual({}, self.makeStore().load('key'))
+
+    def testConcurrentWriters(self):
+        errors = []
+        def record(key):
+            try:
+                store = self.makeStore()
+                for i in range(10):
+                    store.record(key, 'measuredSetUpCost', 1.0, 0.5)
+                    store.flush()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=record, args=('key%d' % i,))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        store = self.makeStore()
+        for i in range(5):
+            self.assertEqual(
+                {'measuredSetUpCost': 1.0}, store.load('key%d' % i))
+
+
+    def testRecordsBuffered(self):
+        store = self.makeStore()
+        store.record('key', 'measuredSetUpCost', 2.0, 0.5)
+        store.record('key', 'measuredSetUpCost', 4.0, 0.5)
+        self.assertEqual({}, self.makeStore().load('key'))
+        store.flush()
+        self.assertEqual(
+            {'measuredSetUpCost': 3.0}, self.makeStore().load('key'))
+
+    def testSchemaPreparedOncePerProcess(self):
+        statements = []
+        connect = sqlite3.connect
+        def tracing_connect(*args, **kwargs):
+            connection = connect(*args, **kwargs)
+            connection.set_trace_callback(statements.append)
+            return connection
+        self.patch(sqlite3, 'connect', tracing_connect)
+        store = self.makeStore()
+        for i in range(3):
+            store.record('key', 'measuredSetUpCost', 1.0, 0.5)
+            store.flush()
+        store.load('key')
+        self.assertEqual(1, len([statement for statement in statements
+            if statement.startswith('CREATE TABLE')]))
+
+
+class TestCostStoreIntegration(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCostStoreIntegration, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = testresources.SQLiteResourceCostStore(
+            os.path.join(directory, 'costs.sqlite'))
+
+    def testCostKey(self):
+        self.assertEqual(
+            'testresources.tests.test_cost_store.MockResource',
+            MockResource().costKey())
+
+    def testManagerRecordsTimings(self):
+        resource_manager = MockResource()
+        resource_manager.costStore = self.store
+        times = [1.0, 3.0, 10.0, 10.5]
+        self.patch(testresources, '_timer', lambda: times.pop(0))
+        resource_manager.finishedWith(resource_manager.getResource())
+        self.assertEqual(
+            {'measuredSetUpCost': 2.0, 'measuredTearDownCost': 0.5},
+            self.store.load(resource_manager.costKey()))
+
+    def testSuiteLoadsStoredCosts(self):
+        resource_manager = MockResource()
+        resource_manager.costStore = self.store
+        self.store.record(
+            resource_manager.costKey(), 'measuredSetUpCost', 5.0, 0.5)
+        case = testresources.ResourcedTestCase('run')
+        case.resources = [('resource', resource_manager)]
+        suite = testresources.OptimisingTestSuite([case])
+        suite.sortTests()
+        self.assertEqual(None, resource_manager.measuredSetUpCost)
+        suite.use_measured_costs = True
+        suite.sortTests()
+        self.assertEqual(5.0, resource_manager.measuredSetUpCost)
+
+    def testMeasuredCostsNotOverwrittenByStore(self):
+        resource_manager = MockResource()
+        resource_manager.costStore = self.store
+        resource_manager.measuredSetUpCost = 1.0
+        self.store.record(
+            resource_manager.costKey(), 'measuredSetUpCost', 5.0, 0.5)
+        resource_manager._loadMeasuredCosts()
+        self.assertEqual(1.0, resource_manager.measuredSetUpCost)
+
+    def testStoreFailuresOnlyWarn(self):
+        resource_manager = DependentResource()
+        dependency = MockResource()
+        resource_manager.resources = [('dependency', dependency)]
+        resource_manager.costStore = BrokenCostStore()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            resource_manager._loadMeasuredCosts()
+            resource = resource_manager.getResource()
+            self.assertEqual('boo', resource.dependency)
+            resource_manager.finishedWith(resource)
+        self.assertEqual(3, len(caught))
+        self.assertIn('database is locked', str(caught[0].message))
+        # The dependency is still released when the timing is lost.
+        self.assertEqual(0, dependency._uses)
+        self.assertEqual(None, dependency._currentResource)
+        self.assertNotEqual(None, resource_manager.measuredTearDownCost)
+
+    def testSuiteRunWritesTimingsOnce(self):
+        statements = []
+        connect = sqlite3.connect
+        def tracing_connect(*args, **kwargs):
+            connection = connect(*args, **kwargs)
+            connection.set_trace_callback(statements.append)
+            return connection
+        self.patch(sqlite3, 'connect', tracing_connect)
+        cases = []
+        for _ in range(3):
+            resource_manager = MockResource()
+            resource_manager.costStore = self.store
+            case = ResourcedTest('test_nothing')
+            case.resources = [('resource', resource_manager)]
+            cases.append(case)
+        testresources.OptimisingTestSuite(cases).run(
+            testtools.TestResult())
+        self.assertEqual(['BEGIN IMMEDIATE'], [statement
+            for statement in statements if statement.startswith('BEGIN')])
+        self.assertEqual(
+            ['measuredSetUpCost', 'measuredTearDownCost'],
+            sorted(self.store.load(MockResource().costKey())))
+
+
+class TestWithoutSQLite(testtools.TestCase):
+
+    def testImportable(self):
+        # sqlite3 is only needed by SQLiteResourceCostStore.
+        subprocess.check_call([sys.executable, '-c',
+            'import sys; sys.modules["sqlite3"] = None; import testresources'])
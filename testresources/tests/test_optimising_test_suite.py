@@ -15,8 +15,12 @@
 #  license.
 #
 
+import fixtures
 import testtools
+import os
 import random
+import threading
+import time
 import testresources
 from testresources import split_by_resources
 from testresources.tests import ResultWithResourceExtensions
@@ -25,6 +29,10 @@ try:
     import unittest2
 except ImportError:
     unittest2 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def test_suite():
@@ -64,6 +72,27 @@ class MakeCounter(testresources.TestResource):
         return resource
 
 
+def makeResourcedTestCase(resource_manager=None, test_running_hook=None):
+    """Make a ResourcedTestCase that runs test_running_hook.
+
+    :param resource_manager: If not None, the test uses it as _default.
+    """
+    class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
+        def runTest(self):
+            if test_running_hook is not None:
+                test_running_hook(self)
+    test_case = ResourcedTestCaseForTesting('runTest')
+    if resource_manager is not None:
+        test_case.resources = [('_default', resource_manager)]
+    return test_case
+
+
+def keepTestOrder(suite):
+    """Make suite run its tests in the order they were added."""
+    suite.sortTests = lambda: None
+    return suite
+
+
 class TestOptimisingTestSuite(testtools.TestCase):
 
     def makeTestCase(self, test_running_hook=None):
@@ -74,15 +103,6 @@ class TestOptimisingTestSuite(testtools.TestCase):
                     test_running_hook(self)
         return TestCaseForTesting('runTest')
 
-    def makeResourcedTestCase(self, resource_manager, test_running_hook):
-        """Make a ResourcedTestCase."""
-        class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
-            def runTest(self):
-                test_running_hook(self)
-        test_case = ResourcedTestCaseForTesting('runTest')
-        test_case.resources = [('_default', resource_manager)]
-        return test_case
-
     def setUp(self):
         super(TestOptimisingTestSuite, self).setUp()
         self.optimising_suite = testresources.OptimisingTestSuite()
@@ -161,7 +181,7 @@ class TestOptimisingTestSuite(testtools.TestCase):
         sample_resource = MakeCounter()
         def getResourceCount(test):
             self.assertEqual(sample_resource._uses, 2)
-        case = self.makeResourcedTestCase(sample_resource, getResourceCount)
+        case = makeResourcedTestCase(sample_resource, getResourceCount)
         self.optimising_suite.addTest(case)
         result = unittest.TestResult()
         self.optimising_suite.run(result)
@@ -173,8 +193,8 @@ class TestOptimisingTestSuite(testtools.TestCase):
         make_counter = MakeCounter()
         def getResourceCount(test):
             self.assertEqual(make_counter._uses, 2)
-        case = self.makeResourcedTestCase(make_counter, getResourceCount)
-        case2 = self.makeResourcedTestCase(make_counter, getResourceCount)
+        case = makeResourcedTestCase(make_counter, getResourceCount)
+        case2 = makeResourcedTestCase(make_counter, getResourceCount)
         self.optimising_suite.addTest(case)
         self.optimising_suite.addTest(case2)
         result = unittest.TestResult()
@@ -185,6 +205,86 @@ class TestOptimisingTestSuite(testtools.TestCase):
         self.assertEqual(make_counter.makes, 1)
         self.assertEqual(make_counter.cleans, 1)
 
+    def testSharedDeclarationResolvedOnce(self):
+        # Tests sharing a resources list only have it resolved once, by
+        # sortTests, and run reuses that.
+        resolved = []
+        real_neededResources = testresources.neededResources
+        def neededResources(resources):
+            resolved.append(resources)
+            return real_neededResources(resources)
+        self.patch(testresources, 'neededResources', neededResources)
+        make_counter = MakeCounter()
+        case = makeResourcedTestCase(make_counter, lambda test: None)
+        case2 = makeResourcedTestCase(make_counter, lambda test: None)
+        case2.resources = case.resources
+        self.optimising_suite.addTest(case)
+        self.optimising_suite.addTest(case2)
+        result = unittest.TestResult()
+        self.optimising_suite.run(result)
+        self.assertEqual(result.testsRun, 2)
+        self.assertEqual([[make_counter]], resolved)
+
+    def testDeclaredDirtiersRunLast(self):
+        make_counter = MakeCounter()
+        def dirtyResource(test):
+            make_counter.dirtied(test._default)
+        dirtier = makeResourcedTestCase(make_counter, dirtyResource)
+        dirtier.dirties = ['_default']
+        cases = [makeResourcedTestCase(make_counter, lambda test: None)
+            for i in range(2)]
+        self.optimising_suite.addTests([dirtier] + cases)
+        self.optimising_suite.sortTests()
+        self.assertEqual(cases + [dirtier], self.optimising_suite._tests)
+        result = unittest.TestResult()
+        self.optimising_suite.run(result)
+        self.assertEqual(3, result.testsRun)
+        self.assertEqual(1, make_counter.makes)
+
+    def testDirtiersLearntFromRuns(self):
+        make_counter = MakeCounter()
+        def dirtyResource(test):
+            make_counter.dirtied(test._default)
+        dirtier = makeResourcedTestCase(make_counter, dirtyResource)
+        cases = [makeResourcedTestCase(make_counter, lambda test: None)
+            for i in range(2)]
+        # Dirtiers are remembered by id.
+        for i, case in enumerate([dirtier] + cases):
+            case.id = lambda i=i: 'test%d' % i
+        self.optimising_suite.addTests([dirtier] + cases)
+        result = unittest.TestResult()
+        self.optimising_suite.run(result)
+        self.assertEqual(2, make_counter.makes)
+        self.optimising_suite.run(result)
+        self.assertEqual(cases + [dirtier], self.optimising_suite._tests)
+        self.assertEqual(3, make_counter.makes)
+
+    def testAlwaysDirtyResourcesNotLearnt(self):
+        # A FixtureResource is always dirty, so only tests calling dirtied
+        # are remembered as dirtiers.
+        fixture = testresources.FixtureResource(fixtures.Fixture())
+        case = makeResourcedTestCase(fixture, lambda test: None)
+        self.optimising_suite.addTest(case)
+        self.optimising_suite.run(unittest.TestResult())
+        self.assertEqual(set(), fixture._dirtiedBy)
+
+    def testDirtiersOfOneResourceBatched(self):
+        resource1 = MakeCounter()
+        resource2 = MakeCounter()
+        def makeCase(dirties):
+            case = makeResourcedTestCase(resource1, lambda test: None)
+            case.resources = [('one', resource1), ('two', resource2)]
+            case.dirties = dirties
+            return case
+        case1 = makeCase(['one'])
+        case2 = makeCase(['two'])
+        case3 = makeCase(['one'])
+        case4 = makeCase([])
+        self.optimising_suite.addTests([case1, case2, case3, case4])
+        self.optimising_suite.sortTests()
+        self.assertEqual(
+            [case4, case1, case3, case2], self.optimising_suite._tests)
+
     def testResultPassedToResources(self):
         resource_manager = MakeCounter()
         test_case = self.makeTestCase(lambda x:None)
@@ -219,7 +319,7 @@ class TestOptimisingTestSuite(testtools.TestCase):
         sample_resource = MakeCounter()
         def resourced_case_hook(test):
             self.assertTrue(sample_resource._uses > 0)
-        self.optimising_suite.addTest(self.makeResourcedTestCase(
+        self.optimising_suite.addTest(makeResourcedTestCase(
             sample_resource, resourced_case_hook))
         def normal_case_hook(test):
             # The resource should not be acquired when the normal test
@@ -237,7 +337,7 @@ class TestOptimisingTestSuite(testtools.TestCase):
         make_counter = MakeCounter()
         def dirtyResource(test):
             make_counter.dirtied(test._default)
-        case = self.makeResourcedTestCase(make_counter, dirtyResource)
+        case = makeResourcedTestCase(make_counter, dirtyResource)
         self.optimising_suite.addTest(case)
         result = unittest.TestResult()
         self.optimising_suite.run(result)
@@ -253,8 +353,8 @@ class TestOptimisingTestSuite(testtools.TestCase):
             make_counter.dirtied(test._default)
         def testTwo(test):
             make_counter.calls.append('test two')
-        case1 = self.makeResourcedTestCase(make_counter, testOne)
-        case2 = self.makeResourcedTestCase(make_counter, testTwo)
+        case1 = makeResourcedTestCase(make_counter, testOne)
+        case2 = makeResourcedTestCase(make_counter, testTwo)
         self.optimising_suite.addTest(case1)
         self.optimising_suite.addTest(case2)
         result = unittest.TestResult()
@@ -309,6 +409,632 @@ class TestOptimisingTestSuite(testtools.TestCase):
         # The second resource was cleaned before the first
         self.assertEqual(cleans, ['two', 'one'])
 
+    def testSwitchOnlyAtGroupBoundaries(self):
+        # Tests needing the same resources run without switching in between.
+        switches = []
+        class MockOptimisingTestSuite(testresources.OptimisingTestSuite):
+            def switch(self, old_resource_set, new_resource_set, result):
+                switches.append((list(old_resource_set),
+                                 list(new_resource_set)))
+                super(MockOptimisingTestSuite, self).switch(
+                    old_resource_set, new_resource_set, result)
+        make_counter = MakeCounter()
+        other_counter = MakeCounter()
+        cases = [makeResourcedTestCase(make_counter, lambda test: None)
+            for i in range(3)]
+        cases.append(
+            makeResourcedTestCase(other_counter, lambda test: None))
+        suite = MockOptimisingTestSuite(cases)
+        result = unittest.TestResult()
+        suite.run(result)
+        self.assertEqual(4, result.testsRun)
+        self.assertEqual(1, make_counter.makes)
+        self.assertEqual(3, len(switches))
+        self.assertEqual([], switches[0][0])
+        self.assertEqual([], switches[-1][1])
+
+    def testDirtiedResourceResetWithinGroup(self):
+        # Skipping switches within a group still resets dirtied resources.
+        make_counter = MakeCounter()
+        def dirtyResource(test):
+            make_counter.dirtied(test._default)
+        cases = [makeResourcedTestCase(make_counter, dirtyResource)
+            for i in range(3)]
+        self.optimising_suite.addTests(cases)
+        result = unittest.TestResult()
+        self.optimising_suite.run(result)
+        self.assertEqual(3, result.testsRun)
+        self.assertEqual(3, make_counter.makes)
+        self.assertEqual(3, make_counter.cleans)
+
+
+class EventResource(testresources.TestResource):
+    """Resource whose make sets an event and may wait for another."""
+
+    def __init__(self, wait_for=None):
+        testresources.TestResource.__init__(self)
+        self.made = threading.Event()
+        self.wait_for = wait_for
+        self.overlapped = None
+
+    def make(self, dependency_resources):
+        self.made.set()
+        if self.wait_for is not None:
+            self.overlapped = self.wait_for.made.wait(5)
+        return "made"
+
+
+@testtools.skipIf(testresources.futures is None, "concurrent.futures needed")
+class TestConcurrentSetUp(testtools.TestCase):
+
+    def setUp(self):
+        super(TestConcurrentSetUp, self).setUp()
+        self.suite = testresources.OptimisingTestSuite()
+        self.suite.setup_workers = 4
+
+    def testIndependentResourcesMadeTogether(self):
+        resource1 = EventResource()
+        resource2 = EventResource(wait_for=resource1)
+        resource1.wait_for = resource2
+        self.suite.switch(set(), [resource1, resource2], None)
+        self.assertEqual(True, resource1.overlapped)
+        self.assertEqual(True, resource2.overlapped)
+        self.assertEqual(1, resource1._uses)
+        self.assertEqual(1, resource2._uses)
+
+    def testDependenciesMadeFirst(self):
+        made = []
+        class Resource(testresources.TestResource):
+            def make(self, dependency_resources):
+                made.append(self)
+                return self
+        shared = Resource()
+        resource1 = Resource()
+        resource1.resources = [('shared', shared)]
+        resource2 = Resource()
+        resource2.resources = [('shared', shared)]
+        needed = testresources.neededResources([resource1, resource2])
+        self.suite.switch(set(), needed, None)
+        self.assertEqual(shared, made[0])
+        self.assertEqual(set([resource1, resource2]), set(made[1:]))
+        # The suite and each of the dependent resources hold shared.
+        self.assertEqual(3, shared._uses)
+        self.suite.switch(needed, set(), None)
+        self.assertEqual(0, shared._uses)
+
+    def testResultCallsPaired(self):
+        resource1 = EventResource()
+        resource2 = EventResource()
+        result = ResultWithResourceExtensions()
+        self.suite.switch(set(), [resource1, resource2], result)
+        for resource in [resource1, resource2]:
+            calls = [call for call in result._calls if call[2] is resource]
+            self.assertEqual(
+                [("make", "start", resource), ("make", "stop", resource)],
+                calls)
+
+    def testFailureRaised(self):
+        class Broken(testresources.TestResource):
+            def make(self, dependency_resources):
+                raise ValueError("broken")
+        dependent = testresources.TestResource()
+        broken = Broken()
+        dependent.resources = [('broken', broken)]
+        other = EventResource()
+        self.assertRaises(ValueError, self.suite.switch,
+            set(), [broken, other, dependent], None)
+        self.assertEqual(0, dependent._uses)
+
+
+@testtools.skipIf(testresources.futures is None, "concurrent.futures needed")
+class TestBackgroundTeardown(testtools.TestCase):
+
+    def setUp(self):
+        super(TestBackgroundTeardown, self).setUp()
+        self.suite = testresources.OptimisingTestSuite()
+        self.suite.background_teardown = True
+
+    def testTeardownOverlapsNextTests(self):
+        next_test_ran = threading.Event()
+        overlapped = []
+        class SlowClean(MakeCounter):
+            def clean(self, resource):
+                overlapped.append(next_test_ran.wait(5))
+                MakeCounter.clean(self, resource)
+        slow = SlowClean()
+        first = makeResourcedTestCase(slow, lambda test: None)
+        second = makeResourcedTestCase(
+            MakeCounter(), lambda test: next_test_ran.set())
+        self.suite.addTests([first, second])
+        # Keep the order the tests were added in.
+        keepTestOrder(self.suite)
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertEqual([True], overlapped)
+        self.assertEqual(1, slow.cleans)
+        self.assertEqual(None, self.suite._teardown)
+
+    def testTeardownSharingNextResourcesNotBackgrounded(self):
+        # Cleaning a resource may use its dependencies, so it is not done
+        # while the next tests use one of them.
+        events = []
+        class Dependent(MakeCounter):
+            def make(self, dependency_resources):
+                MakeCounter.make(self, dependency_resources)
+                # Dependencies are set as attributes on what is made.
+                return unittest.TestCase('run')
+            def clean(self, resource):
+                events.append(('clean', threading.current_thread()))
+                MakeCounter.clean(self, resource)
+        shared = MakeCounter()
+        first = Dependent()
+        first.resources = [('shared', shared)]
+        second = Dependent()
+        second.resources = [('shared', shared)]
+        self.suite.addTests([
+            makeResourcedTestCase(first, lambda test: None),
+            makeResourcedTestCase(second,
+                lambda test: events.append(('test', None)))])
+        keepTestOrder(self.suite)
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        # The second resource is only torn down once the tests finish.
+        self.assertEqual(
+            [('clean', threading.current_thread()), ('test', None)],
+            events[:2])
+        self.assertEqual(1, shared.makes)
+        self.assertEqual(1, shared.cleans)
+        self.assertEqual(0, shared._uses)
+
+    def testRunWaitsForTeardowns(self):
+        resource = MakeCounter()
+        self.suite.addTest(
+            makeResourcedTestCase(resource, lambda test: None))
+        self.suite.run(unittest.TestResult())
+        self.assertEqual(1, resource.cleans)
+        self.assertEqual(0, resource._uses)
+
+    def testTeardownErrorsReported(self):
+        class BrokenClean(MakeCounter):
+            def clean(self, resource):
+                raise ValueError("broken")
+        self.suite.addTest(
+            makeResourcedTestCase(BrokenClean(), lambda test: None))
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(1, result.testsRun)
+        self.assertEqual(1, len(result.errors))
+        self.assertIn("tearDown", str(result.errors[0][0]))
+        self.assertIn("ValueError", result.errors[0][1])
+
+    def testResultCalledOnRunningThread(self):
+        threads = []
+        class Result(ResultWithResourceExtensions):
+            def stopCleanResource(self, resource):
+                threads.append(threading.current_thread())
+                ResultWithResourceExtensions.stopCleanResource(
+                    self, resource)
+        resource = MakeCounter()
+        self.suite.addTest(
+            makeResourcedTestCase(resource, lambda test: None))
+        result = Result()
+        self.suite.run(result)
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertEqual(
+            [("clean", "start", resource), ("clean", "stop", resource)],
+            [call for call in result._calls if call[0] == "clean"])
+
+
+class ThreadRecordingResource(MakeCounter):
+    """Resource that records the threads it is made on."""
+
+    prefetch = True
+
+    def __init__(self):
+        MakeCounter.__init__(self)
+        self.made = threading.Event()
+        self.threads = []
+
+    def make(self, dependency_resources):
+        self.threads.append(threading.current_thread())
+        self.made.set()
+        MakeCounter.make(self, dependency_resources)
+        # Dependencies are set as attributes on what is made.
+        return unittest.TestCase('run')
+
+
+@testtools.skipIf(testresources.futures is None, "concurrent.futures needed")
+class TestPrefetch(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.suite = keepTestOrder(testresources.OptimisingTestSuite())
+        self.suite.prefetch_lookahead = 1
+
+    def runSuite(self, first, second, timeout=0):
+        """Run a test using first then one using second.
+
+        :param timeout: How long the first test waits for second to be made.
+        :return: Whether second was made while the first test ran.
+        """
+        prefetched = []
+        self.suite.addTests([
+            makeResourcedTestCase(first,
+                lambda test: prefetched.append(second.made.wait(timeout))),
+            makeResourcedTestCase(second, lambda test: None)])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(0, first._uses)
+        self.assertEqual(0, second._uses)
+        self.assertEqual(1, second.makes)
+        self.assertEqual(1, second.cleans)
+        return prefetched[0]
+
+    def testNextGroupPrefetched(self):
+        second = ThreadRecordingResource()
+        self.assertTrue(self.runSuite(MakeCounter(), second, 5))
+        self.assertNotEqual([threading.current_thread()], second.threads)
+
+    def testOnlyPrefetchableResourcesPrefetched(self):
+        second = ThreadRecordingResource()
+        second.prefetch = False
+        self.runSuite(MakeCounter(), second)
+        self.assertEqual([threading.current_thread()], second.threads)
+
+    def testResourcesSharingHeldResourcesNotPrefetched(self):
+        first = ThreadRecordingResource()
+        second = ThreadRecordingResource()
+        second.resources = [('first', first)]
+        self.runSuite(first, second)
+        self.assertEqual([threading.current_thread()], second.threads)
+
+    def testMemoryLimit(self):
+        self.suite.prefetch_memory_limit = 5
+        first = MakeCounter()
+        first.memoryCost = 2
+        second = ThreadRecordingResource()
+        second.memoryCost = 4
+        self.runSuite(first, second)
+        self.assertEqual([threading.current_thread()], second.threads)
+
+    def runConcurrently(self, concurrency, wait_for_others):
+        """Prefetch two resources, needed by one test.
+
+        :param wait_for_others: A callable that each make calls, which must
+            return while the other resource has not been made.
+        :return: The most makes running at the same time.
+        """
+        making = []
+        most = []
+        lock = threading.Lock()
+        class Concurrent(ThreadRecordingResource):
+            prefetchConcurrency = concurrency
+            def make(self, dependency_resources):
+                with lock:
+                    making.append(self)
+                    most.append(len(making))
+                try:
+                    wait_for_others()
+                    return ThreadRecordingResource.make(
+                        self, dependency_resources)
+                finally:
+                    with lock:
+                        making.remove(self)
+        second = Concurrent()
+        third = Concurrent()
+        both = makeResourcedTestCase(second, lambda test: None)
+        both.resources.append(('_other', third))
+        self.suite.addTests([
+            makeResourcedTestCase(MakeCounter(),
+                lambda test: (second.made.wait(5), third.made.wait(5))),
+            both])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        self.assertNotIn(threading.current_thread(), second.threads)
+        self.assertNotIn(threading.current_thread(), third.threads)
+        return max(most)
+
+    def testPrefetchedOneAtATimeByDefault(self):
+        self.assertEqual(1, self.runConcurrently(1, lambda: time.sleep(0.05)))
+
+    def testPrefetchConcurrency(self):
+        barrier = threading.Barrier(2, timeout=5)
+        self.assertEqual(2, self.runConcurrently(2, barrier.wait))
+
+
+class ReadOnlyResource(MakeCounter):
+    """A resource that tests may use at the same time."""
+
+    concurrencySafe = True
+
+
+class EventLoggingResult(unittest.TestResult):
+    """A result logging when tests start and stop."""
+
+    def __init__(self):
+        unittest.TestResult.__init__(self)
+        self.events = []
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self.events.append(('start', test))
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self.events.append(('stop', test))
+
+
+@testtools.skipIf(testresources.futures is None, "concurrent.futures needed")
+class TestConcurrentTests(testtools.TestCase):
+
+    def setUp(self):
+        super(TestConcurrentTests, self).setUp()
+        self.suite = keepTestOrder(testresources.OptimisingTestSuite())
+        self.suite.test_workers = 2
+        self.threads = {}
+        self.both_running = threading.Event()
+        self.running = []
+
+    def makeTestCase(self, resource, name, test_running_hook=None):
+        """Make a test recording the thread it runs on under name."""
+        def run(test):
+            self.threads[name] = threading.current_thread()
+            if test_running_hook is not None:
+                test_running_hook(test)
+        case = makeResourcedTestCase(resource, run)
+        case.id = lambda: name
+        return case
+
+    def waitForOther(self, test):
+        """Wait until another test is running too."""
+        self.running.append(test)
+        if len(self.running) == 2:
+            self.both_running.set()
+        test.assertTrue(self.both_running.wait(5))
+
+    def runSuite(self, tests):
+        self.suite.addTests(tests)
+        result = EventLoggingResult()
+        self.suite.run(result)
+        self.assertEqual(len(tests), result.testsRun)
+        self.assertTrue(result.wasSuccessful(), result.errors + result.failures)
+        return result
+
+    def testSafeResourceTestsRunTogether(self):
+        resource = ReadOnlyResource()
+        self.runSuite([self.makeTestCase(resource, 'a', self.waitForOther),
+            self.makeTestCase(resource, 'b', self.waitForOther)])
+        self.assertNotEqual(self.threads['a'], self.threads['b'])
+        self.assertEqual(1, resource.makes)
+        self.assertEqual(0, resource._uses)
+
+    def testResultCallsNotInterleaved(self):
+        resource = ReadOnlyResource()
+        tests = [self.makeTestCase(resource, 'a', self.waitForOther),
+            self.makeTestCase(resource, 'b', self.waitForOther)]
+        result = self.runSuite(tests)
+        starts = [event for event in result.events if event[0] == 'start']
+        self.assertEqual(2, len(starts))
+        for start in starts:
+            position = result.events.index(start)
+            self.assertEqual(('stop', start[1]), result.events[position + 1])
+
+    def testUnsafeResourceTestsRunSerially(self):
+        resource = MakeCounter()
+        self.runSuite([self.makeTestCase(resource, name) for name in 'ab'])
+        self.assertEqual([threading.current_thread()] * 2,
+            [self.threads['a'], self.threads['b']])
+
+    def testSerialOnceDirtied(self):
+        resource = ReadOnlyResource()
+        def dirty(test):
+            resource.dirtied(test._default)
+        tests = [self.makeTestCase(resource, 'a', dirty)]
+        tests.extend(self.makeTestCase(resource, name) for name in 'bcd')
+        self.runSuite(tests)
+        # b may run alongside a, but no test starts once a has finished.
+        self.assertEqual([threading.current_thread()] * 2,
+            [self.threads['c'], self.threads['d']])
+        self.assertEqual(2, resource.makes)
+
+    def testDeclaredDirtiersRunSerially(self):
+        resource = ReadOnlyResource()
+        dirtier = self.makeTestCase(resource, 'b')
+        dirtier.dirties = ['_default']
+        self.runSuite([self.makeTestCase(resource, 'a'), dirtier])
+        self.assertEqual(threading.current_thread(), self.threads['b'])
+
+
+class TestParallelOptimisingTestSuite(testtools.TestCase):
+
+    def setUp(self):
+        super(TestParallelOptimisingTestSuite, self).setUp()
+        if testresources._fork_context() is None:
+            self.skipTest("Worker processes need fork.")
+        self.suite = testresources.ParallelOptimisingTestSuite()
+        self.suite.processes = 2
+
+    def testPartitionsRunInWorkers(self):
+        parent = os.getpid()
+        def check_in_worker(resource):
+            def check(test):
+                test.assertNotEqual(parent, os.getpid())
+                test.assertEqual(1, resource.makes)
+            return check
+        first = MakeCounter()
+        second = MakeCounter()
+        tests = [makeResourcedTestCase(resource, check_in_worker(resource))
+            for resource in (first, second, first, second)]
+        self.suite.addTests(tests)
+        result = ResultWithResourceExtensions()
+        self.suite.run(result)
+        self.assertEqual(4, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        # The workers own their managers: those here are untouched.
+        self.assertEqual(0, first.makes)
+        self.assertEqual(0, first._uses)
+        # But what happened to them is reported with them.
+        for resource in (first, second):
+            self.assertEqual(1, result._calls.count(
+                ("make", "start", resource)))
+            self.assertEqual(1, result._calls.count(
+                ("clean", "stop", resource)))
+
+    def testOutcomesReportedAgainstTests(self):
+        def fail(test):
+            test.fail("failed in a worker")
+        def error(test):
+            raise ValueError("broken in a worker")
+        def skip(test):
+            test.skipTest("skipped in a worker")
+        failing = makeResourcedTestCase(MakeCounter(), fail)
+        erroring = makeResourcedTestCase(MakeCounter(), error)
+        skipping = makeResourcedTestCase(test_running_hook=skip)
+        self.suite.addTests([failing, erroring, skipping])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(3, result.testsRun)
+        self.assertEqual([failing], [test for test, _ in result.failures])
+        self.assertIn("failed in a worker", result.failures[0][1])
+        self.assertEqual([erroring], [test for test, _ in result.errors])
+        self.assertIn("ValueError: broken in a worker", result.errors[0][1])
+        self.assertEqual([(skipping, "skipped in a worker")], result.skipped)
+
+    def testWorkerExitingReported(self):
+        self.suite.addTests([
+            makeResourcedTestCase(MakeCounter(), lambda test: os._exit(1)),
+            makeResourcedTestCase(MakeCounter())])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(1, len(result.errors))
+        self.assertIn("exited", result.errors[0][1])
+
+    def testStopCleansWorkerResources(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        class MarkerResource(testresources.TestResourceManager):
+            def make(self, dependency_resources):
+                path = os.path.join(directory, str(id(self)))
+                open(path, 'w').close()
+                return path
+            def clean(self, resource):
+                os.remove(resource)
+        def fail(test):
+            test.fail("stop")
+        def wait(test):
+            time.sleep(0.2)
+        tests = [makeResourcedTestCase(MarkerResource(), fail)]
+        tests.extend(makeResourcedTestCase(MarkerResource(), wait)
+            for _ in range(3))
+        self.suite.addTests(tests)
+        result = unittest.TestResult()
+        result.failfast = True
+        self.suite.run(result)
+        self.assertTrue(result.shouldStop)
+        self.assertEqual(1, len(result.failures))
+        self.assertLess(result.testsRun, 4)
+        self.assertEqual([], os.listdir(directory))
+
+    def testTestsCanStartProcesses(self):
+        def start_process(test):
+            process = testresources._fork_context().Process(target=int)
+            process.start()
+            process.join()
+            test.assertEqual(0, process.exitcode)
+        self.suite.addTests([
+            makeResourcedTestCase(MakeCounter(), start_process),
+            makeResourcedTestCase(MakeCounter(), start_process)])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+
+    def testRunsInProcessWithOneWorker(self):
+        self.suite.processes = 1
+        parent = os.getpid()
+        self.suite.addTests([
+            makeResourcedTestCase(MakeCounter(),
+                lambda test: test.assertEqual(parent, os.getpid())),
+            makeResourcedTestCase(test_running_hook=
+                lambda test: test.assertEqual(parent, os.getpid()))])
+        result = unittest.TestResult()
+        self.suite.run(result)
+        self.assertEqual(2, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+
+    def testPartitionTests(self):
+        shared = MakeCounter()
+        first = MakeCounter()
+        first.resources = [('shared', shared)]
+        other = MakeCounter()
+        uses_first = makeResourcedTestCase(first)
+        uses_shared = makeResourcedTestCase(shared)
+        uses_other = makeResourcedTestCase(other)
+        plain = [makeResourcedTestCase() for _ in range(3)]
+        self.suite.addTests([uses_first, uses_other] + plain + [uses_shared])
+        partitions = self.suite._partitionTests(2)
+        # Costliest first: the shared partition makes and cleans two
+        # resources and runs two tests.
+        self.assertEqual(set([uses_first, uses_shared]), set(partitions[0]))
+        self.assertEqual(
+            [[uses_other]] + [[test] for test in plain], partitions[1:])
+
+    def testSplitPartitions(self):
+        self.suite.split_partitions = True
+        database = MakeCounter()
+        tests = [makeResourcedTestCase(database)]
+        for _ in range(3):
+            resource = ThreadRecordingResource()
+            resource.resources = [('database', database)]
+            tests.append(makeResourcedTestCase(resource))
+        self.suite.addTests(tests)
+        partitions = self.suite._partitionTests(2)
+        self.assertEqual([2, 2], [len(tests) for tests in partitions])
+        result = ResultWithResourceExtensions()
+        self.suite.run(result)
+        self.assertEqual(4, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        # Each worker made its own copy of the database.
+        self.assertEqual(2, result._calls.count(
+            ("make", "start", database)))
+
+
+class TestOrderedSet(testtools.TestCase):
+
+    def testKeepsInsertionOrder(self):
+        ordered = testresources._OrderedSet([3, 1, 2, 1])
+        self.assertEqual([3, 1, 2], list(ordered))
+        self.assertEqual([2, 1, 3], list(reversed(ordered)))
+        self.assertEqual(3, len(ordered))
+
+    def testAddAndDiscard(self):
+        ordered = testresources._OrderedSet()
+        ordered.add(1)
+        ordered.add(2)
+        ordered.add(1)
+        ordered.discard(1)
+        ordered.discard(5)
+        self.assertEqual([2], list(ordered))
+        self.assertFalse(1 in ordered)
+        self.assertTrue(2 in ordered)
+
+    def testDifference(self):
+        ordered = testresources._OrderedSet([4, 3, 2, 1])
+        difference = ordered - testresources._OrderedSet([3, 1])
+        self.assertIsInstance(difference, testresources._OrderedSet)
+        self.assertEqual([4, 2], list(difference))
+        self.assertEqual([4, 2], list(ordered.difference([3, 1])))
+        self.assertEqual([2, 4], ordered.reversed_difference(set([3, 1])))
+
+    def testSetComparisons(self):
+        self.assertEqual(testresources._OrderedSet([1, 2]), set([2, 1]))
+        self.assertTrue(testresources._OrderedSet([1]) <= set([1, 2]))
+
 
 class TestSplitByResources(testtools.TestCase):
     """Tests for split_by_resources."""
@@ -381,6 +1107,22 @@ class TestSplitByResources(testtools.TestCase):
             self.assertEqual([case], resource_set_tests[frozenset([resource])])
 
 
+    def testMasks(self):
+        resource1 = testresources.TestResource()
+        resource2 = testresources.TestResource()
+        resource1.resources = [('foo', resource2)]
+        resourced_case = self.makeResourcedTestCase(has_resource=False)
+        resourced_case.resources = [('resource1', resource1)]
+        normal_case = self.makeTestCase()
+        index = testresources._ResourceIndex()
+        resource_set_tests = testresources._split_by_resource_masks(
+            [resourced_case, normal_case], index)
+        self.assertEqual({0: [normal_case], 3: [resourced_case]},
+            resource_set_tests)
+        self.assertEqual(frozenset([resource1, resource2]),
+            index.resources(3))
+
+
 class TestCostOfSwitching(testtools.TestCase):
     """Tests for cost_of_switching."""
 
@@ -433,6 +1175,42 @@ class TestCostOfSwitching(testtools.TestCase):
         self.assertEqual(
             2, self.suite.cost_of_switching(set([a, c]), set([b, c])))
 
+    def testMeasuredCostsIgnoredByDefault(self):
+        a = self.makeResource()
+        a.measuredSetUpCost = 5
+        a.measuredTearDownCost = 7
+        self.assertEqual(1, self.suite.cost_of_switching(set(), set([a])))
+        self.assertEqual(1, self.suite.cost_of_switching(set([a]), set()))
+
+    def testMeasuredCosts(self):
+        a = self.makeResource()
+        a.measuredSetUpCost = 5
+        a.measuredTearDownCost = 7
+        b = self.makeResource(setUpCost=2)
+        self.suite.use_measured_costs = True
+        self.assertEqual(7, self.suite.cost_of_switching(set(), set([a, b])))
+        self.assertEqual(8, self.suite.cost_of_switching(set([a, b]), set()))
+
+    def testKeptDirtyResources(self):
+        # Keeping a resource costs resetting it, as often as it is dirty.
+        a = self.makeResource(setUpCost=2, tearDownCost=3)
+        a.initialDirtyProbability = 1
+        b = self.makeResource()
+        b.initialDirtyProbability = 0.5
+        b.resetCost = 4
+        self.assertEqual(
+            7, self.suite.cost_of_switching(set([a, b]), set([a, b])))
+        self.assertEqual(
+            6, self.suite.cost_of_switching(set([a]), set([a, b])))
+
+    def testMeasuredResetCost(self):
+        a = self.makeResource()
+        a.initialDirtyProbability = 1
+        a.resetCost = 4
+        a.measuredResetCost = 0.5
+        self.suite.use_measured_costs = True
+        self.assertEqual(0.5, self.suite.cost_of_switching(set([a]), set([a])))
+
 
 class TestCostGraph(testtools.TestCase):
     """Tests for calculating the cost graph of resourced test cases."""
@@ -469,6 +1247,111 @@ class TestCostGraph(testtools.TestCase):
                           set2: {no_resources: 1, set1: 1 }}, graph)
 
 
+    def testMaskGraph(self):
+        res1 = self.makeResource()
+        res2 = self.makeResource(setUpCost=3)
+        suite = testresources.OptimisingTestSuite()
+        index = testresources._ResourceIndex()
+        set1 = index.mask([res1, res2])
+        set2 = index.mask([res2])
+        graph = suite._getGraph([0, set1, set2], index)
+        self.assertEqual({0: {set1: 4, set2: 3},
+                          set1: {set2: 1},
+                          set2: {set1: 1}}, graph)
+
+    def testOverriddenCostOfSwitching(self):
+        res1 = self.makeResource()
+        res2 = self.makeResource()
+        class CountingSuite(testresources.OptimisingTestSuite):
+            def cost_of_switching(self, old_resource_set, new_resource_set):
+                return len(old_resource_set) * 10 + len(new_resource_set)
+        suite = CountingSuite()
+        index = testresources._ResourceIndex()
+        set1 = index.mask([res1, res2])
+        set2 = index.mask([res2])
+        graph = suite._getGraph([0, set1, set2], index)
+        self.assertEqual({0: {set1: 2, set2: 1},
+                          set1: {set2: 21},
+                          set2: {set1: 12}}, graph)
+
+
+    def testCostMatrix(self):
+        res1 = self.makeResource()
+        res2 = self.makeResource(setUpCost=3)
+        res3 = self.makeResource(tearDownCost=7)
+        suite = testresources.OptimisingTestSuite()
+        suite.use_numpy = False
+        index = testresources._ResourceIndex()
+        masks = [0, index.mask([res1, res2]), index.mask([res2]),
+            index.mask([res3, res1])]
+        self.assertEqual(
+            [[0, 4, 3, 2],
+             [2, 0, 1, 2],
+             [1, 1, 0, 3],
+             [8, 10, 11, 0]],
+            suite._costMatrix(masks, index))
+
+    @testtools.skipIf(numpy is None, "NumPy needed")
+    def testNumpyCostMatrix(self):
+        res1 = self.makeResource()
+        res2 = self.makeResource(setUpCost=3)
+        res3 = self.makeResource(tearDownCost=7)
+        suite = testresources.OptimisingTestSuite()
+        index = testresources._ResourceIndex()
+        masks = [0, index.mask([res1, res2]), index.mask([res2]),
+            index.mask([res3, res1])]
+        costs = suite._costMatrix(masks, index)
+        self.assertIsInstance(costs, numpy.ndarray)
+        self.assertEqual(
+            [[0, 4, 3, 2],
+             [2, 0, 1, 2],
+             [1, 1, 0, 3],
+             [8, 10, 11, 0]],
+            costs.tolist())
+
+    def testMeasuredCostMatrix(self):
+        res1 = self.makeResource()
+        res1.measuredSetUpCost = 5
+        res2 = self.makeResource(setUpCost=3)
+        res2.measuredTearDownCost = 2
+        suite = testresources.OptimisingTestSuite()
+        suite.use_measured_costs = True
+        index = testresources._ResourceIndex()
+        masks = [0, index.mask([res1]), index.mask([res2])]
+        expected = [[0, 5, 3], [1, 0, 4], [2, 7, 0]]
+        suite.use_numpy = False
+        self.assertEqual(expected, suite._costMatrix(masks, index))
+        if numpy is not None:
+            suite.use_numpy = True
+            self.assertEqual(
+                expected, suite._costMatrix(masks, index).tolist())
+
+    def testDirtyResourceCostMatrix(self):
+        res1 = self.makeResource(setUpCost=2)
+        res1.initialDirtyProbability = 0.5
+        res2 = self.makeResource(setUpCost=3)
+        suite = testresources.OptimisingTestSuite()
+        index = testresources._ResourceIndex()
+        masks = [0, index.mask([res1]), index.mask([res1, res2])]
+        expected = [[0, 2, 5], [1, 0, 4.5], [2, 2.5, 0]]
+        suite.use_numpy = False
+        self.assertEqual(expected, suite._costMatrix(masks, index))
+        if numpy is not None:
+            suite.use_numpy = True
+            self.assertEqual(
+                expected, suite._costMatrix(masks, index).tolist())
+
+    def testCostMatrixOverriddenCostOfSwitching(self):
+        res1 = self.makeResource()
+        class CountingSuite(testresources.OptimisingTestSuite):
+            def cost_of_switching(self, old_resource_set, new_resource_set):
+                return len(old_resource_set) * 10 + len(new_resource_set)
+        suite = CountingSuite()
+        index = testresources._ResourceIndex()
+        masks = [0, index.mask([res1])]
+        self.assertEqual([[0, 1], [10, 0]], suite._costMatrix(masks, index))
+
+
 class TestGraphStuff(testtools.TestCase):
 
     def setUp(self):
@@ -676,6 +1559,41 @@ class TestGraphStuff(testtools.TestCase):
         result = self.sortTests(cases)
         self.assertEqual(12, len(result))
 
+    def testSolversRecorded(self):
+        resource_one = testresources.TestResource()
+        resource_two = testresources.TestResource()
+        self.case1.resources = [("_one", resource_one)]
+        self.case2.resources = [("_two", resource_two)]
+        self.case3.resources = [("_one", resource_one), ("_two", resource_two)]
+        suite = testresources.OptimisingTestSuite()
+        suite.addTests(self.cases)
+        suite.sortTests()
+        self.assertEqual(1, len(suite.partition_solvers))
+        solver, order = suite.partition_solvers[0]
+        self.assertEqual('exact', solver)
+        self.assertEqual(3, len(order))
+        suite.exact_ordering_limit = 2
+        suite.sortTests()
+        self.assertEqual(['mst'],
+            [solver for solver, order in suite.partition_solvers])
+
+    def testChristofidesLargePartition(self):
+        shared = testresources.TestResource()
+        cases = []
+        for pos in range(40):
+            case = testtools.clone_test_with_new_id(
+                self.case1, 'case%d' % pos)
+            case.resources = [('_shared', shared),
+                ('_own', testresources.TestResource())]
+            cases.append(case)
+        suite = testresources.OptimisingTestSuite()
+        suite.ordering = 'christofides'
+        suite.addTests(cases)
+        suite.sortTests()
+        self.assertEqual(['christofides'],
+            [solver for solver, order in suite.partition_solvers])
+        self.assertEqual(40, len(suite._tests))
+
     def testSortConsidersDependencies(self):
         """Tests with different dependencies are sorted together."""
         # We test this by having two resources (one and two) that share a very
@@ -720,3 +1638,76 @@ class TestGraphStuff(testtools.TestCase):
 
         for permutation in self._permute_four(self.cases):
             self.assertIn(self.sortTests(permutation), acceptable_orders)
+
+
+class TestGraphStuffApproximate(TestGraphStuff):
+    """Run the sorting tests without exact ordering of small partitions."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.exact_ordering_limit = 0
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
+
+
+class TestGraphStuffApproximatePurePython(TestGraphStuff):
+    """Run the approximate sorting tests without NumPy."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.exact_ordering_limit = 0
+        suite.use_numpy = False
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
+
+
+class TestGraphStuffChristofidesPurePython(TestGraphStuff):
+    """Run the Christofides sorting tests without NumPy."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.ordering = 'christofides'
+        suite.exact_ordering_limit = 0
+        suite.use_numpy = False
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
+
+
+class TestGraphStuffChristofides(TestGraphStuff):
+    """Run the sorting tests using the 'christofides' ordering."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.ordering = 'christofides'
+        suite.exact_ordering_limit = 0
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
+
+
+class TestGraphStuffChristofidesGreedy(TestGraphStuff):
+    """Run the sorting tests with Christofides always matching greedily."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.ordering = 'christofides'
+        suite.christofides_matching_limit = 0
+        suite.exact_ordering_limit = 0
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
+
+
+class TestGraphStuffRefined(TestGraphStuff):
+    """Run the sorting tests with local search refinement enabled."""
+
+    def sortTests(self, tests):
+        suite = testresources.OptimisingTestSuite()
+        suite.refine_moves = 100
+        suite.exact_ordering_limit = 0
+        suite.addTests(tests)
+        suite.sortTests()
+        return suite._tests
@@ -0,0 +1,190 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software distributed
+#  under these licenses is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+#  CONDITIONS OF ANY KIND, either express or implied.  See the license you chose
+#  for the specific language governing permissions and limitations under that
+#  license.
+#
+
+import unittest
+
+import testtools
+
+import testresources
+from testresources.tests import TestUtil
+
+
+def test_suite():
+    loader = TestUtil.TestLoader()
+    result = loader.loadTestsFromName(__name__)
+    return result
+
+
+class CostedResource(testresources.TestResourceManager):
+
+    def __init__(self, setUpCost=1, tearDownCost=1):
+        testresources.TestResourceManager.__init__(self)
+        self.setUpCost = setUpCost
+        self.tearDownCost = tearDownCost
+
+    def make(self, dependency_resources):
+        return unittest.TestCase('run')
+
+
+def makeTestCase(test_id, resources=()):
+    class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
+        def runTest(self):
+            pass
+    case = ResourcedTestCaseForTesting('runTest')
+    case.resources = [(str(position), resource)
+        for position, resource in enumerate(resources)]
+    case.id = lambda: test_id
+    return case
+
+
+class TestPartitionScheduler(testtools.TestCase):
+
+    def testDefaultDuration(self):
+        self.assertEqual(1,
+            testresources.PartitionScheduler(2).default_duration)
+        self.assertEqual(3, testresources.PartitionScheduler(
+            2, {'a': 2, 'b': 4}).default_duration)
+
+    def testEstimate(self):
+        resource = CostedResource(setUpCost=3, tearDownCost=2)
+        scheduler = testresources.PartitionScheduler(2, {'a': 4},
+            default_duration=0.5)
+        tests = [makeTestCase('a', [resource]),
+            makeTestCase('b', [resource])]
+        self.assertEqual(3 + 2 + 4 + 0.5, scheduler.estimate(tests))
+
+    def testLongestProcessingTimeFirst(self):
+        durations = {'a': 7, 'b': 5, 'c': 4, 'd': 3, 'e': 3}
+        scheduler = testresources.PartitionScheduler(2, durations)
+        plan = scheduler.plan(
+            [makeTestCase(test_id) for test_id in 'abcde'])
+        self.assertEqual([['a', 'd'], ['b', 'c', 'e']], plan.assignments)
+        self.assertEqual([10, 12], plan.costs)
+
+    def testPartitionsKeptTogether(self):
+        shared = CostedResource(setUpCost=10)
+        other = CostedResource()
+        tests = [makeTestCase('a', [shared]),
+            makeTestCase('b', [other]),
+            makeTestCase('c', [shared, other]),
+            makeTestCase('d', [CostedResource()])]
+        plan = testresources.PartitionScheduler(2).plan(tests)
+        self.assertEqual(['a', 'b', 'c'], sorted(plan.assignments[0]))
+        self.assertEqual(['d'], plan.assignments[1])
+        self.assertEqual([10 + 1 + 1 + 1 + 3, 1 + 1 + 1], plan.costs)
+
+    def testPlanReused(self):
+        plan = testresources.PartitionPlan([['a', 'b'], ['c']], [5, 2])
+        tests = [makeTestCase(test_id) for test_id in 'dcba']
+        self.assertEqual([[tests[3], tests[2]], [tests[1], tests[0]]],
+            plan.split(tests))
+
+    def testSplitSuite(self):
+        resource = CostedResource()
+        tests = [makeTestCase('a', [resource]),
+            makeTestCase('b'), makeTestCase('c', [resource])]
+        suites = testresources.PartitionScheduler(3)(unittest.TestSuite(tests))
+        self.assertEqual(2, len(suites))
+        for suite in suites:
+            self.assertIsInstance(
+                suite.suite, testresources.OptimisingTestSuite)
+        self.assertEqual([tests[0], tests[2]], list(suites[0]))
+        self.assertEqual([tests[1]], list(suites[1]))
+
+    def testConcurrentTestSuite(self):
+        resource = CostedResource()
+        tests = [makeTestCase(test_id, [resource])
+            for test_id in 'ab'] + [makeTestCase('c')]
+        suite = testtools.ConcurrentTestSuite(unittest.TestSuite(tests),
+            testresources.PartitionScheduler(2))
+        result = testtools.TestResult()
+        suite.run(result)
+        self.assertEqual(3, result.testsRun)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(0, resource._uses)
+
+
+class TestSplitPartitions(testtools.TestCase):
+
+    def makeGiantPartition(self, database):
+        """Make two tests for each of four resources that use database."""
+        tests = []
+        for group in 'abcd':
+            resource = CostedResource()
+            tests.extend(makeTestCase(group + str(position),
+                [database, resource]) for position in range(2))
+        return tests
+
+    def testNotSplitByDefault(self):
+        tests = self.makeGiantPartition(CostedResource(2, 1))
+        plan = testresources.PartitionScheduler(2, default_duration=10).plan(
+            tests)
+        self.assertEqual([8, 0], [len(ids) for ids in plan.assignments])
+        self.assertEqual(0, plan.duplicated_cost)
+        self.assertEqual(0, plan.makespan_reduction)
+
+    def testGiantPartitionSplit(self):
+        database = CostedResource(2, 1)
+        tests = self.makeGiantPartition(database)
+        plan = testresources.PartitionScheduler(2, default_duration=10,
+            split_partitions=True).plan(tests)
+        self.assertEqual([4, 4], [len(ids) for ids in plan.assignments])
+        # Each worker makes and cleans the database once, two resources of
+        # its own, and runs four tests.
+        self.assertEqual([3 + 4 + 40, 3 + 4 + 40], plan.costs)
+        # Unsplit, one worker would cost 3 + 8 + 80.
+        self.assertEqual(3, plan.duplicated_cost)
+        self.assertEqual(91 - 47, plan.makespan_reduction)
+        for ids in plan.assignments:
+            # Tests sharing a resource besides the database stay together.
+            self.assertEqual(2, len(set(test_id[0] for test_id in ids)))
+
+    def testFairShareNotSplit(self):
+        tests = self.makeGiantPartition(CostedResource(2, 1))[:4]
+        tests.extend(self.makeGiantPartition(CostedResource(2, 1))[:4])
+        plan = testresources.PartitionScheduler(2, default_duration=10,
+            split_partitions=True).plan(tests)
+        self.assertEqual([4, 4], [len(ids) for ids in plan.assignments])
+        self.assertEqual(0, plan.duplicated_cost)
+
+    def testCheapestSharedResourceCopied(self):
+        database = CostedResource()
+        cache = CostedResource(setUpCost=20)
+        tests = [makeTestCase('a', [database, cache]),
+            makeTestCase('b', [database, cache, CostedResource()]),
+            makeTestCase('c', [database, CostedResource()]),
+            makeTestCase('d', [database, CostedResource()])]
+        plan = testresources.PartitionScheduler(2, default_duration=20,
+            split_partitions=True).plan(tests)
+        # Only the database is copied, so the cache is made once.
+        self.assertIn(['a', 'b'], [sorted(ids) for ids in plan.assignments])
+        self.assertEqual(2, plan.duplicated_cost)
+
+    def testLinkedByEveryResource(self):
+        first = CostedResource()
+        second = CostedResource()
+        tests = [makeTestCase(test_id, [first, second])
+            for test_id in 'ab']
+        plan = testresources.PartitionScheduler(2,
+            split_partitions=True).plan(tests)
+        self.assertEqual([['a', 'b'], []], plan.assignments)
+
+    def testSplitSuiteRejected(self):
+        tests = self.makeGiantPartition(CostedResource(2, 1))
+        scheduler = testresources.PartitionScheduler(2, default_duration=10,
+            split_partitions=True)
+        self.assertRaises(ValueError, scheduler, unittest.TestSuite(tests))
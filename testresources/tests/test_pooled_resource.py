@@ -0,0 +1,255 @@
+#  testresources: extensions to python unittest to allow declaritive use
+#  of resources by test cases.
+#
+#  Copyright (c) 2005-2010 Testresources Contributors
+#
+#  Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+#  license at the users choice. A copy of both licenses are available in the
+#  project source as Apache-2.0 and BSD. You may not use this file except in
+#  compliance with one of these two licences.
+#
+#  Unless required by applicable law or agreed to in writing, software distributed
+#  under these licenses is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+#  CONDITIONS OF ANY KIND, either express or implied.  See the license you chose
+#  for the specific language governing permissions and limitations under that
+#  license.
+#
+
+"""Tests for PooledTestResourceManager."""
+
+import threading
+
+import testtools
+import testresources
+from testresources.tests import ResultWithResourceExtensions
+
+
+def test_suite():
+    from testresources.tests import TestUtil
+    loader = TestUtil.TestLoader()
+    result = loader.loadTestsFromName(__name__)
+    return result
+
+
+class PoolCounter(testresources.PooledTestResourceManager):
+    """Pooled resource that records makes, cleans and resets."""
+
+    def __init__(self, poolSize=2):
+        super(PoolCounter, self).__init__()
+        self.poolSize = poolSize
+        self.makes = 0
+        self.cleans = 0
+        self.reset_threads = []
+
+    def make(self, dependency_resources):
+        self.makes += 1
+        return PooledThing(self.makes)
+
+    def clean(self, resource):
+        self.cleans += 1
+
+    def _reset(self, resource, dependency_resources):
+        self.reset_threads.append(threading.current_thread())
+        return resource
+
+
+class PooledThing(object):
+
+    def __init__(self, number):
+        self.number = number
+
+
+class TestPooledTestResourceManager(testtools.TestCase):
+
+    def inThread(self, function, *args):
+        """Call function on a new thread, returning the thread and a list
+        that will hold the return value."""
+        returned = []
+        thread = threading.Thread(
+            target=lambda: returned.append(function(*args)))
+        # Do not keep a deadlocked test run from exiting.
+        thread.daemon = True
+        thread.start()
+        return thread, returned
+
+    def testSharedWithinThread(self):
+        manager = PoolCounter()
+        first = manager.getResource()
+        self.assertIs(first, manager.getResource())
+        manager.finishedWith(first)
+        self.assertEqual(0, manager.cleans)
+        manager.finishedWith(first)
+        self.assertEqual(1, manager.makes)
+        self.assertEqual(1, manager.cleans)
+        self.assertEqual(0, manager._uses)
+
+    def testEachThreadLent(self):
+        manager = PoolCounter()
+        held = manager.getResource()
+        thread, returned = self.inThread(manager.getResource)
+        thread.join()
+        self.assertIsNot(held, returned[0])
+        self.assertEqual(2, manager.makes)
+        self.assertEqual(2, manager._uses)
+        manager.finishedWith(returned[0])
+        manager.finishedWith(held)
+        self.assertEqual(2, manager.cleans)
+
+    def testIdleResourceLentAgain(self):
+        manager = PoolCounter()
+        held = manager.getResource()
+        def get_and_finish():
+            resource = manager.getResource()
+            manager.finishedWith(resource)
+            return resource
+        for _ in range(3):
+            thread, returned = self.inThread(get_and_finish)
+            thread.join()
+        self.assertEqual(2, manager.makes)
+        self.assertEqual(0, manager.cleans)
+        manager.finishedWith(held)
+        self.assertEqual(2, manager.cleans)
+
+    def testWaitsWhenExhausted(self):
+        manager = PoolCounter(poolSize=1)
+        held = manager.getResource()
+        thread, returned = self.inThread(manager.getResource)
+        thread.join(0.05)
+        self.assertEqual([], returned)
+        manager.finishedWith(held)
+        thread.join()
+        self.assertEqual(1, len(returned))
+        manager.finishedWith(returned[0])
+        self.assertEqual(0, manager._uses)
+        self.assertEqual(manager.makes, manager.cleans)
+
+    def testGrowPool(self):
+        manager = PoolCounter(poolSize=1)
+        manager.growPool = True
+        held = manager.getResource()
+        thread, returned = self.inThread(manager.getResource)
+        thread.join()
+        self.assertIsNot(held, returned[0])
+        manager.finishedWith(returned[0])
+        manager.finishedWith(held)
+        self.assertEqual(2, manager.cleans)
+
+    def testDirtyResourceResetInBackground(self):
+        manager = PoolCounter()
+        held = manager.getResource()
+        def dirty():
+            resource = manager.getResource()
+            manager.dirtied(resource)
+            manager.finishedWith(resource)
+            return threading.current_thread()
+        thread, returned = self.inThread(dirty)
+        thread.join()
+        manager.finishedWith(held)
+        self.assertEqual(1, len(manager.reset_threads))
+        self.assertNotIn(manager.reset_threads[0],
+            [threading.current_thread(), returned[0]])
+        self.assertEqual(2, manager.cleans)
+        self.assertEqual(set(), manager._dirtyResources)
+
+    def testLastDirtyResourceCleanedNotReset(self):
+        manager = PoolCounter()
+        resource = manager.getResource()
+        manager.dirtied(resource)
+        manager.finishedWith(resource)
+        self.assertEqual([], manager.reset_threads)
+        self.assertEqual(1, manager.cleans)
+
+    def testDirtiedWhileHeldResetOnReuse(self):
+        manager = PoolCounter()
+        resource = manager.getResource()
+        manager.dirtied(resource)
+        self.assertTrue(manager.isDirty())
+        self.assertIs(resource, manager.getResource())
+        self.assertEqual([threading.current_thread()], manager.reset_threads)
+        self.assertFalse(manager.isDirty())
+        manager.finishedWith(resource)
+        manager.finishedWith(resource)
+        self.assertEqual(1, manager.cleans)
+
+    def makeTests(self, *resources):
+        """Make two tests using resources."""
+        class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
+            def test_a(self):
+                pass
+            def test_b(self):
+                pass
+        ResourcedTestCaseForTesting.resources = list(resources)
+        return [ResourcedTestCaseForTesting('test_a'),
+            ResourcedTestCaseForTesting('test_b')]
+
+    def runSuite(self, suite):
+        """Run suite, failing rather than hanging if it deadlocks."""
+        result = ResultWithResourceExtensions()
+        thread, returned = self.inThread(suite.run, result)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        # Nothing is returned if run raised.
+        self.assertEqual([result], returned)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(2, result.testsRun)
+
+    def assertAllCleaned(self, manager):
+        self.assertEqual(0, manager._uses)
+        self.assertEqual(0, manager._live)
+        self.assertEqual({}, manager._lent)
+        self.assertEqual(manager.makes, manager.cleans)
+
+    def testOptimisingTestSuite(self):
+        manager = PoolCounter()
+        suite = testresources.OptimisingTestSuite(
+            self.makeTests(('thing', manager)))
+        self.runSuite(suite)
+        self.assertEqual(1, manager.makes)
+        self.assertAllCleaned(manager)
+
+    def testOptimisingTestSuiteSetupWorkers(self):
+        manager = PoolCounter()
+        other = PoolCounter()
+        suite = testresources.OptimisingTestSuite(
+            self.makeTests(('thing', manager), ('other', other)))
+        suite.setup_workers = 2
+        self.runSuite(suite)
+        self.assertEqual(1, manager.makes)
+        self.assertAllCleaned(manager)
+        self.assertAllCleaned(other)
+
+    def testOptimisingTestSuiteBackgroundTeardown(self):
+        manager = PoolCounter()
+        suite = testresources.OptimisingTestSuite(
+            self.makeTests(('thing', manager)))
+        suite.background_teardown = True
+        self.runSuite(suite)
+        self.assertEqual(1, manager.makes)
+        self.assertAllCleaned(manager)
+
+    def testOptimisingTestSuitePrefetch(self):
+        manager = PoolCounter()
+        manager.prefetch = True
+        other = PoolCounter()
+        suite = testresources.OptimisingTestSuite(
+            self.makeTests(('other', other))[:1] +
+            self.makeTests(('thing', manager))[:1])
+        # Keep the order the tests were added in.
+        suite.sortTests = lambda: None
+        suite.prefetch_lookahead = 1
+        self.runSuite(suite)
+        self.assertEqual(1, manager.makes)
+        self.assertAllCleaned(manager)
+        self.assertAllCleaned(other)
+
+    def testOptimisingTestSuiteTestWorkers(self):
+        # The suite does not borrow the only resource for itself, leaving
+        # none for its tests.
+        manager = PoolCounter(poolSize=1)
+        manager.concurrencySafe = True
+        suite = testresources.OptimisingTestSuite(
+            self.makeTests(('thing', manager)))
+        suite.test_workers = 2
+        self.runSuite(suite)
+        self.assertEqual(1, manager.makes)
+        self.assertAllCleaned(manager)
@@ -18,8 +18,15 @@
 
 """Test _resource_graph(resource_sets)."""
 
+import itertools
+import random
+
 import testtools
 import testresources
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from testresources import split_by_resources, _resource_graph
 from testresources.tests import ResultWithResourceExtensions
 import unittest
@@ -61,6 +68,155 @@ class TestResourceGraph(testtools.TestCase):
             result)
 
 
+    def test_masks(self):
+        result = _resource_graph([0, 1, 2, 3], testresources._iter_bits)
+        self.assertEqual({0:set([]), 1:set([3]), 2:set([3]), 3:set([1, 2])},
+            result)
+
+
+class TestPartitionResourceSets(testtools.TestCase):
+
+    def canonical(self, partitions):
+        return sorted(sorted(tuple(sorted(resource_set))
+            for resource_set in partition) for partition in partitions)
+
+    def test_empty(self):
+        no_resources = frozenset()
+        self.assertEqual([set([no_resources])],
+            testresources._partition_resource_sets([no_resources]))
+
+    def test_discrete(self):
+        resset1 = frozenset([testresources.TestResourceManager()])
+        resset2 = frozenset([testresources.TestResourceManager()])
+        self.assertEqual([set([resset1]), set([resset2])],
+            testresources._partition_resource_sets([resset1, resset2]))
+
+    def test_transitive(self):
+        res1 = testresources.TestResourceManager()
+        res2 = testresources.TestResourceManager()
+        res3 = testresources.TestResourceManager()
+        resset1 = frozenset([res1])
+        resset2 = frozenset([res1, res2])
+        resset3 = frozenset([res2, res3])
+        resset4 = frozenset([res3])
+        result = testresources._partition_resource_sets(
+            [resset1, resset4, resset2, resset3])
+        self.assertEqual([set([resset1, resset2, resset3, resset4])], result)
+
+    def test_masks(self):
+        self.assertEqual([set([0]), set([1, 3, 6]), set([8])],
+            testresources._partition_resource_sets(
+                [0, 1, 3, 6, 8], testresources._iter_bits))
+
+    def test_matches_graph_components(self):
+        resource_sets = set()
+        for _ in range(30):
+            resource_sets.add(frozenset(random.sample(range(40), 2)))
+        resource_sets.add(frozenset())
+        graph = _resource_graph(resource_sets)
+        expected = testresources._strongly_connected_components(
+            graph, frozenset())
+        self.assertEqual(self.canonical(expected), self.canonical(
+            testresources._partition_resource_sets(resource_sets)))
+
+
+class TestIterBits(testtools.TestCase):
+
+    def test_bits(self):
+        self.assertEqual([], list(testresources._iter_bits(0)))
+        self.assertEqual([1, 4, 256],
+            list(testresources._iter_bits(1 | 4 | 256)))
+
+
+class TestBitPositions(testtools.TestCase):
+
+    def test_positions(self):
+        self.assertEqual([], list(testresources._bit_positions(0)))
+        self.assertEqual([0, 2, 8, 70],
+            list(testresources._bit_positions(1 | 4 | 256 | (1 << 70))))
+
+
+class TestWeightedPopcount(testtools.TestCase):
+
+    def test_weights(self):
+        weights = list(range(1, 21))
+        tables = testresources._weighted_popcount_tables(weights)
+        self.assertEqual(3, len(tables))
+        for mask in (0, 1, 6, 255, 256, (1 << 20) - 1, (1 << 19) | 3):
+            expected = sum(weight for pos, weight in enumerate(weights)
+                if mask & (1 << pos))
+            self.assertEqual(expected,
+                testresources._weighted_popcount(mask, tables))
+
+
+class TestResourceIndex(testtools.TestCase):
+
+    def test_interning(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        res2 = testresources.TestResourceManager()
+        self.assertEqual(1, index.bit(res1))
+        self.assertEqual(2, index.bit(res2))
+        self.assertEqual(1, index.bit(res1))
+        self.assertEqual(3, index.mask([res1, res2]))
+        self.assertEqual([res1, res2], index.managers)
+        self.assertEqual(frozenset([res2]), index.resources(2))
+        self.assertEqual(frozenset(), index.resources(0))
+
+    def test_declaration(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        res2 = testresources.TestResourceManager()
+        res1.resources.append(("dep", res2))
+        mask, needed = index.declaration([("res1", res1)])
+        self.assertEqual(frozenset([res1, res2]), index.resources(mask))
+        self.assertEqual([res2, res1], needed)
+
+    def test_declaration_cached_by_identity(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        declaration = [("res1", res1)]
+        self.assertIs(
+            index.declaration(declaration), index.declaration(declaration))
+        self.assertEqual([], index.declaration(())[1])
+
+    def test_declaration_changed_in_place(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        res2 = testresources.TestResourceManager()
+        declaration = [("res1", res1)]
+        index.declaration(declaration)
+        declaration.append(("res2", res2))
+        self.assertEqual([res1, res2], index.declaration(declaration)[1])
+
+    def test_declaration_dependency_changed(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        res2 = testresources.TestResourceManager()
+        declaration = [("res1", res1)]
+        index.declaration(declaration)
+        res1.resources.append(("dep", res2))
+        self.assertEqual([res2, res1], index.declaration(declaration)[1])
+
+    def test_declaration_kept_when_managers_made(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        declaration = [("res1", res1)]
+        first = index.declaration(declaration)
+        other = testresources.TestResourceManager()
+        other.resources = [("res1", res1)]
+        self.assertIs(first, index.declaration(declaration))
+
+    def test_tables(self):
+        index = testresources._ResourceIndex()
+        res1 = testresources.TestResourceManager()
+        res1.setUpCost = 5
+        res2 = testresources.TestResourceManager()
+        index.mask([res1, res2])
+        tables = index.tables(lambda manager: manager.setUpCost)
+        self.assertEqual(6, testresources._weighted_popcount(3, tables))
+
+
 class TestDigraphToGraph(testtools.TestCase):
 
     def test_wikipedia_example(self):
@@ -137,3 +293,249 @@ class TestKruskalsMST(testtools.TestCase):
         self.assertEqual(e_weight, r_weight)
         self.assertEqual(expected,
             testresources._kruskals_graph_MST(graph))
+
+
+class TestPrimMST(testtools.TestCase):
+
+    def test_wikipedia_example(self):
+        """Matches the Kruskals example: A-G are 0-6."""
+        inf = float('inf')
+        graph = [
+            [inf,   7, inf,   5, inf, inf, inf],
+            [  7, inf,   8,   9,   7, inf, inf],
+            [inf,   8, inf, inf,   5, inf, inf],
+            [  5,   9, inf, inf,  15,   6, inf],
+            [inf,   7,   5,  15, inf,   8,   9],
+            [inf, inf, inf,   6,   8, inf,  11],
+            [inf, inf, inf, inf,   9,  11, inf]]
+        expected = {
+            0:{     1:7,      3:5},
+            1:{0:7,                 4:7},
+            2:{                     4:5},
+            3:{0:5,                      5:6},
+            4:{     1:7, 2:5,                  6:9},
+            5:{               3:6},
+            6:{                     4:9}}
+        self.assertEqual(expected,
+            testresources._prim_MST(7, graph.__getitem__))
+
+    def test_forest(self):
+        inf = float('inf')
+        graph = [
+            [inf,   1, inf],
+            [  1, inf, inf],
+            [inf, inf, inf]]
+        self.assertEqual({0: {1: 1}, 1: {0: 1}, 2: {}},
+            testresources._prim_MST(3, graph.__getitem__))
+
+    def test_empty(self):
+        self.assertEqual({}, testresources._prim_MST(0, None))
+
+
+class TestNumpyPrimMST(testtools.TestCase):
+
+    def setUp(self):
+        super(TestNumpyPrimMST, self).setUp()
+        if numpy is None:
+            self.skipTest("NumPy needed")
+
+    def test_wikipedia_example(self):
+        """Matches the Kruskals example: A-G are 0-6."""
+        inf = numpy.inf
+        graph = numpy.array([
+            [inf,   7, inf,   5, inf, inf, inf],
+            [  7, inf,   8,   9,   7, inf, inf],
+            [inf,   8, inf, inf,   5, inf, inf],
+            [  5,   9, inf, inf,  15,   6, inf],
+            [inf,   7,   5,  15, inf,   8,   9],
+            [inf, inf, inf,   6,   8, inf,  11],
+            [inf, inf, inf, inf,   9,  11, inf]])
+        expected = {
+            0:{     1:7,      3:5},
+            1:{0:7,                 4:7},
+            2:{                     4:5},
+            3:{0:5,                      5:6},
+            4:{     1:7, 2:5,                  6:9},
+            5:{               3:6},
+            6:{                     4:9}}
+        self.assertEqual(expected,
+            testresources._numpy_prim_MST(7, graph.__getitem__))
+
+    def test_forest(self):
+        inf = numpy.inf
+        graph = numpy.array([
+            [inf,   1, inf],
+            [  1, inf, inf],
+            [inf, inf, inf]])
+        self.assertEqual({0: {1: 1}, 1: {0: 1}, 2: {}},
+            testresources._numpy_prim_MST(3, graph.__getitem__))
+
+
+class TestMinWeightPerfectMatching(testtools.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], testresources._min_weight_perfect_matching({}, []))
+
+    def test_cheapest_pairs(self):
+        A = "A"
+        B = "B"
+        C = "C"
+        D = "D"
+        graph = {
+            A:{     B:1, C:5, D:5},
+            B:{A:1,      C:5, D:5},
+            C:{A:5, B:5,      D:1},
+            D:{A:5, B:5, C:1     }}
+        result = testresources._min_weight_perfect_matching(
+            graph, [A, B, C, D])
+        self.assertEqual(
+            set([frozenset([A, B]), frozenset([C, D])]),
+            set(frozenset(pair) for pair in result))
+
+
+class TestGreedyMatching(testtools.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], testresources._greedy_matching({}, []))
+
+    def test_cheapest_first(self):
+        A = "A"
+        B = "B"
+        C = "C"
+        D = "D"
+        graph = {
+            A:{     B:2, C:1, D:5},
+            B:{A:2,      C:1, D:3},
+            C:{A:1, B:1,      D:9},
+            D:{A:5, B:3, C:9     }}
+        result = testresources._greedy_matching(graph, [A, B, C, D])
+        self.assertEqual(
+            set([frozenset([A, C]), frozenset([B, D])]),
+            set(frozenset(pair) for pair in result))
+
+    def test_dense(self):
+        if numpy is None:
+            self.skipTest("NumPy is not installed")
+        graph = numpy.array([
+            [0, 9, 9, 9, 9],
+            [9, 0, 4, 1, 2],
+            [9, 4, 0, 2, 5],
+            [9, 1, 2, 0, 3],
+            [9, 2, 5, 3, 0]], dtype=float)
+        result = testresources._greedy_matching(graph, [1, 2, 3, 4])
+        self.assertEqual(
+            set([frozenset([1, 3]), frozenset([2, 4])]),
+            set(frozenset(pair) for pair in result))
+
+
+class TestChristofidesTour(testtools.TestCase):
+
+    def test_single_node(self):
+        self.assertEqual(["A"],
+            testresources._christofides_tour({"A": {}}, "A", 2))
+
+    def test_square(self):
+        """A tour of the corners of a square goes round the edge."""
+        A = "A"
+        B = "B"
+        C = "C"
+        D = "D"
+        graph = {
+            A:{     B:1, C:2, D:1},
+            B:{A:1,      C:1, D:2},
+            C:{A:2, B:1,      D:1},
+            D:{A:1, B:2, C:1     }}
+        tour = testresources._christofides_tour(graph, A, 4)
+        self.assertEqual(A, tour[0])
+        self.assertIn(tour, [[A, B, C, D], [A, D, C, B]])
+
+    def test_matching_limit(self):
+        # A star has three odd leaves plus an odd centre.
+        A = "A"
+        B = "B"
+        C = "C"
+        D = "D"
+        graph = {
+            A:{     B:1, C:1, D:1},
+            B:{A:1,      C:2, D:2},
+            C:{A:1, B:2,      D:2},
+            D:{A:1, B:2, C:2     }}
+        for matching_limit in (2, 4):
+            tour = testresources._christofides_tour(graph, A, matching_limit)
+            self.assertEqual(set([A, B, C, D]), set(tour))
+            self.assertEqual(4, len(tour))
+
+
+class TestHeldKarpTour(testtools.TestCase):
+
+    def test_short_tours_unchanged(self):
+        cost = lambda a, b: 1
+        self.assertEqual(["R"], testresources._held_karp_tour(["R"], cost))
+        self.assertEqual(["R", "A"],
+            testresources._held_karp_tour(["R", "A"], cost))
+
+    def test_optimal(self):
+        nodes = ["R"] + ["N%d" % pos for pos in range(6)]
+        weights = {}
+        for a in nodes:
+            for b in nodes:
+                weights[a, b] = random.randint(0, 20)
+        cost = lambda a, b: weights[a, b]
+        result = testresources._held_karp_tour(nodes, cost)
+        self.assertEqual("R", result[0])
+        self.assertEqual(sorted(nodes), sorted(result))
+        best = min(testresources._tour_cost(["R"] + list(rest), cost)
+            for rest in itertools.permutations(nodes[1:]))
+        self.assertEqual(best, testresources._tour_cost(result, cost))
+
+
+class TestRefineTour(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRefineTour, self).setUp()
+        # Points on a line: the best tour goes out and back.
+        self.positions = {"R": 0, "A": 1, "B": 2, "C": 3, "D": 4}
+        self.cost = lambda a, b: abs(self.positions[a] - self.positions[b])
+
+    def test_short_tours_unchanged(self):
+        self.assertEqual(["R", "A"],
+            testresources._refine_tour(["R", "A"], self.cost, 10))
+
+    def test_uncrosses(self):
+        tour = ["R", "C", "A", "D", "B"]
+        result = testresources._refine_tour(tour, self.cost, 10)
+        self.assertEqual("R", result[0])
+        self.assertEqual(sorted(tour), sorted(result))
+        self.assertEqual(8, testresources._tour_cost(result, self.cost))
+
+    def test_asymmetric(self):
+        # Going forwards round the cycle is cheap, backwards is expensive.
+        nodes = ["R", "A", "B", "C"]
+        def cost(a, b):
+            if nodes.index(b) == (nodes.index(a) + 1) % 4:
+                return 1
+            return 10
+        result = testresources._refine_tour(["R", "C", "B", "A"], cost, 10)
+        self.assertEqual(nodes, result)
+
+    def test_move_limit(self):
+        tour = ["R", "C", "A", "D", "B"]
+        self.assertEqual(tour, testresources._refine_tour(tour, self.cost, 0))
+
+    def test_deadline(self):
+        tour = ["R", "C", "A", "D", "B"]
+        self.assertEqual(tour,
+            testresources._refine_tour(tour, self.cost, 10, deadline=0))
+
+    def test_never_worse(self):
+        nodes = ["R"] + ["N%d" % pos for pos in range(8)]
+        weights = {}
+        for a in nodes:
+            for b in nodes:
+                weights[a, b] = random.randint(0, 20)
+        cost = lambda a, b: weights[a, b]
+        result = testresources._refine_tour(nodes, cost, 50)
+        self.assertEqual(sorted(nodes), sorted(result))
+        self.assertEqual("R", result[0])
+        self.assertTrue(testresources._tour_cost(result, cost) <=
+            testresources._tour_cost(nodes, cost))
@@ -160,3 +160,38 @@ class TestResourcedTestCase(testtools.TestCase):
         self.resourced_case.tearDown()
         self.failIf(hasattr(self.resourced_case, "foo"))
         self.assertEqual(self.resource_manager._uses, 0)
+
+
+class TestGetResult(testtools.TestCase):
+
+    def findResult(self):
+        return testresources._get_result()
+
+    def testRunPublishesResult(self):
+        found = []
+        class Example(testresources.ResourcedTestCase):
+            def test_example(inner):
+                found.append(testresources._get_result())
+        result = unittest.TestResult()
+        Example('test_example').run(result)
+        self.assertEqual([result], found)
+
+    def testActiveResult(self):
+        result = ResultWithResourceExtensions()
+        case = testresources.ResourcedTestCase('run')
+        case.resources = [("foo", MockResource(MockResourceInstance()))]
+        with testresources.activeResult(result):
+            case.setUpResources()
+            with testresources.activeResult(None):
+                self.assertIsNot(result, testresources._getActiveResult())
+            self.assertIs(result, testresources._getActiveResult())
+        self.assertEqual(2, len(result._calls))
+        case.tearDownResources()
+        self.assertEqual(2, len(result._calls))
+
+    def testFallsBackToStack(self):
+        def run(result):
+            return self.findResult()
+        result = unittest.TestResult()
+        with testresources.activeResult(None):
+            self.assertIs(result, run(result))
@@ -15,6 +15,9 @@
 #  license.
 #
 
+import copy
+import pickle
+
 from fixtures.tests.helpers import LoggingFixture
 import testtools
 
@@ -122,12 +125,182 @@ class TestTestResource(testtools.TestCase):
         dep1.resources.append(("dep2", dep2))
         self.assertEqual([dep2, dep1, resource], resource.neededResources())
 
+    def testneededResourcesDiamond(self):
+        # A dependency reached by two paths is only included once, after
+        # everything that needs it.
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        dep2 = testresources.TestResource()
+        base = testresources.TestResource()
+        resource.resources = [("dep1", dep1), ("dep2", dep2)]
+        dep1.resources.append(("base", base))
+        dep2.resources.append(("base", base))
+        self.assertEqual([base, dep1, dep2, resource],
+            resource.neededResources())
+
+    def testneededResourcesCached(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        resource.resources.append(("dep1", dep1))
+        first = resource.neededResources()
+        self.assertEqual(first, resource._needed_resources[1])
+        self.assertEqual(first, resource.neededResources())
+        # The caller gets their own list.
+        first.append(None)
+        self.assertEqual([dep1, resource], resource.neededResources())
+
+    def testneededResourcesInvalidatedByDependencyChange(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        dep2 = testresources.TestResource()
+        resource.resources.append(("dep1", dep1))
+        self.assertEqual([dep1, resource], resource.neededResources())
+        dep1.resources.append(("dep2", dep2))
+        self.assertEqual([dep2, dep1, resource], resource.neededResources())
+        dep1.resources[0] = ("dep2", resource.__class__())
+        self.assertEqual(3, len(resource.neededResources()))
+        self.assertFalse(dep2 in resource.neededResources())
+        del dep1.resources[:]
+        self.assertEqual([dep1, resource], resource.neededResources())
+
+    def testneededResourcesInvalidatedByAssignment(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        self.assertEqual([resource], resource.neededResources())
+        resource.resources = [("dep1", dep1)]
+        self.assertEqual([dep1, resource], resource.neededResources())
+
+    def testneededResourcesKeptWhenOthersChange(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        resource.resources.append(("dep1", dep1))
+        resource.neededResources()
+        cached = resource._needed_resources
+        # Making, or changing, managers the closure does not include leaves
+        # it cached.
+        other = testresources.TestResource()
+        other.resources.append(("dep1", dep1))
+        resource.neededResources()
+        self.assertIs(cached, resource._needed_resources)
+
+    def testneededResourcesInvalidatedByDependencyAssignment(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        dep2 = testresources.TestResource()
+        resource.resources.append(("dep1", dep1))
+        self.assertEqual([dep1, resource], resource.neededResources())
+        dep1.resources = [("dep2", dep2)]
+        self.assertEqual([dep2, dep1, resource], resource.neededResources())
+
+    def testClassResourcesCopied(self):
+        dep1 = testresources.TestResource()
+        class DeclaringResource(testresources.TestResource):
+            resources = [("dep1", dep1)]
+        resource = DeclaringResource()
+        self.assertEqual([("dep1", dep1)], resource.resources)
+        self.assertIsNot(DeclaringResource.resources, resource.resources)
+        self.assertEqual([dep1, resource], resource.neededResources())
+        self.assertIsNot(None, resource._needed_resources)
+        resource.resources.append(("dep2", testresources.TestResource()))
+        self.assertEqual(3, len(resource.neededResources()))
+
+    def testInitiallyNotLocked(self):
+        resource = testresources.TestResource()
+        self.assertIs(None, resource._lock)
+        resource._makeThreadSafe()
+        lock = resource._lock
+        self.assertIsNot(None, lock)
+        resource._makeThreadSafe()
+        self.assertIs(lock, resource._lock)
+
+    def testCopyable(self):
+        resource = MockResource()
+        resource._makeThreadSafe()
+        copied = copy.deepcopy(resource)
+        self.assertIs(None, copied._lock)
+        self.assertIsNot(None, resource._lock)
+        self.assertEqual(MockResourceInstance("Boo!"), copied.getResource())
+        unpickled = pickle.loads(pickle.dumps(testresources.TestResource()))
+        self.assertIs(None, unpickled._lock)
+
+    def testneededResourcesCircular(self):
+        resource = testresources.TestResource()
+        dep1 = testresources.TestResource()
+        resource.resources.append(("dep1", dep1))
+        dep1.resources.append(("resource", resource))
+        self.assertRaises(ValueError, resource.neededResources)
+
+    def testResourceClosures(self):
+        resource1 = testresources.TestResource()
+        resource2 = testresources.TestResource()
+        dep = testresources.TestResource()
+        resource1.resources.append(("dep", dep))
+        resource2.resources.append(("dep", dep))
+        closures = testresources.resourceClosures([resource1, resource2])
+        self.assertEqual({resource1: [dep, resource1],
+                          resource2: [dep, resource2],
+                          dep: [dep]}, closures)
+
     def testDefaultCosts(self):
         # The base TestResource costs 1 to set up and to tear down.
         resource_manager = testresources.TestResource()
         self.assertEqual(resource_manager.setUpCost, 1)
         self.assertEqual(resource_manager.tearDownCost, 1)
 
+    def testInitiallyNotMeasured(self):
+        resource_manager = testresources.TestResource()
+        self.assertEqual(None, resource_manager.measuredSetUpCost)
+        self.assertEqual(None, resource_manager.measuredTearDownCost)
+        self.assertEqual(None, resource_manager.measuredResetCost)
+
+    def patchTimer(self, *times):
+        """Make the clock used for measuring costs return times in turn."""
+        times = list(times)
+        self.patch(testresources, '_timer', lambda: times.pop(0))
+
+    def testMakeAndCleanMeasured(self):
+        resource_manager = MockResource()
+        self.patchTimer(1.0, 3.0, 10.0, 10.5)
+        resource = resource_manager.getResource()
+        self.assertEqual(2.0, resource_manager.measuredSetUpCost)
+        resource_manager.finishedWith(resource)
+        self.assertEqual(0.5, resource_manager.measuredTearDownCost)
+
+    def testMeasuredCostsAreMovingAverages(self):
+        resource_manager = MockResource()
+        resource_manager.measurementWeight = 0.5
+        self.patchTimer(0.0, 2.0, 3.0, 3.0, 3.0, 7.0)
+        resource_manager.finishedWith(resource_manager.getResource())
+        resource_manager.getResource()
+        self.assertEqual(3.0, resource_manager.measuredSetUpCost)
+
+    def testResetMeasured(self):
+        resource_manager = MockResettableResource()
+        self.patchTimer(0.0, 1.0, 5.0, 9.0)
+        resource = resource_manager.getResource()
+        resource_manager.dirtied(resource)
+        resource_manager.reset(resource)
+        self.assertEqual(4.0, resource_manager.measuredResetCost)
+
+    def testFailedMakeNotMeasured(self):
+        resource_manager = testresources.TestResource()
+        self.assertRaises(NotImplementedError, resource_manager.getResource)
+        self.assertEqual(None, resource_manager.measuredSetUpCost)
+
+    def testInitiallyNeverDirty(self):
+        resource_manager = testresources.TestResource()
+        self.assertEqual(None, resource_manager.resetCost)
+        self.assertEqual(0, resource_manager.dirtyProbability())
+
+    def testDirtyProbabilityLearnt(self):
+        resource_manager = MockResource()
+        resource = resource_manager.getResource()
+        resource_manager.dirtied(resource)
+        resource = resource_manager.getResource()
+        self.assertEqual(1.0, resource_manager.dirtyProbability())
+        resource_manager.getResource()
+        self.assertEqual(0.5, resource_manager.dirtyProbability())
+
     def testGetResourceReturnsMakeResource(self):
         resource_manager = MockResource()
         resource = resource_manager.getResource()
@@ -495,6 +668,10 @@ class TestGenericResource(testtools.TestCase):
         self.assertTrue(mgr.isDirty())
         mgr.finishedWith(resource)
 
+    def test_dirty_probability(self):
+        mgr = testresources.GenericResource(object)
+        self.assertEqual(1, mgr.dirtyProbability())
+
 
 class TestFixtureResource(testtools.TestCase):
 
@@ -514,6 +691,15 @@ class TestFixtureResource(testtools.TestCase):
         self.assertTrue(mgr.isDirty())
         mgr.finishedWith(resource)
 
+    def test_dirty_probability(self):
+        mgr = testresources.FixtureResource(LoggingFixture())
+        self.assertEqual(1, mgr.dirtyProbability())
+        resource = mgr.getResource()
+        mgr.getResource()
+        self.assertEqual(1, mgr.dirtyProbability())
+        mgr.finishedWith(resource)
+        mgr.finishedWith(resource)
+
     def test_reset_called(self):
         fixture = LoggingFixture()
         mgr = testresources.FixtureResource(fixture)